@@ -0,0 +1,391 @@
+#!/usr/bin/python
+
+"""
+End-to-end benchmark for gratia-gold.
+
+For each requested dataset size, this generates synthetic JobUsageRecord /
+JobUsageRecord_Meta data, loads it into SQLite (through the sqlite_mysqldb
+stand-in) or a local MySQL/MariaDB database, and runs gratia_gold.main
+against it with fake gcharge, grefund and goldsh tools on the PATH.
+
+It reports rows/s, summaries/s, charges/s, peak RSS and the time spent in
+each phase (from the [metrics] JSON file), and appends every result to a
+JSON-lines file so runs can be compared over time.
+
+Example:
+
+    python bench/gratia_bench.py --sizes 10000,100000 --workers 4
+"""
+
+import os
+import sys
+import pwd
+import time
+import random
+import shutil
+import optparse
+import resource
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+import simplejson
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+
+SCHEMA = [
+"""
+CREATE TABLE JobUsageRecord (
+  dbid INTEGER PRIMARY KEY,
+  ResourceType VARCHAR(255),
+  ReportableVOName VARCHAR(255),
+  LocalUserId VARCHAR(255),
+  Charge DOUBLE,
+  WallDuration DOUBLE,
+  CpuUserDuration DOUBLE,
+  CpuSystemDuration DOUBLE,
+  NodeCount INTEGER,
+  Njobs INTEGER,
+  Processors INTEGER,
+  EndTime DATETIME,
+  MachineName VARCHAR(255),
+  ProjectName VARCHAR(255)
+)
+""",
+"""
+CREATE TABLE JobUsageRecord_Meta (
+  dbid INTEGER PRIMARY KEY,
+  ProbeName VARCHAR(255)
+)
+""",
+]
+
+INSERT_JUR = "INSERT INTO JobUsageRecord VALUES " \
+    "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+INSERT_JURM = "INSERT INTO JobUsageRecord_Meta VALUES (%s, %s)"
+
+FAKE_GCHARGE = """#!/bin/sh
+%(sleep)s
+exit 0
+"""
+
+FAKE_GOLDSH = """#!%(python)s
+import re, sys, time
+for line in sys.stdin:
+    m = re.search(r'JobId="([0-9]+)"', line)
+    if m:
+        time.sleep(%(latency)f)
+        print "Successfully charged job %%s" %% m.group(1)
+"""
+
+CONFIG = """
+[gratia]
+db=%(db)s
+%(mysql)s
+probe=^bench:probe0$
+machinename=bench.machine
+aggregate=%(aggregate)s
+prefetch=%(prefetch)d
+
+[gold]
+home=%(workdir)s
+username=%(user)s
+backend=%(backend)s
+workers=%(workers)d
+port=%(port)d
+
+[transaction]
+rollback=%(workdir)s/rollback
+last_successful_id=%(workdir)s/txn_id
+lockfile=%(workdir)s/gratia-gold.lock
+
+[metrics]
+json=%(workdir)s/stats.json
+
+[logging]
+file=%(workdir)s/gratia-gold.log
+"""
+
+def parse_opts():
+    parser = optparse.OptionParser()
+    parser.add_option("--sizes", default="10000,100000",
+        help="Comma-separated dataset sizes, in records.")
+    parser.add_option("--database", default="sqlite",
+        help="sqlite (default) or mysql.")
+    parser.add_option("--mysql-host", default="localhost")
+    parser.add_option("--mysql-port", type="int", default=3306)
+    parser.add_option("--mysql-user", default="root")
+    parser.add_option("--mysql-passwd", default="")
+    parser.add_option("--mysql-db", default="gratia_bench",
+        help="Scratch database; its tables are dropped and recreated.")
+    parser.add_option("--backend", default="gcharge",
+        help="Gold backend: gcharge, goldsh, native or fake.  The native " \
+            "backend charges a mock Gold server run by the benchmark.")
+    parser.add_option("--workers", type="int", default=1,
+        help="[gold] workers for the gcharge backend.")
+    parser.add_option("--aggregate", default="database",
+        help="[gratia] aggregate mode: database or client.")
+    parser.add_option("--prefetch", type="int", default=0,
+        help="[gratia] prefetch: windows queried ahead while charging.")
+    parser.add_option("--latency", type="float", default=0,
+        help="Seconds each fake Gold request takes.")
+    parser.add_option("--sparsity", type="int", default=1,
+        help="Consecutive dbids differ by a random amount up to this.")
+    parser.add_option("--probes", type="int", default=1,
+        help="Number of probes the records are spread over; only the " \
+            "first is synchronized.")
+    parser.add_option("--users", type="int", default=50)
+    parser.add_option("--projects", type="int", default=10)
+    parser.add_option("--vos", type="int", default=5)
+    parser.add_option("--days", type="int", default=30,
+        help="Number of days the EndTimes are spread over.")
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("--results", default=os.path.join(BENCH_DIR,
+        "results.jsonl"), help="File the results are appended to.")
+    parser.add_option("--keep", default=False, action="store_true",
+        help="Keep the scratch directories.")
+    parser.add_option("--child", nargs=2, metavar="CONFIG RESULT",
+        help=optparse.SUPPRESS_HELP)
+    return parser.parse_args()
+
+def generate(opts, size):
+    """
+    Yield (JobUsageRecord row, JobUsageRecord_Meta row) pairs.
+    """
+    rand = random.Random(opts.seed)
+    start = datetime(2012, 1, 1)
+    span = opts.days * 86400
+    dbid = 0
+    for idx in xrange(size):
+        dbid += rand.randint(1, max(opts.sparsity, 1))
+        endtime = start + timedelta(0, span * idx / size)
+        wall = rand.randint(60, 86400)
+        jur = (dbid, "Batch", "vo%d" % rand.randint(1, opts.vos),
+            "user%d" % rand.randint(1, opts.users), None, wall,
+            wall * rand.random(), wall * rand.random() / 10,
+            1, 1, rand.choice([1, 1, 1, 2, 4, 8]),
+            endtime.strftime("%Y-%m-%d %H:%M:%S"), "worker.example.com",
+            "project%d" % rand.randint(1, opts.projects))
+        jurm = (dbid, "bench:probe%d" % rand.randint(0, opts.probes - 1))
+        yield jur, jurm
+
+def load(opts, size, workdir):
+    """
+    Load a synthetic dataset and return the [gratia] db setting to use.
+    """
+    if opts.database == "sqlite":
+        import sqlite3
+        path = os.path.join(workdir, "gratia.sqlite")
+        conn = sqlite3.connect(path)
+        placeholder = "?"
+    elif opts.database == "mysql":
+        import MySQLdb
+        conn = MySQLdb.connect(host=opts.mysql_host, port=opts.mysql_port,
+            user=opts.mysql_user, passwd=opts.mysql_passwd, db=opts.mysql_db)
+        path = opts.mysql_db
+        placeholder = "%s"
+    else:
+        raise Exception("Unknown database: %s" % opts.database)
+    curs = conn.cursor()
+    for table in ["JobUsageRecord", "JobUsageRecord_Meta"]:
+        try:
+            curs.execute("DROP TABLE %s" % table)
+        except Exception:
+            pass
+    for statement in SCHEMA:
+        curs.execute(statement)
+    jur_batch, jurm_batch = [], []
+    for jur, jurm in generate(opts, size):
+        jur_batch.append(jur)
+        jurm_batch.append(jurm)
+        if len(jur_batch) >= 10000:
+            _insert(curs, placeholder, jur_batch, jurm_batch)
+            jur_batch, jurm_batch = [], []
+    _insert(curs, placeholder, jur_batch, jurm_batch)
+    conn.commit()
+    conn.close()
+    return path
+
+def _insert(curs, placeholder, jur_batch, jurm_batch):
+    if not jur_batch:
+        return
+    curs.executemany(INSERT_JUR.replace("%s", placeholder), jur_batch)
+    curs.executemany(INSERT_JURM.replace("%s", placeholder), jurm_batch)
+
+def write_tools(opts, workdir):
+    """
+    Write the fake Gold tools into workdir/bin, which setup_env puts on
+    the PATH.
+    """
+    bindir = os.path.join(workdir, "bin")
+    os.mkdir(bindir)
+    sleep = ""
+    if opts.latency:
+        sleep = "sleep %f" % opts.latency
+    tools = {"gcharge": FAKE_GCHARGE % {'sleep': sleep},
+        "grefund": FAKE_GCHARGE % {'sleep': sleep},
+        "goldsh": FAKE_GOLDSH % {'python': sys.executable,
+            'latency': opts.latency}}
+    for name, contents in tools.items():
+        path = os.path.join(bindir, name)
+        fd = open(path, "w")
+        fd.write(contents)
+        fd.close()
+        os.chmod(path, 0755)
+
+def start_mock_gold(opts, workdir):
+    """
+    For the native backend, write the auth key and start a mock Gold
+    server; returns the server, or None for the other backends.
+    """
+    if opts.backend != "native":
+        return None
+    sys.path.insert(0, SRC_DIR)
+    from gratia_gold import gold_mock
+    os.mkdir(os.path.join(workdir, "etc"))
+    fd = open(os.path.join(workdir, "etc", "auth_key"), "w")
+    fd.write("bench\n")
+    fd.close()
+    server = gold_mock.MockGoldServer("bench", latency=opts.latency)
+    server.start()
+    return server
+
+def write_config(opts, workdir, db, port=7112):
+    mysql = ""
+    if opts.database == "mysql":
+        mysql = "host=%s\nport=%d\nuser=%s\npasswd=%s" % (opts.mysql_host,
+            opts.mysql_port, opts.mysql_user, opts.mysql_passwd)
+    path = os.path.join(workdir, "gratia-gold.cfg")
+    fd = open(path, "w")
+    fd.write(CONFIG % {'db': db, 'mysql': mysql, 'workdir': workdir,
+        'user': pwd.getpwuid(os.getuid()).pw_name, 'backend': opts.backend,
+        'workers': opts.workers, 'aggregate': opts.aggregate,
+        'prefetch': opts.prefetch, 'port': port})
+    fd.close()
+    return path
+
+def run_child(config, result, sqlite):
+    """
+    Run gratia_gold.main in this process and record its wall time and
+    peak RSS.
+    """
+    sys.path.insert(0, SRC_DIR)
+    if sqlite:
+        sys.path.insert(0, BENCH_DIR)
+        import sqlite_mysqldb
+        sqlite_mysqldb.install()
+    import gratia_gold.main
+    sys.argv = ["gratia-gold", "-c", config]
+    start = time.time()
+    retval = gratia_gold.main.main()
+    wall = time.time() - start
+    fd = open(result, "w")
+    simplejson.dump({'retval': retval, 'wall': wall,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss},
+        fd)
+    fd.close()
+    return retval
+
+def git_commit():
+    try:
+        child = subprocess.Popen(["git", "rev-parse", "--short", "HEAD"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=BENCH_DIR)
+        return child.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+# Settings which must match (along with the size) for two results to be
+# compared.
+SETTINGS = ["database", "backend", "workers", "aggregate", "prefetch",
+    "latency", "sparsity", "probes", "users", "projects", "vos", "days", "seed"]
+
+def run(opts, size):
+    workdir = tempfile.mkdtemp(prefix="gratia-bench-")
+    try:
+        load_start = time.time()
+        db = load(opts, size, workdir)
+        load_time = time.time() - load_start
+        write_tools(opts, workdir)
+        server = start_mock_gold(opts, workdir)
+        if server:
+            config = write_config(opts, workdir, db, server.server_address[1])
+        else:
+            config = write_config(opts, workdir, db)
+        result = os.path.join(workdir, "result.json")
+        args = [sys.executable, os.path.abspath(__file__), "--child", config,
+            result]
+        if opts.database == "sqlite":
+            args.append("--database=sqlite")
+        else:
+            args.append("--database=mysql")
+        retval = subprocess.call(args)
+        if server:
+            server.shutdown()
+            server.server_close()
+        if retval:
+            raise Exception("Benchmark run failed with status %i; see %s" % \
+                (retval, os.path.join(workdir, "gratia-gold.log")))
+        child = simplejson.load(open(result))
+        stats = simplejson.load(open(os.path.join(workdir, "stats.json")))
+    finally:
+        if not opts.keep:
+            shutil.rmtree(workdir)
+    record = {'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'commit': git_commit(), 'size': size, 'load_seconds': load_time,
+        'wall_seconds': child['wall'], 'peak_rss_kb': child['peak_rss_kb'],
+        'counters': stats['counters'], 'phases': {}}
+    for name in ["rows", "summaries", "charges"]:
+        record['%s_per_second' % name] = \
+            stats['counters'].get(name, 0) / child['wall']
+    for name, phase in stats['phases'].items():
+        record['phases'][name] = phase['total']
+    for name in SETTINGS:
+        record[name] = getattr(opts, name)
+    return record
+
+def previous_result(path, record):
+    previous = None
+    if not os.path.exists(path):
+        return None
+    for line in open(path):
+        try:
+            old = simplejson.loads(line)
+        except ValueError:
+            continue
+        for key in ["size"] + SETTINGS:
+            if old.get(key) != record[key]:
+                break
+        else:
+            previous = old
+    return previous
+
+def report(record, previous):
+    print "size=%(size)d: %(wall_seconds).2fs, %(rows_per_second).0f rows/s, " \
+        "%(summaries_per_second).0f summaries/s, %(charges_per_second).0f " \
+        "charges/s, peak RSS %(peak_rss_kb)d KB" % record
+    phases = record['phases'].items()
+    phases.sort(lambda a, b: cmp(b[1], a[1]))
+    for name, total in phases:
+        print "    %-12s %8.3fs" % (name, total)
+    if previous:
+        print "    vs. %s (%s): %.2fx rows/s" % (previous['timestamp'],
+            previous.get('commit'), record['rows_per_second'] / \
+            max(previous['rows_per_second'], 1e-9))
+
+def main():
+    opts, args = parse_opts()
+    if opts.child:
+        return run_child(opts.child[0], opts.child[1],
+            opts.database == "sqlite")
+    for size in [int(i) for i in opts.sizes.split(",")]:
+        record = run(opts, size)
+        previous = previous_result(opts.results, record)
+        report(record, previous)
+        fd = open(opts.results, "a")
+        fd.write(simplejson.dumps(record) + "\n")
+        fd.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
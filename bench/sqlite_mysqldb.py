@@ -0,0 +1,99 @@
+
+"""
+A minimal stand-in for the MySQLdb module, backed by SQLite.
+
+Only what gratia_gold uses is provided: connect(), cursors (including
+MySQLdb.cursors.SSCursor, which is just a regular cursor here), "%(name)s"
+parameters, the REGEXP operator, and DATE/DATETIME values come back as
+datetime objects.  It lets the benchmark run the sync without a MySQL
+server; timings of the queries themselves are not representative of MySQL.
+"""
+
+import re
+import sys
+import types
+import sqlite3
+from datetime import datetime
+# datetime.strptime imports this on first use, which is not thread-safe;
+# rows are fetched from the prefetching threads.
+import _strptime
+
+_param_re = re.compile(r"%\((\w+)\)s")
+_datetime_re = re.compile(r"^\d{4}-\d\d-\d\d( \d\d:\d\d:\d\d)?$")
+
+class Error(Exception):
+    pass
+
+class OperationalError(Error):
+    pass
+
+def _regexp(pattern, value):
+    if value is None:
+        return False
+    return re.search(pattern, value) is not None
+
+def _convert(row):
+    result = []
+    for value in row:
+        if isinstance(value, basestring) and _datetime_re.match(value):
+            if len(value) == 10:
+                value = datetime.strptime(value, "%Y-%m-%d")
+            else:
+                value = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+        result.append(value)
+    return tuple(result)
+
+class Cursor(object):
+
+    def __init__(self, curs):
+        self.curs = curs
+
+    def execute(self, query, params=None):
+        try:
+            self.curs.execute(_param_re.sub(r":\1", query), params or {})
+        except sqlite3.OperationalError, oe:
+            raise OperationalError(0, str(oe))
+
+    def fetchone(self):
+        row = self.curs.fetchone()
+        if row is None:
+            return None
+        return _convert(row)
+
+    def fetchmany(self, size):
+        return [_convert(row) for row in self.curs.fetchmany(size)]
+
+    def fetchall(self):
+        return [_convert(row) for row in self.curs.fetchall()]
+
+    def close(self):
+        self.curs.close()
+
+class Connection(object):
+
+    def __init__(self, path):
+        # Like MySQLdb, let a connection be handed between threads (as the
+        # prefetching sync does), as long as it is not used concurrently.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.create_function("REGEXP", 2, _regexp)
+
+    def cursor(self, cursorclass=None):
+        return Cursor(self.conn.cursor())
+
+    def close(self):
+        self.conn.close()
+
+def connect(db=None, **kw):
+    return Connection(db)
+
+def install():
+    """
+    Install this module as MySQLdb (and MySQLdb.cursors) in sys.modules.
+    """
+    module = sys.modules[__name__]
+    cursors = types.ModuleType("MySQLdb.cursors")
+    cursors.SSCursor = Cursor
+    cursors.Cursor = Cursor
+    module.cursors = cursors
+    sys.modules["MySQLdb"] = module
+    sys.modules["MySQLdb.cursors"] = cursors
@@ -11,7 +11,7 @@ setup(name="gratia-gold",
       package_dir={"": "src"},
       packages=["gratia_gold"],
 
-      scripts = ['src/gratia-gold'],
+      scripts = ['src/gratia-gold', 'src/gratia-gold-reconcile'],
 
       data_files=[("/etc/cron.d", ["config/gratia-gold.cron"]),
             ("/etc/", ["config/gratia-gold.cfg"]),
@@ -6,20 +6,45 @@ Takes a summarized Gratia job and either charges or refunds it.
 """
 
 import os
+import re
 import sys
 import pwd
+import hmac
+import time
 import errno
+import fcntl
+import base64
+import random
+import select
+import socket
 import logging
+import subprocess
+import ConfigParser
 from datetime import datetime, timedelta
-from dateutil import parser
+from xml.sax import saxutils
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+import metrics
+import profiling
 
 log = logging.getLogger("gratia_gold.gold")
-logname = None
+backend = None
+
+# The status of a charge Gold may or may not have made: the request was
+# sent, but no answer came back.  Real statuses are 0 or positive.
+UNKNOWN = -1
 
 def setup_env(cp):
-    global logname
+    # The fake backend runs in-process and does not need a Gold install.
+    # The backend is not made here: a process about to fork leaves that
+    # to its children.
+    if _get_option(cp, "backend", "gcharge") == "fake":
+        return
     gold_home = cp.get("gold", "home")
-    logname = cp.get("logging", "file")
     if not os.path.exists(gold_home):
         raise Exception("GOLD_HOME %s does not exist!" % gold_home)
     os.environ['GOLD_HOME'] = gold_home
@@ -42,6 +67,22 @@ def drop_privs(cp):
         log.warn("Unable to drop privileges to %s - continuing" % gold_user)
 
 
+# Conversions done for every job are memoized: a window only holds a handful
+# of distinct days, processor counts and users, so each distinct value is
+# converted once.  A cache is emptied when it reaches MEMO_SIZE entries.
+MEMO_SIZE = 10000
+_digits = {}
+_start_times = {}
+_arg_heads = {}
+_arg_tails = {}
+
+def _remember(cache, key, value):
+    if len(cache) >= MEMO_SIZE:
+        cache.clear()
+    cache[key] = value
+    return value
+
+
 def get_digits_from_a_string(string1):
     '''
     The number of processors or node_count sometimes shows 1L or None.
@@ -51,6 +92,15 @@ def get_digits_from_a_string(string1):
     None will return "1". 
     123L will return "123".
     '''
+    try:
+        return _digits[string1]
+    except KeyError:
+        return _remember(_digits, string1, _get_digits(string1))
+    except TypeError:
+        return _get_digits(string1)
+
+
+def _get_digits(string1):
     if string1 is None:
         return "1"
     if (type(string1) is int) or (type(string1) is long):
@@ -66,6 +116,109 @@ def get_digits_from_a_string(string1):
     return numberofstring1
 
 
+def job_charge(charge, wall_duration):
+    '''
+    Return what a summarized job is charged, given its Charge and
+    WallDuration: its Charge, or else its WallDuration in whole seconds, or
+    else an hour.
+    '''
+    if charge is not None:
+        return charge
+    if wall_duration is None:
+        return "3600" # default 3600 seconds, which is 1 hour
+    return str(int(wall_duration)) # wall_duration is in seconds
+
+
+def normalize_job(job):
+    '''
+    Fill in the defaults gcharge needs for a summarized job.
+
+    The processors, node_count, charge and endtime fields are rewritten in
+    place as strings.  Returns the (start time, end time) strings to use for
+    the StartTime, QueueTime and EndTime extension properties.
+    '''
+    job['processors'] = get_digits_from_a_string(job['processors'])
+    job['node_count'] = get_digits_from_a_string(job['node_count'])
+
+    job['charge'] = job_charge(job['charge'], job['wall_duration'])
+
+    # if there is no endtime, force the end time to be now
+    if job['endtime'] is None:
+        today = datetime.today()
+        dt = datetime(today.year, today.month, today.day, today.hour, today.minute, today.second)
+        job['endtime'] = str(dt)
+    end_time = job['endtime']
+    try:
+        return _start_times[end_time], end_time
+    except KeyError:
+        pass
+    from dateutil import parser
+    end_dt = parser.parse(end_time)
+
+    # we need a starttime for amiegold - let's just put it 24 hours before the endtime
+    start_dt = end_dt - timedelta(1,0)
+    return _remember(_start_times, end_time, str(start_dt)), end_time
+
+
+def gcharge_args(job):
+    '''
+    Build the gcharge command line for a job.
+
+    The leading arguments (user, project, machine, queue, processors and
+    nodes) and the trailing time extensions are built once per distinct
+    combination of values and reused; only the job id and charge are
+    filled in per job.
+    '''
+    start_time, end_time = normalize_job(job)
+    key = (job['user'], job['project_name'], job['machine_name'],
+        job['queue'], job['processors'], job['node_count'])
+    head = _arg_heads.get(key)
+    if head is None:
+        head = _remember(_arg_heads, key, _gcharge_head(job))
+    tail = _arg_tails.get(end_time)
+    if tail is None:
+        tail = _remember(_arg_tails, end_time, _gcharge_tail(start_time,
+            end_time))
+
+    args = list(head)
+    job_id = job['gold_job_id'] or job['dbid']
+    if job['incremental']:
+        args += ["--incremental", "-J", str(job_id)]
+    elif job_id:
+        args += ["-J", str(job_id)]
+
+    args += ["-t", job['charge']]
+
+    # walltime is the same as the charge
+    args += ["-X", "WallDuration=" + str(job['charge'])]
+    args += tail
+    return args
+
+
+def _gcharge_head(job):
+    args = ["gcharge"]
+    if job['user']:
+        args += ["-u", job['user']]
+    if job['project_name']:
+        args += ["-p", job['project_name']]
+    if job['machine_name']:
+        args += ["-m", job['machine_name']]
+    if job['queue']:
+        args += ["-C", job['queue']]
+    args += ["-P", job['processors']]
+    args += ["-N", job['node_count']]
+    return tuple(args)
+
+
+def _gcharge_tail(start_time, end_time):
+    args = ["-X", "EndTime=\""+ end_time +"\""]
+    args += ["-X", "StartTime=\""+ start_time +"\""]
+
+    # queue time is also required, but does not make much sense for summary jobs
+    args += ["-X", "QueueTime=\""+ start_time +"\""]
+    return tuple(args)
+
+
 def call_gcharge(job):
     '''
     job has the following information 
@@ -83,103 +236,930 @@ def call_gcharge(job):
     [--debug] [-?, --help] [--man] [--quiet] [-v, --verbose] [-V, --version]
     [[-j] gold_job_id] [-q quote_id] [-r reservation_id] {-J job_id}
     '''
-    args = ["gcharge"]
+    args = gcharge_args(job)
+    pid, rfd = _spawn(args)
+    return _wait(pid, rfd, args, _charge_id(job))
+
+
+def _spawn(args):
+    '''
+    Fork and exec a Gold command line, with its stdout and stderr going to
+    a pipe.  Returns the child's pid and the read end of the pipe.
+    '''
+    rfd, wfd = os.pipe()
+    # Keep the read end out of the Gold commands started later.
+    fcntl.fcntl(rfd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    pid = os.fork()
+    if pid == 0:
+        profiling.detach()
+        try:
+            os.close(rfd)
+            os.dup2(wfd, 1)
+            os.dup2(wfd, 2)
+            os.close(wfd)
+            os.execvp(args[0], args)
+        except Exception, e:
+            # There is no log writer thread in this process; tell the parent
+            # through the pipe.
+            os.write(2, "os.execvp of %s failed: %s\n" % (args[0], str(e)))
+        os._exit(1)
+    os.close(wfd)
+    return pid, rfd
+
+
+def _charge_id(job):
+    '''
+    The Gold job id a charge of job is made to.
+    '''
+    return job['gold_job_id'] or job['dbid']
+
+
+def _log_status(args, status, output, job_id=None):
+    '''
+    Log the outcome of a Gold command, with its captured output, as one
+    record.  The record also carries them as attributes (gold_command,
+    gold_status, gold_output and job_id), for handlers that want them.
+    '''
+    extra = {'gold_command': args, 'gold_status': status,
+        'gold_output': output, 'job_id': job_id}
+    if output:
+        output = "\n" + output.rstrip("\n")
+    if status == 0:
+        log.debug("%s %s\nCommand succeeded ...%s", args[0], args, output,
+            extra=extra)
+    else:
+        log.error("%s %s\nCommand failed; Error code is %s%s", args[0], args,
+            status, output, extra=extra)
+
+
+def _wait(pid, rfd, args, job_id=None):
+    '''
+    Wait for a single child started by _spawn and return its exit status.
+    '''
+    output = _read_all(rfd)
+    status = 0
+    pid2 = 0
+    while pid != pid2:
+        pid2, status = os.waitpid(pid, 0)
+    _log_status(args, status, output, job_id)
+    return status
+
+
+def _read_all(rfd):
+    chunks = []
+    try:
+        while True:
+            chunk = os.read(rfd, 4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(rfd)
+    return "".join(chunks)
+
+
+def pool_gcharge(jobs, workers, before_charge=None, after_charge=None):
+    '''
+    Charge jobs with up to `workers` gcharge processes in flight at once.
+
+    jobs may be any iterable; it is consumed as workers become free.
+    before_charge(job) is called right before each job's gcharge is started;
+    this is where the caller journals the job.  The children's output is
+    read as it comes; once a child has closed its output it is reaped, and
+    after_charge(job, status) is called, so jobs finish in whatever order
+    their children exit.  Returns a list of statuses (0 for success) in the
+    same order as jobs, regardless of completion order.
+    '''
+    statuses = []
+    running = {}
+    jobs = iter(jobs)
+    exhausted = False
+    while not exhausted or running:
+        while not exhausted and len(running) < workers:
+            try:
+                job = jobs.next()
+            except StopIteration:
+                exhausted = True
+                break
+            if before_charge:
+                before_charge(job)
+            args = gcharge_args(job)
+            pid, rfd = _spawn(args)
+            running[rfd] = (pid, len(statuses), job, args, time.time(), [])
+            statuses.append(None)
+        if not running:
+            break
+        try:
+            readable = select.select(running.keys(), [], [])[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for rfd in readable:
+            chunk = os.read(rfd, 4096)
+            if chunk:
+                running[rfd][5].append(chunk)
+                continue
+            os.close(rfd)
+            pid, idx, job, args, started, chunks = running.pop(rfd)
+            status = os.waitpid(pid, 0)[1]
+            metrics.observe("charge", time.time() - started)
+            _log_status(args, status, "".join(chunks), _charge_id(job))
+            statuses[idx] = status
+            if after_charge:
+                after_charge(job, status)
+    return statuses
+
+
+def _goldsh_quote(value):
+    '''
+    Quote a value for a goldsh argument: a "Job.Name=Value" attribute or a
+    "Name:=Value" option.
+    '''
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return '"%s"' % value
+
+
+def charge_attributes(job):
+    '''
+    Return the Job attributes of the Job Charge request for a job, as a list
+    of (name, value) pairs.
+
+    gcharge is itself a thin wrapper around the Job Charge request; each
+    -X extension becomes a Job attribute, and -t becomes the Duration.
+    '''
+    start_time, end_time = normalize_job(job)
+    attrs = []
+    job_id = job['gold_job_id'] or job['dbid']
+    if job_id:
+        attrs.append(("JobId", job_id))
     if job['user']:
-        args += ["-u", job['user']]
+        attrs.append(("User", job['user']))
     if job['project_name']:
-        args += ["-p", job['project_name']]
+        attrs.append(("Project", job['project_name']))
     if job['machine_name']:
-        args += ["-m", job['machine_name']]
+        attrs.append(("Machine", job['machine_name']))
     if job['queue']:
-        args += ["-C", job['queue']]
+        attrs.append(("QueueName", job['queue']))
+    attrs.append(("Processors", job['processors']))
+    attrs.append(("Nodes", job['node_count']))
+    attrs.append(("WallDuration", job['charge']))
+    attrs.append(("EndTime", end_time))
+    attrs.append(("StartTime", start_time))
+    attrs.append(("QueueTime", start_time))
+    return attrs
 
-    originalnumprocessors = job['processors']
-    job['processors'] = get_digits_from_a_string(originalnumprocessors)
-    args += ["-P", job['processors']]
-    
-    originalnodecount = job['node_count']
-    job['node_count'] = get_digits_from_a_string(originalnodecount)
-    args += ["-N", job['node_count']]
 
-    if job['dbid']:
-        args += ["-J", str(job['dbid'])]
-    
-    if job['charge'] is None:
-        if job['wall_duration'] is None:
-            job['charge'] = "3600" # default 3600 seconds, which is 1 hour
-        else:
-            job['charge'] = str(int(job['wall_duration'])) # job['wall_duration'] is in seconds
-    args += ["-t", job['charge']]
-    
-    # walltime is the same as the charge
-    args += ["-X", "WallDuration=" + str(job['charge'])] 
+def goldsh_charge_command(job):
+    '''
+    Build the goldsh command equivalent to the gcharge invocation for a job.
+    '''
+    command = ["Job", "Charge"]
+    for name, value in charge_attributes(job):
+        command.append("Job.%s=%s" % (name, _goldsh_quote(value)))
+    command.append("Duration:=%s" % _goldsh_quote(job['charge']))
+    if job['incremental']:
+        command.append("Incremental:=True")
+    return " ".join(command)
 
-    # if there is no endtime, force the end time to be now
-    if job['endtime'] is None:
-        today = datetime.today()
-        dt = datetime(today.year, today.month, today.day, today.hour, today.minute, today.second)
-        job['endtime'] = str(dt)
-    end_dt = parser.parse(job['endtime'])
-    args += ["-X", "EndTime=\""+ job['endtime']+"\""]
 
-    # we need a starttime for amiegold - let's just put it 24 hours before the endtime
-    start_dt = end_dt - timedelta(1,0)
-    args += ["-X", "StartTime=\""+ str(start_dt) +"\""]
+# The result goldsh prints for each Job Charge command of a script.
+_result_re = re.compile(r"^(Successfully charged|Failed to charge)\b.*?"
+    r"\bjob\s+([0-9]+)")
 
-    # queue time is also required, but does not make much sense for summary jobs
-    args += ["-X", "QueueTime=\""+ str(start_dt) +"\""]
+def batch_gcharge(jobs):
+    '''
+    Charge a list of jobs with a single goldsh process.
 
-    pid = os.fork()
-    fd = open(logname, 'a')
-    fdfileno = fd.fileno()
-    if pid == 0:
-        execvpstatus = 0
+    The Job Charge commands are written to goldsh's stdin as a script, so
+    the Perl interpreter and the Gold client are only started once per
+    window instead of once per job.  For each command, goldsh prints a
+    result line naming the job: "Successfully charged ... job 1234 ..." or
+    "Failed to charge ... job 1234 ...".  Other lines are ignored.  goldsh
+    exits with status 0 only if every command succeeded.
+
+    A job with no result line, after goldsh exited with an error, may or may
+    not have been charged (goldsh may have died partway); it gets the
+    UNKNOWN status.  Output which does not match the exit status - a job
+    with no result line although goldsh succeeded, a result for a job not
+    in the script, or a failure exit with no failed command - raises an
+    exception: the charges made cannot be told apart, so the run stops, and
+    the next one refunds the journaled window.
+
+    Returns a list of statuses (0 for success) in the same order as jobs.
+    '''
+    if not jobs:
+        return []
+    script = []
+    for job in jobs:
+        script.append(goldsh_charge_command(job))
+    script.append("")
+
+    started = time.time()
+    try:
         try:
-            os.dup2(fdfileno, 1)
-            os.dup2(fdfileno, 2)
-            execvpstatus = os.execvp("gcharge", args)
-        except:
-            log.error("os.execvp failed; error code is "+str(execvpstatus))
-            os._exit(1)
-    status = 0
-    pid2 = 0
-    while pid != pid2:
-        pid2, status = os.wait()
-    if status == 0:
-        log.debug("gcharge " + str(args)+"\nJob charge succeed ...")
+            child = subprocess.Popen(["goldsh"], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                close_fds=True)
+            output, errors = child.communicate("\n".join(script))
+        except OSError, oe:
+            log.error("Unable to run goldsh: %s" % str(oe))
+            return [1] * len(jobs)
+    finally:
+        metrics.observe("charge", time.time() - started)
+
+    extra = {'gold_command': ["goldsh"], 'gold_status': child.returncode,
+        'gold_output': output + errors, 'job_id': None}
+    ids = {}
+    for job in jobs:
+        ids[str(_charge_id(job))] = True
+    results = {}
+    unexpected = []
+    for line in (output + errors).splitlines():
+        m = _result_re.search(line.strip())
+        if not m:
+            continue
+        if m.group(2) not in ids:
+            unexpected.append(m.group(2))
+            continue
+        status = 0
+        if m.group(1) != "Successfully charged":
+            status = 1
+        results[m.group(2)] = status
+    statuses = []
+    for job in jobs:
+        statuses.append(results.get(str(_charge_id(job)), UNKNOWN))
+    failed = len([i for i in statuses if i])
+    problem = None
+    if unexpected:
+        problem = "results for jobs %s, which were not charged" % \
+            ", ".join(unexpected)
+    elif child.returncode == 0 and failed:
+        problem = "no result for %i of %i jobs, although it exited with " \
+            "status 0" % (statuses.count(UNKNOWN), len(jobs))
+    elif child.returncode != 0 and not failed:
+        problem = "exit code %s, although every job was charged" % \
+            child.returncode
+    if problem:
+        log.error("Unable to parse the output of goldsh: %s\n%s", problem,
+            (output + errors).rstrip("\n"), extra=extra)
+        raise Exception("Unable to parse the output of goldsh: %s" % problem)
+    if failed:
+        log.error("goldsh failed to charge %i of %i jobs (%i with no "
+            "result); exit code is %s\n%s", failed, len(jobs),
+            statuses.count(UNKNOWN), child.returncode,
+            (output + errors).rstrip("\n"), extra=extra)
     else:
-        log.error("gcharge " + str(args)+"\nJob charging failed; Error code is "+str(status))
+        log.debug("goldsh charged %i jobs\n%s", len(jobs),
+            (output + errors).rstrip("\n"), extra=extra)
+    return statuses
 
-    return status
 
+# The Gold server's port, and the path its SSSRMAP messages are posted to.
+GOLD_PORT = 7112
+SSSRMAP_PATH = "/SSSRMAP3"
 
-def refund(cp, job):
+# The Code of the failure reported for a request Gold did not answer.
+NO_RESPONSE_CODE = "999"
+
+# A response Body, for the Status Value, Code and Message and the Count.
+RESPONSE = '<Body><Response><Status><Value>%s</Value><Code>%s</Code>' \
+    '<Message>%s</Message></Status><Count>%i</Count></Response></Body>'
+
+def _xml(value):
+    return saxutils.escape(str(value), {'"': "&quot;"})
+
+
+def gold_request(actor, action, obj, data=None, options=None):
     '''
-    refund a job by its job id
+    Build the Body of a Gold request: `action` on `obj`, with a data element
+    of the (name, value) pairs in data, and the (name, value) pairs in
+    options.
     '''
-    args = ["grefund"]
-    args += ["-J", job["dbid"]]
-    log.debug("grefund "+ str(args))
-    pid = os.fork()
-    status = 0
-    fd = open(logname, 'a')
-    fdfileno = fd.fileno()
-    if pid == 0:
-        execvpstatus = 0
-        try:
-            os.dup2(fdfileno, 1)
-            os.dup2(fdfileno, 2)
-            execvpstatus = os.execvp("grefund", args)
-        except:
-            log.error("os.execvp failed; erro code is " + str(execvpstatus))
-            os._exit(1)
-    pid2 = 0
-    while pid != pid2:
-        pid2, status = os.wait()
-    if status == 0:
-        log.debug("grefund " + str(args) + "\nJob refund succeed ... ")
+    parts = ['<Body><Request action="%s" actor="%s" object="%s">' % \
+        (_xml(action), _xml(actor), _xml(obj))]
+    if data:
+        parts.append("<Data><%s>" % obj)
+        for name, value in data:
+            parts.append("<%s>%s</%s>" % (name, _xml(value), name))
+        parts.append("</%s></Data>" % obj)
+    for name, value in options or []:
+        parts.append('<Option name="%s">%s</Option>' % (_xml(name),
+            _xml(value)))
+    parts.append("</Request></Body>")
+    return "".join(parts)
+
+
+def query_request(actor, obj, select, where=None):
+    '''
+    Build the Body of a Gold Query of `obj`.  select is a list of
+    (name, op) pairs, where op is None or an aggregate such as "Sum" or
+    "GroupBy"; where is a list of (name, op, value) conditions, all of
+    which must hold, with op one of "EQ", "GE", "LT", ...
+    '''
+    parts = ['<Body><Request action="Query" actor="%s" object="%s">' % \
+        (_xml(actor), _xml(obj))]
+    for name, op in select:
+        if op:
+            parts.append('<Select name="%s" op="%s"></Select>' % (_xml(name),
+                _xml(op)))
+        else:
+            parts.append('<Select name="%s"></Select>' % _xml(name))
+    for name, op, value in where or []:
+        parts.append('<Where name="%s" op="%s">%s</Where>' % (_xml(name),
+            _xml(op), _xml(value)))
+    parts.append("</Request></Body>")
+    return "".join(parts)
+
+
+def gold_signature(body, key):
+    '''
+    Return the (DigestValue, SignatureValue) of a message body: the SHA1
+    digest of the body, and the HMAC-SHA1 of that digest under the shared
+    secret key, both base64-encoded.
+    '''
+    digest = base64.b64encode(sha1(body).digest())
+    signature = base64.b64encode(hmac.new(key, digest, sha1).digest())
+    return digest, signature
+
+
+def gold_envelope(body, actor, key):
+    '''
+    Wrap a message body in a signed SSSRMAP envelope.
+    '''
+    digest, signature = gold_signature(body, key)
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<Envelope>%s' \
+        '<Signature><DigestValue>%s</DigestValue><SignatureValue>%s' \
+        '</SignatureValue><SecurityToken type="Symmetric" name="%s">' \
+        '</SecurityToken></Signature></Envelope>' % (body, digest,
+        signature, _xml(actor))
+
+
+def _element_text(parent, name):
+    nodes = parent.getElementsByTagName(name)
+    if not nodes:
+        return None
+    return "".join([i.data for i in nodes[0].childNodes \
+        if i.nodeType == i.TEXT_NODE])
+
+
+def parse_gold_response(message):
+    '''
+    Return the (success, code, message) of a Gold response envelope.
+    '''
+    from xml.dom import minidom
+    try:
+        dom = minidom.parseString(message)
+    except Exception, e:
+        return False, None, "Unparseable response: %s" % str(e)
+    try:
+        status = dom.getElementsByTagName("Status")
+        if not status:
+            return False, None, "Response has no status"
+        return _element_text(status[0], "Value") == "Success", \
+            _element_text(status[0], "Code"), \
+            _element_text(status[0], "Message")
+    finally:
+        dom.unlink()
+
+
+def parse_gold_data(message, obj="Job"):
+    '''
+    Return the (success, code, message, rows) of a Gold response envelope,
+    where rows holds a dictionary of the fields of each `obj` element of
+    the response's Data.
+    '''
+    success, code, text = parse_gold_response(message)
+    if not success:
+        return success, code, text, []
+    from xml.dom import minidom
+    dom = minidom.parseString(message)
+    try:
+        rows = []
+        for data in dom.getElementsByTagName("Data"):
+            for element in data.getElementsByTagName(obj):
+                row = {}
+                for field in element.childNodes:
+                    if field.nodeType == field.ELEMENT_NODE:
+                        row[field.tagName] = "".join([i.data for i in \
+                            field.childNodes if i.nodeType == i.TEXT_NODE])
+                rows.append(row)
+        return success, code, text, rows
+    finally:
+        dom.unlink()
+
+
+def read_http_message(fd):
+    '''
+    Read one HTTP message (a request or a response) from the file object
+    fd, returning its start line, headers (with lowercase names) and body.
+    Raises EOFError if the connection is closed before the start line.
+    '''
+    start = fd.readline()
+    if not start:
+        raise EOFError("Connection closed")
+    headers = {}
+    while True:
+        line = fd.readline()
+        if not line:
+            raise EOFError("Connection closed in headers")
+        if line in ("\r\n", "\n"):
+            break
+        name, value = line.split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int(fd.readline().split(";")[0], 16)
+            if not size:
+                while fd.readline() not in ("\r\n", "\n", ""):
+                    pass
+                break
+            chunks.append(fd.read(size))
+            fd.readline()
+        body = "".join(chunks)
     else:
-        log.error("grefund " + str(args) + "\nJob refund failed; Error code is "+str(status))
+        body = fd.read(int(headers.get("content-length", 0)))
+    return start.strip(), headers, body
+
+
+class GoldClient(object):
+    '''
+    A client for the Gold server's SSSRMAP protocol: signed XML messages
+    posted over HTTP/1.1.
+
+    One connection is kept open across requests.  send() pipelines a list
+    of requests, writing them all before reading the responses, so a batch
+    costs a single round trip.  If a connection which was kept from an
+    earlier batch turns out to have been closed by the server before it
+    answered anything, the batch is retried once on a new connection.
+    '''
+
+    def __init__(self, host, port, actor, key, timeout=60):
+        self.host = host
+        self.port = port
+        self.actor = actor
+        self.key = key
+        self.timeout = timeout
+        self.sock = None
+        self.fd = None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect((self.host, self.port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error:
+            sock.close()
+            raise
+        self.sock = sock
+        self.fd = sock.makefile("rb")
+        log.debug("Connected to Gold at %s:%i" % (self.host, self.port))
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.fd.close()
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self.fd = None
+
+    def _post(self, body):
+        message = gold_envelope(body, self.actor, self.key)
+        return "POST %s HTTP/1.1\r\nHost: %s:%i\r\n" \
+            "Content-Type: text/xml; charset=\"utf-8\"\r\n" \
+            "Content-Length: %i\r\n\r\n%s" % (SSSRMAP_PATH, self.host,
+            self.port, len(message), message)
+
+    def send(self, bodies, parse=parse_gold_response):
+        '''
+        Send the request bodies and return one (success, code, message) per
+        request, in order, or whatever parse() returns for each response
+        envelope.  Requests left unanswered because the connection failed
+        are reported as failures.
+        '''
+        if not bodies:
+            return []
+        data = "".join([self._post(i) for i in bodies])
+        results = []
+        for attempt in range(2):
+            reused = self.sock is not None
+            try:
+                if self.sock is None:
+                    self.connect()
+                self.sock.sendall(data)
+                while len(results) < len(bodies):
+                    start, headers, body = read_http_message(self.fd)
+                    results.append(parse(body))
+                    if headers.get("connection", "").lower() == "close":
+                        self.close()
+                        break
+                break
+            except (socket.error, EOFError, ValueError), e:
+                self.close()
+                if reused and not results and not attempt:
+                    log.debug("Gold connection was closed (%s); " \
+                        "reconnecting" % str(e))
+                    continue
+                log.error("Lost connection to Gold at %s:%i: %s" % \
+                    (self.host, self.port, str(e)))
+                break
+        while len(results) < len(bodies):
+            results.append(parse(gold_envelope(RESPONSE % ("Failure",
+                NO_RESPONSE_CODE, "No response from Gold", 0), "", "")))
+        return results
 
+
+def charge_request(actor, job):
+    '''
+    Build the Job Charge request body for a job.
+    '''
+    attrs = charge_attributes(job)
+    options = [("Duration", job['charge'])]
+    if job['incremental']:
+        options.append(("Incremental", "True"))
+    return gold_request(actor, "Charge", "Job", attrs, options)
+
+
+def refund_request(actor, job):
+    '''
+    Build the Job Refund request body for a journaled job.
+    '''
+    job_id = job.get("gold_job_id") or job["dbid"]
+    return gold_request(actor, "Refund", "Job", options=[("JobId", job_id)])
+
+
+def restored_job(job):
+    '''
+    For a journaled incremental charge, return the charge that restores its
+    Gold job to the totals it had before; see summaries.ChargedIndex.
+
+    grefund can only refund a Gold job as a whole, so rolling back an
+    incremental charge refunds the job and then charges the previous totals
+    back to it.  Returns None for a job that was not an incremental charge.
+    '''
+    previous = job.get('previous')
+    if not job.get('incremental') or not previous:
+        return None
+    restore = dict(job)
+    restore.update(previous)
+    restore['previous'] = None
+    return restore
+
+
+def call_grefund(job):
+    '''
+    refund a job by its job id
+    '''
+    job_id = job.get("gold_job_id") or job["dbid"]
+    args = ["grefund"]
+    args += ["-J", str(job_id)]
+    log.debug("grefund %s", args)
+    pid, rfd = _spawn(args)
+    status = _wait(pid, rfd, args, job_id)
+    restore = restored_job(job)
+    if status == 0 and restore:
+        status = call_gcharge(restore)
     return status
 
+
+class Backend(object):
+    """
+    Interface for submitting charges and refunds to Gold.
+
+    charge() takes an iterable of jobs and returns a list of statuses (0 for
+    success) in the same order.  If given, before_charge(job) must be called
+    for each job before its charge is submitted, so the caller can journal
+    it, and after_charge(job, status) as soon as its status is known.
+    refund() takes a single job and returns its status.
+    """
+
+    name = None
+
+    def charge(self, jobs, before_charge=None, after_charge=None):
+        """
+        Charge jobs, in order, returning one status per job: 0 on success,
+        UNKNOWN if Gold did not answer (the charge may have been made), or
+        any other value if it failed.  Jobs with incremental set are added
+        to their gold_job_id; the others create Gold job gold_job_id, or
+        dbid if that is not set.
+        """
+        raise NotImplementedError("%s does not implement charge()" % \
+            self.__class__.__name__)
+
+    def refund(self, job):
+        """
+        Refund the Gold job of a journaled charge, returning its status.
+        An incremental charge is rolled back by then charging the job's
+        previous totals back to it (see restored_job).
+        """
+        raise NotImplementedError("%s does not implement refund()" % \
+            self.__class__.__name__)
+
+    def close(self):
+        """
+        Release the backend's processes and connections, if any.
+        """
+        pass
+
+
+class GchargeBackend(Backend):
+    """
+    Charge by running one gcharge per job, up to `workers` at a time.
+    """
+
+    name = "gcharge"
+
+    def __init__(self, workers=1):
+        if workers < 1:
+            raise Exception("[gold] workers must be at least 1")
+        self.workers = workers
+
+    def charge(self, jobs, before_charge=None, after_charge=None):
+        return pool_gcharge(jobs, self.workers, before_charge, after_charge)
+
+    def refund(self, job):
+        return call_grefund(job)
+
+
+class BatchBackend(Backend):
+    """
+    A backend which submits charges `batch_size` jobs at a time, through
+    charge_batch().
+    """
+
+    def __init__(self, batch_size):
+        if batch_size < 1:
+            raise Exception("[gold] batch_size must be at least 1")
+        self.batch_size = batch_size
+
+    def charge_batch(self, batch):
+        """
+        Submit the charges of a list of jobs, whose before_charge has been
+        called, returning one status per job, as charge() does.
+        """
+        raise NotImplementedError("%s does not implement charge_batch()" % \
+            self.__class__.__name__)
+
+    def charge(self, jobs, before_charge=None, after_charge=None):
+        statuses = []
+        batch = []
+        for job in jobs:
+            if before_charge:
+                before_charge(job)
+            batch.append(job)
+            if len(batch) >= self.batch_size:
+                statuses += self._charge_batch(batch, after_charge)
+                batch = []
+        statuses += self._charge_batch(batch, after_charge)
+        return statuses
+
+    def _charge_batch(self, batch, after_charge):
+        if not batch:
+            return []
+        statuses = self.charge_batch(batch)
+        if after_charge:
+            for job, status in zip(batch, statuses):
+                after_charge(job, status)
+        return statuses
+
+
+class GoldshBackend(BatchBackend):
+    """
+    Charge jobs through goldsh, one process per `batch_size` jobs.
+    """
+
+    name = "goldsh"
+
+    def __init__(self, batch_size=1000):
+        BatchBackend.__init__(self, batch_size)
+
+    def charge_batch(self, batch):
+        return batch_gcharge(batch)
+
+    def refund(self, job):
+        return call_grefund(job)
+
+
+class NativeBackend(BatchBackend):
+    """
+    Charge and refund by talking to the Gold server directly (see
+    GoldClient), with no Gold client processes.  Up to `batch_size` charges
+    are pipelined per round trip over one persistent connection.
+    """
+
+    name = "native"
+
+    def __init__(self, client, batch_size=100):
+        BatchBackend.__init__(self, batch_size)
+        self.client = client
+
+    def charge_batch(self, batch):
+        started = time.time()
+        results = self.client.send([charge_request(self.client.actor, job) \
+            for job in batch])
+        metrics.observe("charge", time.time() - started)
+        statuses = []
+        for job, (success, code, message) in zip(batch, results):
+            if success:
+                statuses.append(0)
+            elif code == NO_RESPONSE_CODE:
+                log.error("No response from Gold to the charge of job %s" % \
+                    str(job['dbid']))
+                statuses.append(UNKNOWN)
+            else:
+                log.error("Gold failed to charge job %s: %s (code %s)" % \
+                    (str(job['dbid']), message, code))
+                statuses.append(1)
+        return statuses
+
+    def refund(self, job):
+        success, code, message = self.client.send([refund_request(
+            self.client.actor, job)])[0]
+        if not success:
+            log.error("Gold failed to refund job %s: %s (code %s)" % \
+                (str(job.get("gold_job_id") or job["dbid"]), message, code))
+            return 1
+        restore = restored_job(job)
+        if restore:
+            return self.charge_batch([restore])[0]
+        return 0
+
+    def close(self):
+        self.client.close()
+
+
+class FakeBackend(Backend):
+    """
+    An in-process stand-in for Gold, for benchmarking the sync pipeline
+    without a Gold installation.
+
+    Charges are recorded in memory, or in the SQLite database `database` if
+    one is given.  Each request sleeps for `latency` seconds, and fails with
+    probability `failure_rate`.
+    """
+
+    name = "fake"
+
+    def __init__(self, database=None, latency=0, failure_rate=0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.charges = {}
+        self.conn = None
+        if database:
+            import sqlite3
+            self.conn = sqlite3.connect(database)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS charges ("
+                "job_id TEXT PRIMARY KEY, user TEXT, project TEXT, "
+                "machine TEXT, charge INTEGER, endtime TEXT, "
+                "refunded INTEGER DEFAULT 0)")
+            self.conn.commit()
+
+    def _request(self):
+        started = time.time()
+        if self.latency:
+            time.sleep(self.latency)
+        metrics.observe("charge", time.time() - started)
+        return self.random.random() >= self.failure_rate
+
+    def charge(self, jobs, before_charge=None, after_charge=None):
+        statuses = []
+        for job in jobs:
+            if before_charge:
+                before_charge(job)
+            normalize_job(job)
+            status = 0
+            if self._request():
+                self._record(job)
+            else:
+                log.error("Fake charge of job %s failed" % str(job['dbid']))
+                status = 1
+            statuses.append(status)
+            if after_charge:
+                after_charge(job, status)
+        if self.conn:
+            self.conn.commit()
+        return statuses
+
+    def _record(self, job):
+        job_id = str(job['gold_job_id'] or job['dbid'])
+        charge = int(job['charge'])
+        if self.conn:
+            if job['incremental']:
+                self.conn.execute("UPDATE charges SET charge=charge+?, "
+                    "refunded=0 WHERE job_id=?", (charge, job_id))
+            else:
+                self.conn.execute("INSERT OR REPLACE INTO charges (job_id, "
+                    "user, project, machine, charge, endtime) VALUES "
+                    "(?, ?, ?, ?, ?, ?)", (job_id, job['user'],
+                    job['project_name'], job['machine_name'], charge,
+                    job['endtime']))
+        elif job['incremental'] and job_id in self.charges:
+            self.charges[job_id][4] += charge
+        else:
+            self.charges[job_id] = [job_id, job['user'], job['project_name'],
+                job['machine_name'], charge, job['endtime']]
+
+    def refund(self, job):
+        job_id = str(job.get('gold_job_id') or job['dbid'])
+        if not self._request():
+            log.error("Fake refund of job %s failed" % job_id)
+            return 1
+        if self.conn:
+            self.conn.execute("UPDATE charges SET refunded=1, charge=0 "
+                "WHERE job_id=?", (job_id,))
+            self.conn.commit()
+        elif job_id in self.charges:
+            del self.charges[job_id]
+        restore = restored_job(job)
+        if restore:
+            # Like the real backends, charge the previous totals back to
+            # the refunded job, as a request which can fail too.
+            return self.charge([restore])[0]
+        return 0
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
+def _get_option(cp, option, default, getter="get"):
+    try:
+        return getattr(cp, getter)("gold", option)
+    except ConfigParser.Error:
+        return default
+
+
+def make_backend(cp):
+    '''
+    Create the charge backend selected by [gold] backend: "gcharge" (the
+    default), "goldsh", "native" or "fake".
+    '''
+    name = _get_option(cp, "backend", "gcharge")
+    if name == "gcharge":
+        return GchargeBackend(_get_option(cp, "workers", 1, "getint"))
+    elif name == "goldsh":
+        return GoldshBackend(_get_option(cp, "batch_size", 1000, "getint"))
+    elif name == "native":
+        return NativeBackend(make_client(cp),
+            _get_option(cp, "batch_size", 100, "getint"))
+    elif name == "fake":
+        return FakeBackend(_get_option(cp, "fake_database", None),
+            _get_option(cp, "fake_latency", 0, "getfloat"),
+            _get_option(cp, "fake_failure_rate", 0, "getfloat"))
+    raise Exception("Unknown Gold backend: %s" % name)
+
+
+def make_client(cp):
+    '''
+    Create the GoldClient for the native backend from the [gold] host
+    (default localhost), port (default 7112), auth_key (the file holding the
+    shared secret; default $GOLD_HOME/etc/auth_key), actor (default the
+    username) and timeout (seconds, default 60) options.
+    '''
+    key_file = _get_option(cp, "auth_key", None)
+    if key_file is None:
+        key_file = os.path.join(cp.get("gold", "home"), "etc", "auth_key")
+    fd = open(key_file, "r")
+    try:
+        key = fd.read().strip()
+    finally:
+        fd.close()
+    return GoldClient(_get_option(cp, "host", "localhost"),
+        _get_option(cp, "port", GOLD_PORT, "getint"),
+        _get_option(cp, "actor", cp.get("gold", "username")), key,
+        _get_option(cp, "timeout", 60, "getfloat"))
+
+
+def get_backend(cp):
+    '''
+    Return the backend for this process, creating it on first use.
+    '''
+    global backend
+    if backend is None:
+        backend = make_backend(cp)
+    return backend
+
+
+def close_backend():
+    '''
+    Close the backend of this process, if any, before forking workers which
+    make their own.
+    '''
+    global backend
+    if backend is not None:
+        backend.close()
+        backend = None
+
+
+def refund(cp, job):
+    '''
+    refund a job through the configured backend
+    '''
+    return get_backend(cp).refund(job)
+
@@ -0,0 +1,227 @@
+
+"""
+A minimal stand-in for the Gold server, for testing the native backend.
+
+It speaks just enough of the SSSRMAP protocol for gold.GoldClient: signed
+Job Charge, Refund and Query requests over keep-alive HTTP/1.1.  Every
+request's signature is checked against the shared key.  Jobs are kept in
+memory (and charges optionally appended to a ledger file, one "JobId
+Duration" or "JobId refund" line per request) so a test can check what was
+charged.  Queries support EQ/NE/GE/GT/LE/LT conditions and the GroupBy,
+Sum and Count operators.
+"""
+
+import sys
+import time
+import random
+import socket
+import logging
+import optparse
+import threading
+import SocketServer
+from xml.dom import minidom
+
+import gold
+
+log = logging.getLogger("gratia_gold.gold_mock")
+
+RESPONSE = gold.RESPONSE
+
+CONDITIONS = {'EQ': lambda a, b: a == b, 'NE': lambda a, b: a != b,
+    'GE': lambda a, b: a >= b, 'GT': lambda a, b: a > b,
+    'LE': lambda a, b: a <= b, 'LT': lambda a, b: a < b}
+
+def _text(element):
+    return "".join([i.data for i in element.childNodes \
+        if i.nodeType == i.TEXT_NODE])
+
+def _format(value):
+    if isinstance(value, float) and value == int(value):
+        return str(int(value))
+    return str(value)
+
+class MockGoldHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                start, headers, body = gold.read_http_message(self.rfile)
+            except (EOFError, socket.error, ValueError):
+                return
+            response = self.server.handle_message(body)
+            message = gold.gold_envelope(response, "gold", self.server.key)
+            self.wfile.write("HTTP/1.1 200 OK\r\n"
+                "Content-Type: text/xml; charset=\"utf-8\"\r\n"
+                "Content-Length: %i\r\n\r\n%s" % (len(message), message))
+            self.wfile.flush()
+
+
+class MockGoldServer(SocketServer.ThreadingTCPServer):
+    '''
+    Serve on (host, port); port 0 picks a free port, available afterward
+    as server_address[1].  With failure_rate, that fraction of charges is
+    rejected; latency is the seconds to wait before answering each request.
+    '''
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, key, host="localhost", port=0, failure_rate=0,
+            latency=0, ledger=None):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port),
+            MockGoldHandler)
+        self.key = key
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.ledger = ledger
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def handle_message(self, message):
+        try:
+            dom = minidom.parseString(message)
+        except Exception:
+            return RESPONSE % ("Failure", "711", "Unparseable request", 0)
+        try:
+            return self._handle(message, dom)
+        finally:
+            dom.unlink()
+
+    def _handle(self, message, dom):
+        body = message[message.index("<Body>"):message.index("</Body>") + 7]
+        digest, signature = gold.gold_signature(body, self.key)
+        if gold._element_text(dom, "DigestValue") != digest or \
+                gold._element_text(dom, "SignatureValue") != signature:
+            return RESPONSE % ("Failure", "444", "Bad signature", 0)
+        request = dom.getElementsByTagName("Request")[0]
+        options = {}
+        for option in request.getElementsByTagName("Option"):
+            options[option.getAttribute("name")] = _text(option)
+        if self.latency:
+            time.sleep(self.latency)
+        action = request.getAttribute("action")
+        if request.getAttribute("object") != "Job":
+            return RESPONSE % ("Failure", "313", "Unsupported object", 0)
+        if action == "Charge":
+            attrs = {}
+            for data in request.getElementsByTagName("Data"):
+                for job in data.getElementsByTagName("Job"):
+                    for field in job.childNodes:
+                        if field.nodeType == field.ELEMENT_NODE:
+                            attrs[field.tagName] = _text(field)
+            job_id = attrs.get("JobId")
+            if self.failure_rate and random.random() < self.failure_rate:
+                return RESPONSE % ("Failure", "782", "Charge failed", 0)
+            duration = float(options.get("Duration", 0))
+            self.lock.acquire()
+            try:
+                job = self.jobs.get(job_id)
+                if options.get("Incremental") == "True" and job:
+                    job['Charge'] += duration
+                else:
+                    attrs['Charge'] = duration
+                    self.jobs[job_id] = attrs
+                self._record("%s %s" % (job_id, options.get("Duration", 0)))
+            finally:
+                self.lock.release()
+            return RESPONSE % ("Success", "000",
+                "Successfully charged job %s" % job_id, 1)
+        elif action == "Refund":
+            job_id = options.get("JobId")
+            self.lock.acquire()
+            try:
+                if job_id in self.jobs:
+                    self.jobs[job_id]['Charge'] = 0
+                self._record("%s refund" % job_id)
+            finally:
+                self.lock.release()
+            return RESPONSE % ("Success", "000",
+                "Successfully refunded job %s" % job_id, 1)
+        elif action == "Query":
+            return self._query(request)
+        return RESPONSE % ("Failure", "313", "Unsupported action", 0)
+
+    def _query(self, request):
+        select = [(i.getAttribute("name"), i.getAttribute("op")) for i in \
+            request.getElementsByTagName("Select")]
+        where = [(i.getAttribute("name"), i.getAttribute("op") or "EQ",
+            _text(i)) for i in request.getElementsByTagName("Where")]
+        group_by = [name for name, op in select if op == "GroupBy"]
+        self.lock.acquire()
+        try:
+            jobs = [i for i in self.jobs.values() if \
+                not [1 for name, op, value in where if \
+                    not CONDITIONS[op](str(i.get(name, "")), value)]]
+        finally:
+            self.lock.release()
+        if group_by:
+            groups = {}
+            for job in jobs:
+                key = tuple([job.get(name, "") for name in group_by])
+                row = groups.get(key)
+                if row is None:
+                    row = dict(zip(group_by, key))
+                    groups[key] = row
+                for name, op in select:
+                    if op == "Sum":
+                        row[name] = row.get(name, 0) + float(job.get(name, 0))
+                    elif op == "Count":
+                        row[name] = row.get(name, 0) + 1
+            rows = groups.values()
+        else:
+            rows = jobs
+        parts = ["<Data>"]
+        for row in rows:
+            parts.append("<Job>")
+            for name, op in select:
+                parts.append("<%s>%s</%s>" % (name, gold._xml(_format(
+                    row.get(name, ""))), name))
+            parts.append("</Job>")
+        parts.append("</Data>")
+        return RESPONSE.replace("</Response>", "".join(parts) + \
+            "</Response>") % ("Success", "000", "Query succeeded", len(rows))
+
+    def _record(self, line):
+        if not self.ledger:
+            return
+        fd = open(self.ledger, "a")
+        try:
+            fd.write(line + "\n")
+        finally:
+            fd.close()
+
+    def start(self):
+        '''
+        Serve from a background thread.
+        '''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--port", type="int", default=gold.GOLD_PORT,
+        help="Port to listen on.")
+    parser.add_option("--key", default="gold",
+        help="The shared secret key (the contents of the auth_key file).")
+    parser.add_option("--failure-rate", dest="failure_rate", type="float",
+        default=0, help="Fraction of charges to reject.")
+    parser.add_option("--latency", type="float", default=0,
+        help="Seconds to wait before answering each request.")
+    parser.add_option("--ledger", help="File to record charges in.")
+    opts, args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = MockGoldServer(opts.key, port=opts.port,
+        failure_rate=opts.failure_rate, latency=opts.latency,
+        ledger=opts.ledger)
+    log.info("Serving Gold requests on port %i" % server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
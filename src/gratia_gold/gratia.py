@@ -7,16 +7,28 @@ Queries the database,
 Summarizes resulting queries.
 """
 
+import time
+import atexit
 import logging
+import ConfigParser
+from datetime import datetime, timedelta
 
 import gold
 import transaction
 
-import MySQLdb
+# MySQLdb is imported where it is used, so that runs which find nothing to
+# do never load it.
 
 log = logging.getLogger("gratia_gold.gratia")
 
+# Initial size, in dbids, of the window scanned by each query.
 MAX_ID = 100000
+# Number of summaries each window should aim for.
+WINDOW_ROWS = 5000
+# Number of rows read from the server at a time while streaming a window.
+FETCH_SIZE = 500
+# Seconds for which the probe names matching [gratia] probe are cached.
+PROBE_CACHE_TTL = 3600
 
 GRATIA_QUERY = \
 """
@@ -40,9 +52,9 @@ FROM
 JOIN
   JobUsageRecord_Meta JURM ON JUR.dbid = JURM.dbid
 WHERE
-  JUR.dbid >= %%(last_successful_id)s AND
-  JUR.dbid < %%(last_successful_id)s + %d AND   
-  ProbeName REGEXP %%(probename)s
+  JUR.dbid >= %(last_successful_id)s AND
+  JUR.dbid < %(end_id)s AND
+  PROBE_FILTER
 GROUP BY
   ResourceType,
   ReportableVOName,
@@ -53,8 +65,113 @@ GROUP BY
   MachineName,
   ProjectName
 ORDER BY JUR.dbid ASC
-LIMIT 10000
-""" % MAX_ID
+"""
+
+NEXT_ID_QUERY = \
+"""
+SELECT
+  MIN(dbid)
+FROM
+  JobUsageRecord_Meta
+WHERE
+  dbid >= %(start_id)s AND
+  dbid <= %(max_id)s AND
+  PROBE_FILTER
+"""
+
+RAW_QUERY = \
+"""
+SELECT
+  JUR.dbid,
+  ResourceType,
+  ReportableVOName,
+  LocalUserId,
+  Charge,
+  WallDuration,
+  CpuUserDuration,
+  CpuSystemDuration,
+  NodeCount,
+  Njobs,
+  Processors,
+  EndTime,
+  MachineName,
+  ProjectName
+FROM
+  JobUsageRecord JUR
+JOIN
+  JobUsageRecord_Meta JURM ON JUR.dbid = JURM.dbid
+WHERE
+  JUR.dbid >= %(start_id)s AND
+  JUR.dbid < %(end_id)s AND
+  PROBE_FILTER
+"""
+
+# Whether there is anything new for our probe; only the new rows are scanned.
+NEW_ID_QUERY = \
+"""
+SELECT
+  dbid
+FROM
+  JobUsageRecord_Meta
+WHERE
+  dbid >= %(start_id)s AND
+  ProbeName REGEXP %(probename)s
+ORDER BY dbid ASC
+LIMIT 1
+"""
+
+PROBES_QUERY = \
+"""
+SELECT DISTINCT
+  ProbeName
+FROM
+  JobUsageRecord_Meta
+WHERE
+  ProbeName REGEXP %(probename)s
+"""
+
+# The probe names of PROBES_QUERY reporting in a range of dbids, to add to
+# the cached names as new records come in.
+PROBES_TAIL_QUERY = \
+"""
+SELECT DISTINCT
+  ProbeName
+FROM
+  JobUsageRecord_Meta
+WHERE
+  dbid >= %(start_id)s AND
+  dbid <= %(end_id)s AND
+  ProbeName REGEXP %(probename)s
+"""
+
+# Totals for reconcile: the summaries of GRATIA_QUERY, over a whole range.
+TOTALS_QUERY = \
+"""
+SELECT
+  DATE(EndTime),
+  ProjectName,
+  LocalUserId,
+  sum(Charge) as Charge,
+  sum(WallDuration) as WallDuration
+FROM
+  JobUsageRecord JUR
+JOIN
+  JobUsageRecord_Meta JURM ON JUR.dbid = JURM.dbid
+WHERE
+  JUR.dbid >= %(start_id)s AND
+  JUR.dbid < %(end_id)s AND
+  PROBE_FILTER
+  DAY_FILTER
+GROUP BY
+  ResourceType,
+  ReportableVOName,
+  LocalUserId,
+  NodeCount,
+  Processors,
+  DATE(EndTime),
+  MachineName,
+  ProjectName
+"""
 
 # %d day of month (00-31)
 
@@ -72,7 +189,41 @@ def _add_if_exists(cp, attribute, info):
     except:
         pass
 
-def query_gratia(cp, txn):
+class Window(object):
+    """
+    Tracks the size of the dbid window scanned by each query.
+
+    The window is resized after every query so that it returns roughly
+    [gratia] window_rows summaries: it shrinks in dense regions and grows
+    in sparse ones.  The size changes by at most a factor of four per query.
+    """
+
+    def __init__(self, cp):
+        try:
+            self.size = cp.getint("gratia", "window")
+        except ConfigParser.Error:
+            self.size = MAX_ID
+        try:
+            self.target = cp.getint("gratia", "window_rows")
+        except ConfigParser.Error:
+            self.target = WINDOW_ROWS
+        if self.size < 1 or self.target < 1:
+            raise Exception("Invalid [gratia] window settings")
+
+    def resize(self, rows):
+        """
+        Pick the next window size given the number of summaries the last
+        window returned.
+        """
+        if rows == 0:
+            size = self.size * 4
+        else:
+            size = self.size * self.target / rows
+        size = max(self.size / 4, min(self.size * 4, size))
+        self.size = max(1, size)
+
+
+def _connection_info(cp):
     info = {}
     _add_if_exists(cp, "user", info)
     _add_if_exists(cp, "passwd", info)
@@ -81,38 +232,286 @@ def query_gratia(cp, txn):
     _add_if_exists(cp, "port", info)
     if 'port' in info:
         info['port'] = int(info['port'])
+    return info
+
+# MySQL client errors meaning the server connection went away.
+CR_SERVER_GONE_ERROR = 2006
+CR_SERVER_LOST = 2013
+
+class Connection(object):
+    """
+    A connection to the Gratia database which is opened on first use and
+    then kept for the rest of the run.
+
+    If the server drops the connection, the query is retried once on a
+    fresh connection.
+    """
+
+    def __init__(self, info):
+        self.info = info
+        self.conn = None
+
+    def connect(self):
+        import MySQLdb
+        try:
+            self.conn = MySQLdb.connect(**self.info)
+            log.debug("Successfully connected to database ...")
+        except Exception, e:
+            log.error("Failed to connect to database; and the reason is:"+ str(e))
+            raise Exception("Failed to connect to database")
+
+    def execute(self, query, params=None, cursorclass=None):
+        """
+        Run a query and return the cursor holding its results.
+        """
+        import MySQLdb
+        for attempt in range(2):
+            if self.conn is None:
+                self.connect()
+            try:
+                if cursorclass:
+                    curs = self.conn.cursor(cursorclass)
+                else:
+                    curs = self.conn.cursor()
+                curs.execute(query, params)
+                return curs
+            except MySQLdb.OperationalError, oe:
+                if attempt or oe.args[0] not in (CR_SERVER_GONE_ERROR,
+                        CR_SERVER_LOST):
+                    raise
+                log.warning("Lost connection to database (%s); reconnecting" \
+                    % str(oe))
+                self.close()
+
+    def close(self):
+        if self.conn is not None:
+            import MySQLdb
+            try:
+                self.conn.close()
+            except MySQLdb.Error:
+                pass
+            self.conn = None
+
+_connections = {}
+
+def get_connection(cp):
+    """
+    Return the shared Connection for the database named in cp.  Each
+    source of a fan-in ([gratia] source; see main.fan_in) is queried from a
+    thread of its own, so it gets a Connection of its own, even if it
+    shares a database with another.
+    """
+    info = _connection_info(cp)
+    key = tuple(sorted(info.items()))
     try:
-        conn = MySQLdb.connect(**info)
-        log.debug("Successfully connected to database ...")
-    except:
-        log.error("Failed to connect to database; and the reason is:"+ str(conn))
-        raise Exception("Failed to connect to database")
-    curs = conn.cursor()
-
-    txn['probename'] = cp.get("gratia", "probe")
-
-    results = []
-    curs.execute(GRATIA_QUERY, txn)
-    for row in curs.fetchall():
-        info = {}
-        info['dbid'] = row[0] #dbid in gratia
-        info['resource_type'] = row[1] # ResourceType in gratia
-        info['vo_name'] = row[2] # ReportableVOName in gratia
-        info['user'] = row[3] # LocalUserId in gratia
-        info['charge'] = row[4] # Charge in gratia
-        info['wall_duration'] = row[5] # WallDuration in gratia
-        info['cpu'] = row[6] + row[7] # CpuUserDuration + CpuSystemDuration in gratia
-        info['node_count'] = row[8] # NodeCount in gratia
-        info['njobs'] = row[9] # Njobs in gratia
-        info['processors'] = row[10] # Processors in gratia
-        info['endtime'] = row[11].strftime("%Y-%m-%d %H:%M:%S") # EndTime in gratia
-        # info['machine_name'] = row[12] # MachineName in gratia
-        # force the machine_name to be opts.machinename
-        info['machine_name'] = cp.get("gratia", "machinename")
-        info['project_name'] = row[13] # ProjectName in gratia
-        info['queue'] = "condor"
-        results.append(info)
-    return results
+        key = (cp.get("gratia", "source"),) + key
+    except ConfigParser.Error:
+        pass
+    if key not in _connections:
+        _connections[key] = Connection(info)
+    return _connections[key]
+
+def close_connections():
+    for conn in _connections.values():
+        conn.close()
+    _connections.clear()
+atexit.register(close_connections)
+
+_probe_names = {}
+
+def probe_names(cp, end_id):
+    """
+    Return the probe names matching the [gratia] probe regex, valid for
+    records with dbids below end_id, or None if probes should be matched
+    with the regex instead ([gratia] probe_cache_ttl = 0).
+
+    The names are looked up once, with the regex applied to the distinct
+    probe names only, and cached for probe_cache_ttl seconds (default
+    3600).  A probe first reporting after the lookup only has records above
+    the highest dbid seen at the time, so before any window reaching past
+    it, the names of the records added since (an indexed range of dbids)
+    are added to the cached ones.
+    """
+    try:
+        ttl = cp.getfloat("gratia", "probe_cache_ttl")
+    except ConfigParser.Error:
+        ttl = PROBE_CACHE_TTL
+    if ttl <= 0:
+        return None
+    conn = get_connection(cp)
+    regex = cp.get("gratia", "probe")
+    key = (conn, regex)
+    entry = _probe_names.get(key)
+    now = time.time()
+    if entry is not None and end_id <= entry[1] and now < entry[2]:
+        return entry[0]
+    row = conn.execute("SELECT MAX(dbid) FROM JobUsageRecord_Meta"
+        ).fetchone()
+    through = (row and row[0]) or 0
+    if entry is None or now >= entry[2]:
+        names = [row[0] for row in conn.execute(PROBES_QUERY,
+            {'probename': regex}).fetchall()]
+        expires = now + ttl
+    else:
+        names = list(entry[0])
+        expires = entry[2]
+        if through >= entry[1]:
+            for row in conn.execute(PROBES_TAIL_QUERY, {'probename': regex,
+                    'start_id': entry[1], 'end_id': through}).fetchall():
+                if row[0] not in names:
+                    names.append(row[0])
+    names.sort()
+    log.debug("Probe %s matches %s (through DBID=%i)", regex,
+        ", ".join(names), through)
+    entry = (names, through + 1, expires)
+    _probe_names[key] = entry
+    return entry[0]
+
+def _probe_filter(cp, query, params, end_id):
+    """
+    Fill in the PROBE_FILTER condition of query, adding its parameters to
+    params: an IN list of the matching probe names, which can use an index,
+    rather than the regex applied to every row.
+    """
+    names = probe_names(cp, end_id)
+    if not names:
+        # Nothing matches (yet), or caching is off; fall back to the regex.
+        params['probename'] = cp.get("gratia", "probe")
+        condition = "ProbeName REGEXP %(probename)s"
+    else:
+        placeholders = []
+        for idx, name in enumerate(names):
+            params['probe%i' % idx] = name
+            placeholders.append("%%(probe%i)s" % idx)
+        condition = "ProbeName IN (%s)" % ", ".join(placeholders)
+    return query.replace("PROBE_FILTER", condition)
+
+# Fields of a summarized job, in the order they are selected.
+JOB_FIELDS = ('dbid', 'resource_type', 'vo_name', 'user', 'charge',
+    'wall_duration', 'cpu', 'node_count', 'njobs', 'processors', 'endtime',
+    'machine_name', 'project_name', 'queue')
+# Fields set when the summary is charged incrementally to an existing Gold
+# job (see summaries.ChargedIndex), or, for gold_job_id, to a job id offset
+# from its dbid ([gratia] job_id_offset).
+CHARGE_FIELDS = ('gold_job_id', 'incremental', 'previous')
+
+class Job(object):
+    """
+    A summarized job.
+
+    Fields are kept in slots rather than a per-job dict; item access
+    (job['user']) is supported so jobs can be used wherever a job dict is.
+    """
+
+    __slots__ = JOB_FIELDS + CHARGE_FIELDS
+
+    def __init__(self, *values):
+        for name in CHARGE_FIELDS:
+            setattr(self, name, None)
+        for name, value in zip(JOB_FIELDS, values):
+            setattr(self, name, value)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def todict(self):
+        return dict([(name, getattr(self, name)) for name in \
+            JOB_FIELDS + CHARGE_FIELDS])
+
+    def __repr__(self):
+        return repr(self.todict())
+
+_days = {}
+
+def day_string(value):
+    """
+    Return the date of a date or datetime as "YYYY-MM-DD".  Rows only hold a
+    handful of distinct days, so each is formatted once.
+    """
+    ordinal = value.toordinal()
+    day = _days.get(ordinal)
+    if day is None:
+        if len(_days) >= gold.MEMO_SIZE:
+            _days.clear()
+        day = value.strftime("%Y-%m-%d")
+        _days[ordinal] = day
+    return day
+
+def query_gratia(cp, start_id, end_id):
+    """
+    Summarize the jobs with dbids in [start_id, end_id).
+
+    This is a generator: rows are streamed from a server-side cursor and
+    yielded as Job objects, so charging can begin with the first summary
+    and memory use does not depend on the size of the window.  The
+    connection is busy until the generator is exhausted.
+    """
+    # force the machine_name to be opts.machinename
+    machine_name = cp.get("gratia", "machinename")
+
+    params = {'last_successful_id': start_id, 'end_id': end_id}
+    query = _probe_filter(cp, GRATIA_QUERY, params, end_id)
+    import MySQLdb.cursors
+    curs = get_connection(cp).execute(query, params,
+        MySQLdb.cursors.SSCursor)
+    try:
+        while True:
+            rows = curs.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield Job(
+                    row[0], # dbid in gratia
+                    row[1], # ResourceType in gratia
+                    row[2], # ReportableVOName in gratia
+                    row[3], # LocalUserId in gratia
+                    row[4], # Charge in gratia
+                    row[5], # WallDuration in gratia
+                    row[6] + row[7], # CpuUserDuration + CpuSystemDuration in gratia
+                    row[8], # NodeCount in gratia
+                    row[9], # Njobs in gratia
+                    row[10], # Processors in gratia
+                    day_string(row[11]) + " 00:00:00", # DATE(EndTime) in gratia
+                    machine_name, # MachineName (row[12]) is overridden
+                    row[13], # ProjectName in gratia
+                    "condor")
+    finally:
+        curs.close()
+
+def next_dbid(cp, start_id, max_id):
+    """
+    Return the smallest dbid in [start_id, max_id] belonging to our probe,
+    or None if there is none.  Used to jump over empty regions.
+    """
+    params = {'start_id': start_id, 'max_id': max_id}
+    query = _probe_filter(cp, NEXT_ID_QUERY, params, max_id + 1)
+    curs = get_connection(cp).execute(query, params)
+    row = curs.fetchone()
+    if not row or row[0] is None:
+        return None
+    return int(row[0])
+
+def has_records(cp, start_id):
+    """
+    Return True if our probe has any record with a dbid of start_id or
+    more.  The probe regex is matched directly, rather than looking up the
+    probe names first, as only the rows past start_id are examined.
+    """
+    params = {'start_id': start_id, 'probename': cp.get("gratia", "probe")}
+    return get_connection(cp).execute(NEW_ID_QUERY, params).fetchone() \
+        is not None
+
+def max_dbid(cp):
+    """
+    Return the current maximum dbid in the Gratia database.
+    """
+    row = get_connection(cp).execute("select MAX(dbid) from JobUsageRecord").fetchone()
+    if not row or row[0] is None:
+        return 0
+    return int(row[0])
 
 def initialize_txn(cp):
     '''
@@ -120,21 +519,7 @@ def initialize_txn(cp):
     the minimum dbid of the database
     and last_successful_id
     '''
-    info = {}
-    _add_if_exists(cp, "user", info)
-    _add_if_exists(cp, "passwd", info)
-    _add_if_exists(cp, "db", info)
-    _add_if_exists(cp, "host", info)
-    _add_if_exists(cp, "port", info)
-    if 'port' in info:
-        info['port'] = int(info['port'])
-    try:
-        db = MySQLdb.connect(**info)
-    except:
-        log.error("Connection to database failed; and the reason is: "+str(db))
-        raise Exception("Failed to connect to database.");
-    cursor = db.cursor()
-    cursor.execute("select MIN(dbid), MAX(dbid) from JobUsageRecord");
+    cursor = get_connection(cp).execute("select MIN(dbid), MAX(dbid) from JobUsageRecord");
     row = cursor.fetchone()
     minimum_dbid = int(row[0])
     maximum_dbid = int(row[1])
@@ -143,13 +528,232 @@ def initialize_txn(cp):
     # we check the file, if the file is empty, then it is the
     # the minimum dbid, otherwise, we choose 
     # to be the maximum of the "minimum dbid" and the last_successful_id in the file
-    txn={}
-    txn_previous = transaction.start_txn(cp)
-    txn['last_successful_id']=max(minimum_dbid, txn_previous['last_successful_id'])
-    txn['probename'] = cp.get("gratia", "probe")
-    transaction.commit_txn(cp, txn)
+    # The file is only rewritten if this changes it.
+    txn = transaction.start_txn(cp)
+    last_successful_id = max(minimum_dbid, txn['last_successful_id'])
+    probename = cp.get("gratia", "probe")
+    if txn['last_successful_id'] != last_successful_id or \
+            txn.get('probename') != probename:
+        txn['last_successful_id'] = last_successful_id
+        txn['probename'] = probename
+        transaction.commit_txn(cp, txn)
     return minimum_dbid, maximum_dbid
 
-def summarize_gratia(cp):
-    raise NotImplementedError()
+def _add(total, value):
+    """
+    Add like SQL's sum(): NULLs are ignored, and the sum of only NULLs is
+    NULL.
+    """
+    if value is None:
+        return total
+    if total is None:
+        return value
+    return total + value
+
+class Aggregator(object):
+    """
+    Folds raw job records into summaries, grouped on the same columns as
+    GRATIA_QUERY, across as many windows as it sees.
+
+    A day's summaries are held until the day is complete - the newest
+    EndTime seen is more than `grace` past the end of the day - and are
+    then emitted once.  Records for a day at or before complete_through
+    (one whose summaries were already emitted) are late; they are
+    summarized separately and emitted with the current window.  So are
+    records with no EndTime, whose day never completes.
+
+    complete_through only moves forward, and once it has been committed
+    every scanned record for such a day has been charged.  When resuming
+    from a committed complete_through and scanned_id, records below
+    scanned_id for days up to that complete_through, or with no EndTime,
+    are skipped.
+    """
+
+    def __init__(self, machine_name, grace, complete_through=None,
+            scanned_id=0):
+        self.machine_name = machine_name
+        self.grace = grace
+        self.complete_through = complete_through
+        self.skip_through = complete_through
+        self.scanned_id = scanned_id
+        self.groups = {}
+        self.late = {}
+        self.latest = None
+        self.rows = 0
 
+    def add(self, row):
+        """
+        Fold in one row of RAW_QUERY.
+        """
+        dbid, endtime = row[0], row[11]
+        day = None
+        if endtime is not None:
+            day = day_string(endtime)
+            if self.latest is None or endtime > self.latest:
+                self.latest = endtime
+        if dbid < self.scanned_id and (day is None or (self.skip_through \
+                and day <= self.skip_through)):
+            # Charged before we resumed; see the class docstring.
+            return
+        if day is None or (self.complete_through and \
+                day <= self.complete_through):
+            groups = self.late
+        else:
+            groups = self.groups
+        self.rows += 1
+        # ResourceType, ReportableVOName, LocalUserId, NodeCount,
+        # Processors, DATE(EndTime), MachineName, ProjectName
+        key = (row[1], row[2], row[3], row[8], row[10], day, row[12], row[13])
+        acc = groups.get(key)
+        if acc is None:
+            # max dbid, Charge, WallDuration, CPU, Njobs, min dbid
+            acc = [dbid, None, None, None, 0, dbid]
+            groups[key] = acc
+        acc[0] = max(acc[0], dbid)
+        acc[1] = _add(acc[1], row[4])
+        acc[2] = _add(acc[2], row[5])
+        acc[3] = _add(_add(acc[3], row[6]), row[7])
+        if row[9] is not None:
+            acc[4] += 1
+        acc[5] = min(acc[5], dbid)
+
+    def _emit(self, groups):
+        jobs = []
+        for key, acc in groups:
+            resource_type, vo_name, user, node_count, processors, day, \
+                machine_name, project_name = key
+            if day is None:
+                endtime = None
+            else:
+                endtime = day + " 00:00:00"
+            jobs.append(Job(acc[0], resource_type, vo_name, user, acc[1],
+                acc[2], acc[3], node_count, acc[4], processors, endtime,
+                self.machine_name, project_name, "condor"))
+        jobs.sort(lambda a, b: cmp(a.dbid, b.dbid))
+        return jobs
+
+    def complete(self):
+        """
+        Remove and return the summaries for complete days, plus any late
+        summaries and those with no EndTime, ordered by dbid.
+        """
+        ready = self.late.items()
+        self.late = {}
+        if self.latest is not None:
+            cutoff = (self.latest - self.grace - timedelta(1)).strftime("%Y-%m-%d")
+            for key in self.groups.keys():
+                if key[5] is not None and key[5] <= cutoff:
+                    ready.append((key, self.groups.pop(key)))
+            if not self.complete_through or cutoff > self.complete_through:
+                self.complete_through = cutoff
+        return self._emit(ready)
+
+    def flush(self):
+        """
+        Remove and return every summary still held, ordered by dbid.
+        """
+        ready = self.late.items() + self.groups.items()
+        for key, acc in ready:
+            if key[5] is not None and (not self.complete_through or \
+                    key[5] > self.complete_through):
+                self.complete_through = key[5]
+        self.late = {}
+        self.groups = {}
+        return self._emit(ready)
+
+    def checkpoint(self, end_id):
+        """
+        Return the dbid to restart from: the lowest dbid of any record still
+        held, or end_id if there is none.
+        """
+        checkpoint = end_id
+        for acc in self.groups.values():
+            checkpoint = min(checkpoint, acc[5])
+        return checkpoint
+
+def make_aggregator(cp, txn):
+    """
+    Create the Aggregator for [gratia] aggregate = client, resuming from
+    the complete_through and scanned_id recorded in txn.
+    """
+    try:
+        grace = cp.getfloat("gratia", "aggregate_grace")
+    except ConfigParser.Error:
+        grace = 24
+    return Aggregator(cp.get("gratia", "machinename"), timedelta(0, grace*3600),
+        txn.get('complete_through'), txn.get('scanned_id', 0))
+
+def summarize_gratia(cp, start_id, end_id, aggregator):
+    """
+    Scan the raw records with dbids in [start_id, end_id) into aggregator,
+    then return the summaries that are ready to be charged.
+
+    Unlike query_gratia, the database only does an indexed range scan; the
+    grouping happens here, and summaries span windows.
+    """
+    params = {'start_id': start_id, 'end_id': end_id}
+    query = _probe_filter(cp, RAW_QUERY, params, end_id)
+    aggregator.rows = 0
+    import MySQLdb.cursors
+    curs = get_connection(cp).execute(query, params,
+        MySQLdb.cursors.SSCursor)
+    try:
+        while True:
+            rows = curs.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                aggregator.add(row)
+    finally:
+        curs.close()
+    return aggregator.complete()
+
+
+def charged_totals(cp, start_id, end_id, first_day=None, last_day=None,
+        counts=None):
+    """
+    Return the totals that syncing the records with dbids in [start_id,
+    end_id) charges, by (day, project, user), in a single aggregate query.
+    If given, first_day and last_day ("YYYY-MM-DD", inclusive) limit the
+    records to those which ended on those days.  If a dictionary is given
+    as counts, the number of summaries making up each total is added to it.
+
+    Each summary is counted as what it is charged (see gold.job_charge).
+    Summaries with no EndTime are charged as of the day they are synced,
+    so they are left out (and logged).
+    """
+    params = {'start_id': start_id, 'end_id': end_id}
+    days = []
+    if first_day:
+        params['first_day'] = first_day
+        days.append("AND EndTime >= %(first_day)s")
+    if last_day:
+        params['after_day'] = (datetime.strptime(last_day, "%Y-%m-%d") + \
+            timedelta(1)).strftime("%Y-%m-%d")
+        days.append("AND EndTime < %(after_day)s")
+    query = _probe_filter(cp, TOTALS_QUERY, params, end_id)
+    query = query.replace("DAY_FILTER", " ".join(days))
+    totals = {}
+    skipped = 0
+    import MySQLdb.cursors
+    curs = get_connection(cp).execute(query, params,
+        MySQLdb.cursors.SSCursor)
+    try:
+        while True:
+            rows = curs.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for day, project, user, charge, wall_duration in rows:
+                if day is None:
+                    skipped += 1
+                    continue
+                key = (day_string(day), project, user)
+                totals[key] = totals.get(key, 0) + \
+                    float(gold.job_charge(charge, wall_duration))
+                if counts is not None:
+                    counts[key] = counts.get(key, 0) + 1
+    finally:
+        curs.close()
+    if skipped:
+        log.warning("Left out %i summaries with no EndTime." % skipped)
+    return totals
@@ -36,7 +36,7 @@ atexit.register(close_and_unlink_lock)
 
 log = logging.getLogger("gratia_gold.locking")
 
-def exclusive_lock(lock_location, timeout=3600):
+def exclusive_lock(lock_location, timeout=3600, persistent=False):
     """
     Grabs an exclusive lock on lock_location
 
@@ -44,6 +44,10 @@ def exclusive_lock(lock_location, timeout=3600):
     timeout, then the other process will be signaled.  If the timeout is
     negative, then the other process is never signaled.
 
+    If persistent is set, the lock is to be held for as long as this process
+    runs (a daemon, or a backfill); the lockfile says so, and this process is
+    never signaled by others.
+
     If we are unable to hold the lock, this call will not block on the lock;
     rather, it will throw an exception.
     """
@@ -57,7 +61,8 @@ def exclusive_lock(lock_location, timeout=3600):
 
     global fd
     global pid_with_lock
-    fd = open(lock_location, "w")
+    # Opened for appending, so the holder's PID is not truncated away.
+    fd = open(lock_location, "a+")
 
     # POSIX file locking is cruelly crude.  There's nothing to do besides
     # try / sleep to grab the lock, no equivalent of polling.
@@ -70,9 +75,8 @@ def exclusive_lock(lock_location, timeout=3600):
     for tries in range(1, max_tries+1):
         try:
             fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            fd.write("%d" % os.getpid())
+            write_pid(fd, persistent)
             pid_with_lock = os.getpid()
-            fd.flush()
             log.debug("Successfully acquired lock %s." % lock_location)
             return
         except IOError, ie:
@@ -87,21 +91,65 @@ def exclusive_lock(lock_location, timeout=3600):
                 # iteration in the for loop.
                 try:
                     fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    fd.write("%d" % os.getpid())
+                    write_pid(fd, persistent)
                     pid_with_lock = os.getpid()
-                    fd.flush()
                     return
                 except IOError, ie:
                     if not ((ie.errno == errno.EACCES) or (ie.errno == errno.EAGAIN)):
                         raise
         fd.close()
-        fd = open(lock_location, "w")
+        fd = open(lock_location, "a+")
         log.warning("Unable to acquire lock, try %i; will sleep for %i "
             "seconds and try %i more times." % (tries, tries, max_tries-tries))
         time.sleep(tries)
 
     raise Exception("Unable to acquire lock")
 
+def write_pid(fd, persistent):
+    """
+    For internal use only.
+
+    Replace the contents of the lockfile fd with our PID, followed by
+    "persistent" if the lock is held for as long as we run.
+    """
+    fd.truncate(0)
+    if persistent:
+        fd.write("%d persistent" % os.getpid())
+    else:
+        fd.write("%d" % os.getpid())
+    fd.flush()
+
+def is_persistent(fd, pid):
+    """
+    For internal use only.
+
+    Return True if the lockfile fd says the process pid holds the lock for as
+    long as it runs.
+    """
+    fd.seek(0)
+    return fd.read().split() == [str(pid), "persistent"]
+
+def persistent_holder(lock_location):
+    """
+    Return the PID of the process holding the lock on lock_location if it
+    holds it for as long as it runs, and None otherwise.
+
+    Do not call this with the lock held: closing the file releases it.
+    """
+    try:
+        lock_fd = open(lock_location, "r")
+    except IOError, ie:
+        if ie.errno != errno.ENOENT:
+            raise
+        return None
+    try:
+        pid = get_lock_pid(lock_fd)
+        if pid and pid != os.getpid() and is_persistent(lock_fd, pid):
+            return pid
+    finally:
+        lock_fd.close()
+    return None
+
 def check_lock(fd, timeout):
     """
     For internal use only.
@@ -119,6 +167,11 @@ def check_lock(fd, timeout):
         log.warning("Another process, %d, holds the probe lockfile." % pid)
         return False
 
+    if is_persistent(fd, pid):
+        log.warning("Another process, %d, holds the probe lockfile for as "
+            "long as it runs; will not time it out." % pid)
+        return False
+
     try:
         age = get_pid_age(pid)
     except:
@@ -0,0 +1,146 @@
+
+"""
+Queued logging for gratia-gold.
+
+Records are handed to a QueueHandler, which only resolves their message
+and puts them on a bounded queue; a background writer thread takes them
+off and passes them to the real (console and file) handlers.  So the
+charge loop never waits on the log file, and a record below the
+configured level costs no formatting at all (use log.debug("... %s", x)
+rather than "%" in the call).
+
+The writer thread does not survive a fork: a forked worker calls
+after_fork() to start its own, and stop() before it exits, so its last
+records are written out.
+"""
+
+import Queue
+import atexit
+import logging
+import threading
+
+# Records waiting to be written; a full queue blocks the logging thread
+# instead of dropping records.
+QUEUE_SIZE = 10000
+
+writer = None
+
+class QueueHandler(logging.Handler):
+    """
+    Put each record on a queue for the writer thread.
+
+    The message is resolved here, as the record is logged, so arguments
+    changed afterwards (jobs are dictionaries) are logged as they were.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+                record.exc_info = None
+            self.queue.put(record)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+
+class Writer(object):
+    """
+    Pass the records of a queue to the handlers, from a background thread.
+    """
+
+    def __init__(self, handlers, size=QUEUE_SIZE):
+        self.handlers = handlers
+        self.queue = Queue.Queue(size)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+            name="gratia-gold-log")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """
+        Write out the queued records and stop the thread.
+        """
+        if not self.thread:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        for handler in self.handlers:
+            handler.flush()
+
+    def close(self):
+        self.stop()
+        for handler in self.handlers:
+            handler.close()
+
+
+def configure(logger, handlers, level):
+    """
+    Route the records of logger, at level or above, through a queue to
+    handlers.  Calling this again (a reloaded configuration, or several
+    entry points in one process) closes the handlers set up before instead
+    of adding to them.
+    """
+    global writer
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+    if writer:
+        writer.close()
+    writer = Writer(handlers)
+    handler = QueueHandler(writer.queue)
+    handler.setLevel(level)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    writer.start()
+    return writer
+
+
+def after_fork():
+    """
+    In a forked child, start a writer thread to replace the parent's.
+
+    The queue is replaced, as its lock may have been held by another thread
+    at the fork, and so are the handlers' locks, for the same reason.
+    """
+    if not writer:
+        return
+    writer.queue = Queue.Queue(writer.queue.maxsize)
+    for handler in logging.getLogger("gratia_gold").handlers:
+        if isinstance(handler, QueueHandler):
+            handler.queue = writer.queue
+        handler.createLock()
+    for handler in writer.handlers:
+        handler.createLock()
+    writer.start()
+
+
+def stop():
+    """
+    Write out the queued records; call this before os._exit().
+    """
+    if writer:
+        writer.stop()
+
+atexit.register(stop)
@@ -8,15 +8,24 @@ records it finds, and submit the summaries to GOLD via a command-line script.
 """
 
 import os
+import sys
 import time
+import errno
+import Queue
 import random
+import signal
 import logging
 import optparse
+import threading
 import ConfigParser
 
 import gold
+import logs
 import gratia
 import locking
+import metrics
+import profiling
+import summaries
 import transaction
 
 log = None
@@ -35,6 +44,15 @@ def parse_opts():
     parser.add_option("-s", "--cron", dest="cron",
                       type="int", default=0,
                       help = "Called from cron; cron interval (adds a random sleep)")
+    parser.add_option("-d", "--daemon", dest="daemon",
+                      default=False, action="store_true",
+                      help="Keep running, polling Gratia for new records.")
+    parser.add_option("-p", "--profile", dest="profile",
+                      default=False, action="store_true",
+                      help="Profile the run; the stats are written next to the log.")
+    parser.add_option("-b", "--backfill", dest="backfill",
+                      default=False, action="store_true",
+                      help="Catch up in parallel shards; see [backfill].")
     
     opts, args = parser.parse_args()
 
@@ -48,6 +66,7 @@ def parse_opts():
 def config_logging(cp, opts):
     global log
     global logfile
+    global logfile_handler
     # return a logger with the specified name gratia_gold
     log = logging.getLogger("gratia_gold")
 
@@ -62,46 +81,481 @@ def config_logging(cp, opts):
 
     # default log level - make logger/console match
     # Logging messages which are less severe than logging.WARNING will be ignored
-    log.setLevel(logging.WARNING)
-    console_handler.setLevel(logging.WARNING)
-    logfile_handler.setLevel(logging.WARNING)
-
+    level = logging.WARNING
     if opts.verbose: 
-        log.setLevel(logging.DEBUG)
-        console_handler.setLevel(logging.DEBUG)
-        logfile_handler.setLevel(logging.DEBUG)
+        level = logging.DEBUG
+    console_handler.setLevel(level)
+    logfile_handler.setLevel(level)
 
     # formatter
     formatter = logging.Formatter("[%(process)d] %(asctime)s %(levelname)7s:  %(message)s")
     console_handler.setFormatter(formatter)
     logfile_handler.setFormatter(formatter)
+    handlers = [logfile_handler]
     if opts.cron == 0:
-        log.addHandler(console_handler)
-    log.addHandler(logfile_handler)
+        handlers.insert(0, console_handler)
+    # The handlers are fed from a queue by a background thread (see logs),
+    # so writing the log never holds up charging.
+    logs.configure(log, handlers, level)
     log.debug("Logger has been configured")
 
 
-def main():
-    opts, args = parse_opts()
-    cp = ConfigParser.ConfigParser()
-    cp.read(opts.config)
-    config_logging(cp, opts)
+def charge_jobs(cp, journal, jobs, index=None, checkpointer=None, failed=None,
+        retry=False):
+    """
+    Charge a window of jobs (any iterable) to Gold through the configured
+    backend, returning one status per job (0 on success).
+
+    Jobs still in the journal from a checkpoint of an earlier attempt at
+    this window were charged then; they are not charged again (they count
+    as successes).  If a charged-summary index is given, summaries it has
+    already seen are skipped the same way, the rest are charged
+    incrementally where their group is already in Gold, and each successful
+    charge is recorded in the index.  If a checkpointer is given, it is
+    told about every charge as it starts and finishes.  If a list is given
+    as failed, a (job, status) pair is appended to it for every charge
+    which fails.
+
+    With retry set, the jobs are queued retries, already prepared with
+    ChargedIndex.prepare_retry; none of them is skipped, as a newer summary
+    charged for the same group since does not cover them.
+
+    With [gratia] job_id_offset set, new Gold jobs get the dbid plus that
+    offset as their id, so that sources whose dbids overlap (see
+    source_configs) do not charge the same Gold jobs.
+    """
+    skipped = []
+    replayed = journal.charged()
+    if replayed and not retry:
+        jobs = skip_replayed(jobs, replayed, skipped, index)
+    if index and not retry:
+        jobs = index.filter(jobs, skipped)
+    try:
+        offset = cp.getint("gratia", "job_id_offset")
+    except ConfigParser.Error:
+        offset = 0
+    if offset:
+        jobs = offset_job_ids(jobs, offset)
+
+    # Record the job into rollback log.  We write it in before we call
+    # gcharge - this way, if the script is killed unexpectedly, we'll
+    # refund the job.  So, this errs on the conservative side.
+    def before_charge(job):
+        log.debug("Processing job: %s", job)
+        offset = journal.append(job)
+        if checkpointer:
+            checkpointer.started_charge(job, offset)
+    def after_charge(job, status):
+        if status and failed is not None:
+            failed.append((job, status))
+        if index and status == 0:
+            index.record(job)
+        if checkpointer:
+            checkpointer.finished_charge(job, status)
+    statuses = gold.get_backend(cp).charge(jobs, before_charge, after_charge)
+    return statuses + [0] * len(skipped)
+
+
+def skip_replayed(jobs, replayed, skipped, index=None):
+    """
+    Drop the jobs whose charges were checkpointed by an earlier attempt at
+    this window (replayed maps their dbids to their journaled charges),
+    appending them to skipped.  The journaled charges are recorded in the
+    index, if any, as that attempt's index updates were rolled back.
+    """
+    for job in jobs:
+        charge = replayed.get(job['dbid'])
+        if charge is None:
+            yield job
+            continue
+        log.debug("Summary %s was charged before the last checkpoint",
+            job['dbid'])
+        if index:
+            index.record(charge)
+        skipped.append(job)
+
+
+def offset_job_ids(jobs, offset):
+    """
+    Give the jobs which are not charged incrementally the Gold job id of
+    their dbid plus offset.
+    """
+    for job in jobs:
+        if not job['incremental']:
+            job['gold_job_id'] = job['dbid'] + offset
+        yield job
+
+
+PROBE_SECTION_PREFIX = "probe:"
+
+def probe_configs(cp):
+    """
+    Return a list of (name, config) pairs, one per [probe:NAME] section.
+
+    Each config is a copy of cp where the options of the probe section
+    (at least "probe", optionally "machinename") override [gratia], and the
+    rollback log, txn file and lockfile get a ".NAME" suffix, so every probe
+    keeps its own state and can be synchronized independently.  The
+    [metrics] files get NAME inserted before their extension.
+    """
+    configs = []
+    for section in cp.sections():
+        if not section.startswith(PROBE_SECTION_PREFIX):
+            continue
+        name = section[len(PROBE_SECTION_PREFIX):]
+        probe_cp = state_config(cp, name)
+        for option, value in cp.items(section, raw=True):
+            probe_cp.set("gratia", option, value)
+        configs.append((name, probe_cp))
+    return configs
+
+
+SOURCE_SECTION_PREFIX = "source:"
 
+def source_configs(cp):
+    """
+    Return a list of (name, config) pairs, one per [source:NAME] section,
+    or, if there are [probe:PROBE] sections, one per probe of each source,
+    named NAME.PROBE.
+
+    A source is a Gratia database, such as a regional collector's.  The
+    options of its section (host, db, user, passwd, probe, machinename,
+    job_id_offset, ...) override [gratia], and it keeps its own state
+    files, as probes do (see state_config).  Each config also gets its
+    name as [gratia] source, which gives it a database connection of its
+    own.  The [metrics] files are left as they are: the sources are
+    synchronized together by fan_in, which keeps a single set of metrics.
+    """
+    configs = []
+    for section in cp.sections():
+        if not section.startswith(SOURCE_SECTION_PREFIX):
+            continue
+        name = section[len(SOURCE_SECTION_PREFIX):]
+        source_cp = state_config(cp, name)
+        for option, value in cp.items(section, raw=True):
+            source_cp.set("gratia", option, value)
+        probes = [("%s.%s" % (name, probe_name), probe_cp) for \
+            probe_name, probe_cp in probe_configs(source_cp)]
+        for source_name, config in probes or [(name, source_cp)]:
+            config.set("gratia", "source", source_name)
+            if cp.has_section("metrics"):
+                for option, value in cp.items("metrics", raw=True):
+                    config.set("metrics", option, value)
+            configs.append((source_name, config))
+    return configs
+
+
+def state_config(cp, name):
+    """
+    Return a copy of cp whose state files - the rollback log, txn file,
+    lockfile, charged-summary index and dead-letter file, when set - get a
+    ".NAME" suffix, and whose [metrics] files get NAME inserted before
+    their extension.
+    """
+    new_cp = ConfigParser.ConfigParser()
+    for section in cp.sections():
+        new_cp.add_section(section)
+        for option, value in cp.items(section, raw=True):
+            new_cp.set(section, option, value)
+    for option in ["rollback", "last_successful_id", "lockfile",
+            "charged_index", "dead_letter"]:
+        if not cp.has_option("transaction", option):
+            continue
+        new_cp.set("transaction", option, "%s.%s" % \
+            (cp.get("transaction", option, raw=True), name))
+    for option in ["prometheus", "json"]:
+        if not cp.has_option("metrics", option):
+            continue
+        # Keep the extension; the textfile collector wants ".prom".
+        base, ext = os.path.splitext(cp.get("metrics", option, raw=True))
+        new_cp.set("metrics", option, "%s.%s%s" % (base, name, ext))
+    return new_cp
+
+
+def run_forked(tasks, workers, finished=None, forward=False):
+    """
+    Run each (name, function) in tasks in its own forked child, with at most
+    `workers` children at a time.  Returns 0 if every function returned 0,
+    and 1 otherwise.  If given, finished(name, status) is called as each
+    child exits, with the child's exit status.
+
+    With forward set (for daemons), a SIGTERM or SIGINT received while the
+    children run is passed on to each of them, and no more children are
+    started; the children stop like a daemon does (see _stop), and are
+    waited for.
+    """
+    running = {}
+    tasks = list(tasks)
+    previous = {}
+    if forward:
+        def forward_signal(signum, frame):
+            _stop(signum, frame)
+            for pid in running.keys():
+                try:
+                    os.kill(pid, signum)
+                except OSError, oe:
+                    if oe.errno != errno.ESRCH:
+                        raise
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            previous[signum] = signal.signal(signum, forward_signal)
+    try:
+        status = _run_forked(tasks, workers, finished, forward, running)
+        if forward:
+            log_stop()
+        return status
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+
+def _run_forked(tasks, workers, finished, forward, running):
+    retval = 0
+    while (tasks and not stopping) or running:
+        while tasks and not stopping and len(running) < workers:
+            name, function = tasks.pop(0)
+            pid = os.fork()
+            if pid == 0:
+                if forward:
+                    signal.signal(signal.SIGTERM, _stop)
+                    signal.signal(signal.SIGINT, _stop)
+                logs.after_fork()
+                status = 1
+                try:
+                    try:
+                        status = function()
+                    except Exception, e:
+                        log.exception("Worker %s failed: %s" % (name, str(e)))
+                finally:
+                    gratia.close_connections()
+                    locking.close_and_unlink_lock()
+                    logs.stop()
+                    os._exit(status)
+            log.debug("Started worker %s (pid %i)" % (name, pid))
+            running[pid] = name
+            if forward and stopping:
+                # The signal came before the child was in running.
+                os.kill(pid, signal.SIGTERM)
+        if not running:
+            break
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except OSError, oe:
+            # Interrupted by a signal to forward.
+            if oe.errno == errno.EINTR:
+                continue
+            raise
+        if pid not in running:
+            continue
+        name = running.pop(pid)
+        if status:
+            if os.WIFEXITED(status):
+                status = os.WEXITSTATUS(status)
+            log.error("Worker %s failed with status %i" % (name, status))
+            retval = 1
+        else:
+            log.debug("Worker %s finished" % name)
+        if finished:
+            finished(name, status)
+    return retval
+
+
+def cron_sleep(opts):
+    """
+    When called from cron, sleep for a random part of the cron interval, so
+    that many hosts do not query Gratia at once.  Only called once there is
+    work to do: an idle run exits right away.
+    """
     if opts.cron > 0:
         random_sleep = random.randint(1, opts.cron)
         log.info("gratia-gold called from cron; sleeping for %d seconds." % \
             random_sleep)
         time.sleep(random_sleep)
 
+
+def main():
+    opts, args = parse_opts()
+    cp = ConfigParser.ConfigParser()
+    cp.read(opts.config)
+    config_logging(cp, opts)
+
+    profile = profiling.enabled(cp, opts)
+    sources = source_configs(cp)
+    probes = sources or probe_configs(cp)
+    if opts.backfill:
+        cron_sleep(opts)
+        if not probes:
+            return backfill(cp, profile)
+        retval = 0
+        for name, probe_cp in probes:
+            if backfill(probe_cp, profile, name):
+                retval = 1
+        return retval
+    if sources:
+        if not opts.daemon:
+            if held(cp):
+                return 0
+            sources = [(name, source_cp) for name, source_cp in sources \
+                if not source_idle(name, source_cp)]
+            # The sources are queried from threads with their own
+            # connections.
+            gratia.close_connections()
+            if not sources:
+                log.debug("Nothing new to charge.")
+                return 0
+        cron_sleep(opts)
+        if profile:
+            return profiling.run(cp, lambda: fan_in(cp, sources,
+                opts.daemon))
+        return fan_in(cp, sources, opts.daemon)
+    if not probes:
+        if not opts.daemon and held(cp):
+            return 0
+        if not opts.daemon and idle(cp):
+            log.debug("Nothing new to charge.")
+            return 0
+        cron_sleep(opts)
+        if profile:
+            return profiling.run(cp, lambda: sync(cp, opts.daemon))
+        return sync(cp, opts.daemon)
+
+    if not opts.daemon:
+        probes = [(name, probe_cp) for name, probe_cp in probes \
+            if not held(probe_cp) and not idle(probe_cp)]
+        # The workers open their own connections.
+        gratia.close_connections()
+        if not probes:
+            log.debug("Nothing new to charge.")
+            return 0
+    cron_sleep(opts)
+    try:
+        workers = cp.getint("gratia", "probe_workers")
+    except ConfigParser.Error:
+        workers = len(probes)
+    tasks = []
+    for name, probe_cp in probes:
+        tasks.append((name, sync_task(probe_cp, name, opts.daemon, profile)))
+    return run_forked(tasks, max(workers, 1), forward=opts.daemon)
+
+
+def held(cp):
+    """
+    Return True if a daemon or a backfill holds the lock of the probe in
+    cp; a run from cron then leaves it be, and exits quietly.
+    """
     lockfile = cp.get("transaction", "lockfile")
-    locking.exclusive_lock(lockfile)
+    pid = locking.persistent_holder(lockfile)
+    if pid:
+        log.debug("Process %i holds the lockfile %s; exiting." % (pid,
+            lockfile))
+        return True
+    return False
+
+
+def idle(cp):
+    """
+    Return True if a run for the probe in cp would have nothing to do, so
+    it can exit right away, before taking the lock and without writing
+    anything.
+
+    That is the case when the txn file exists, the rollback log is empty,
+    no window or backfill was left unfinished, the client-side aggregator
+    holds no summaries, no queued retry is due, and the probe has no
+    records at or past last_successful_id.  An unfinished backfill makes
+    the run go on to refuse to start (see check_backfill).
+    """
+    if not os.path.exists(cp.get("transaction", "last_successful_id")):
+        return False
+    try:
+        if os.path.getsize(cp.get("transaction", "rollback")):
+            return False
+    except OSError, oe:
+        if oe.errno != errno.ENOENT:
+            raise
+    txn = transaction.start_txn(cp)
+    if 'window_end' in txn or 'backfill' in txn:
+        return False
+    if txn.get('scanned_id', txn['last_successful_id']) != \
+            txn['last_successful_id']:
+        return False
+    now = time.time()
+    for entry in txn.get('retry') or []:
+        if entry['due'] <= now:
+            return False
+    return not gratia.has_records(cp, txn['last_successful_id'])
+
+
+def check_backfill(txn):
+    """
+    Refuse to synchronize normally while txn holds an unfinished backfill
+    plan: its shards may have charged records past last_successful_id,
+    which a normal run would charge again.  The backfill is resumed with
+    --backfill.
+    """
+    if 'backfill' in txn:
+        raise Exception("A backfill through DBID=%s is unfinished, with %i " \
+            "shards left; resume it with --backfill before a normal run." % \
+            (txn['backfill']['shards'][-1][1] - 1,
+            len(txn['backfill']['shards'])))
+
+
+def source_idle(name, cp):
+    """
+    idle(), for a source of a fan-in.  A source which cannot be checked -
+    its database is down - is not idle, so the fan-in reports its failure
+    while the other sources go on.
+    """
+    try:
+        return idle(cp)
+    except Exception, e:
+        log.warning("Unable to check source %s for new records: %s" % (name,
+            str(e)))
+        return False
+
+
+def sync_task(cp, name, daemon, profile):
+    """
+    Return a function synchronizing one probe in a forked worker.
+    """
+    if profile:
+        return lambda: profiling.run(cp, lambda: sync(cp, daemon), name)
+    return lambda: sync(cp, daemon)
+
+
+def sync(cp, daemon=False):
+    """
+    Synchronize the probe configured in cp from Gratia into Gold.
+
+    If daemon is set, keep running after catching up: poll Gratia for new
+    records every [daemon] poll_interval seconds, doubling the interval up
+    to [daemon] max_interval while there is nothing new.
+
+    Metrics for the run are written out at the end, and every [metrics]
+    interval seconds along the way.
+    """
+    metrics.reset(probe=cp.get("gratia", "probe"))
+    try:
+        return _sync(cp, daemon)
+    finally:
+        metrics.write(cp)
+
+
+def _sync(cp, daemon):
+    lockfile = cp.get("transaction", "lockfile")
+    # A daemon holds the lock for as long as it runs; the runs from cron
+    # leave it be.
+    locking.exclusive_lock(lockfile, persistent=daemon)
+    if daemon:
+        # Stop after the current window, even during the first catch-up.
+        signal.signal(signal.SIGTERM, _stop)
+        signal.signal(signal.SIGINT, _stop)
 
     gold.drop_privs(cp)
     gold.setup_env(cp)
+    check_backfill(transaction.start_txn(cp))
     
     # read min_dbid and max_dbid from the gratia database and
     # also save max(min_dbid, last_successful_id) into the file last_successful_id 
-    (min_dbid, max_dbid) = gratia.initialize_txn(cp)
+    (min_dbid, max_dbid) = metrics.timed("initialize", gratia.initialize_txn, cp)
     log.debug("min_dbid is "+ str(min_dbid) + " max_dbid is "+str(max_dbid))
     curr_txn = transaction.start_txn(cp)
     curr_txt_id = curr_txn['last_successful_id'] 
@@ -109,47 +563,1066 @@ def main():
     curr_dbid = min_dbid
 
     if (curr_txt_id < min_dbid):
-        curr_txt['last_successful_id'] = min_dbid
+        curr_txn['last_successful_id'] = min_dbid
     else:
         curr_dbid = curr_txt_id
 
     txn = curr_txn
     txn['last_successful_id'] = curr_dbid
-    while curr_dbid <=  max_dbid:
-
-        log.debug("Current transaction: probe=%(probename)s, DBID=%(last_successful_id)s" % txn)
-
-        roll_fd = transaction.check_rollback(cp)
-
-        jobs = gratia.query_gratia(cp, txn)
-        
-        for job in jobs:
-            log.debug("Processing job: %s" % str(job))
-
-        processed_jobs = {}
-        max_id = 0
-        job_count = 0
-        for job in jobs:
-            # Record the job into rollback log.  We write it in before we call
-            # gcharge - this way, if the script is killed unexpectedly, we'll
-            # refund the job.  So, this errs on the conservative side.
-            transaction.add_rollback(roll_fd, job)
-            status = gold.call_gcharge(job)
-            if status != 0:
-                #roll_fd.close()
-                transaction.check_rollback(cp)
+    window = gratia.Window(cp)
+    # Charges up to the last checkpoint within the interrupted window, if
+    # any, stay; the window is replayed over the same range, without them.
+    journal = transaction.check_rollback(cp,
+        committed=txn.get('journal_offset', 0))
+    index = summaries.open_index(cp)
+    aggregator = None
+    if get_aggregate_mode(cp) == "client":
+        aggregator = gratia.make_aggregator(cp, txn)
+    status, curr_dbid = sync_range(cp, txn, window, journal, index,
+        aggregator, curr_dbid, max_dbid)
+    if status == 0:
+        charge_retries(cp, txn, journal, index)
+    if not daemon:
+        if status == 0 and aggregator:
+            status = flush_aggregates(cp, txn, journal, index, aggregator)
+        return status
+
+    poll_interval, max_interval = poll_intervals(cp)
+    interval = poll_interval
+    while not stopping:
+        time.sleep(interval)
+        if stopping:
+            break
+        new_max_dbid = metrics.timed("poll", gratia.max_dbid, cp)
+        if status == 0:
+            charge_retries(cp, txn, journal, index)
+        if status == 0 and new_max_dbid <= max_dbid:
+            interval = min(interval * 2, max_interval)
+            continue
+        max_dbid = new_max_dbid
+        if status and aggregator:
+            # The failed window left the aggregator half-emitted; rebuild it
+            # from the last commit.
+            aggregator = gratia.make_aggregator(cp, txn)
+            curr_dbid = txn['last_successful_id']
+        status, curr_dbid = sync_range(cp, txn, window, journal, index,
+            aggregator, curr_dbid, max_dbid)
+        if status:
+            # Gold is failing; retry the window, but back off.
+            interval = min(interval * 2, max_interval)
+        else:
+            interval = poll_interval
+    if status == 0 and aggregator:
+        status = flush_aggregates(cp, txn, journal, index, aggregator)
+    log_stop()
+    log.info("Exiting daemon at DBID=%(last_successful_id)s" % txn)
+    return status
+
+
+def poll_intervals(cp):
+    """
+    Return the [daemon] poll_interval and max_interval, in seconds.
+    """
+    try:
+        poll_interval = cp.getfloat("daemon", "poll_interval")
+    except ConfigParser.Error:
+        poll_interval = 10
+    try:
+        max_interval = cp.getfloat("daemon", "max_interval")
+    except ConfigParser.Error:
+        max_interval = 300
+    return poll_interval, max_interval
+
+
+def get_aggregate_mode(cp):
+    """
+    Return where summaries are computed: "database" (the default), with a
+    GROUP BY per window, or "client", with gratia.Aggregator.
+    """
+    try:
+        mode = cp.get("gratia", "aggregate")
+    except ConfigParser.Error:
+        mode = "database"
+    if mode not in ["database", "client"]:
+        raise Exception("Unknown [gratia] aggregate mode: %s" % mode)
+    return mode
+
+
+# Set to the number of the signal asking the daemon to stop.
+stopping = False
+
+def _stop(signum, frame):
+    """
+    Signal handler for the daemon: finish the current window, then exit.
+
+    Nothing is logged here: the handler runs in whatever code the signal
+    interrupted, which may hold the lock of the log queue.  See
+    log_stop().
+    """
+    global stopping
+    stopping = signum
+
+
+def log_stop():
+    """
+    Log the signal which stopped the daemon, if any.
+    """
+    if stopping:
+        log.info("Received signal %i; stopping." % stopping)
+
+
+def sync_range(cp, txn, window, journal, index, aggregator, curr_dbid,
+        max_dbid):
+    """
+    Charge every job from curr_dbid up to max_dbid, one window at a time,
+    committing txn (and the charged-summary index, if any) after each
+    window.  If aggregator is given, windows are summarized through it
+    rather than in the database.
+
+    With [gratia] prefetch set, up to that many windows are queried ahead
+    in a background thread while the current one is charged; see
+    Prefetcher.
+
+    Returns 0 and the next dbid to scan on success.  If a charge fails,
+    the window is rolled back, txn is left as of the last commit, and 1 is
+    returned.
+    """
+    try:
+        depth = cp.getint("gratia", "prefetch")
+    except ConfigParser.Error:
+        depth = 0
+    if depth > 0:
+        return _sync_prefetched(cp, txn, window, journal, index, aggregator,
+            curr_dbid, max_dbid, depth)
+
+    # A window interrupted after a checkpoint is replayed over the same range.
+    window_end = txn.get('window_end')
+    while curr_dbid <=  max_dbid and not stopping:
+        scan = fetch_window(cp, window, aggregator, curr_dbid, max_dbid, False,
+            window_end)
+        window_end = None
+        statuses = charge_window(cp, txn, journal, index, scan)
+        if statuses is None:
+            return 1, curr_dbid
+        if 'rows' not in scan:
+            scan['rows'] = len(statuses)
+        advance_window(cp, window, aggregator, scan, max_dbid)
+        commit_window(cp, txn, journal, index, scan)
+        curr_dbid = scan['next_id']
+    return 0, curr_dbid
+
+
+def _sync_prefetched(cp, txn, window, journal, index, aggregator, curr_dbid,
+        max_dbid, depth):
+    """
+    sync_range, with the windows queried by a Prefetcher.
+    """
+    def scan_windows(curr_dbid, window_end):
+        while curr_dbid <= max_dbid and not stopping:
+            scan = fetch_window(cp, window, aggregator, curr_dbid, max_dbid,
+                True, window_end)
+            window_end = None
+            advance_window(cp, window, aggregator, scan, max_dbid)
+            yield scan
+            curr_dbid = scan['next_id']
+
+    # Windows already fetched are still charged after a stop signal, so that
+    # the aggregator never runs ahead of what has been committed.
+    prefetcher = Prefetcher(scan_windows(curr_dbid, txn.get('window_end')),
+        depth)
+    try:
+        for scan in prefetcher:
+            statuses = charge_window(cp, txn, journal, index, scan)
+            if statuses is None:
+                return 1, scan['start_id']
+            commit_window(cp, txn, journal, index, scan)
+            curr_dbid = scan['next_id']
+    finally:
+        prefetcher.close()
+    return 0, curr_dbid
+
+
+class Prefetcher(object):
+    """
+    Iterate over a generator from a background thread, holding at most
+    `depth` items ahead of the consumer.
+
+    The sync is pipelined with this: the generator queries and summarizes
+    windows (the only user of the Gratia connection while it runs) while
+    the main thread charges and commits the previous ones.  An exception in
+    the generator is re-raised to the consumer.  If given, cancelled is the
+    Event set by close(), which the generator may also wait on.
+    """
+
+    def __init__(self, generator, depth, cancelled=None):
+        self.queue = Queue.Queue(depth)
+        self.cancelled = cancelled or threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(generator,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self, generator):
+        try:
+            for item in generator:
+                if not self._put((True, item)):
+                    return
+        except Exception:
+            self._put((False, sys.exc_info()))
+            return
+        self._put(None)
+
+    def _put(self, item):
+        while not self.cancelled.isSet():
+            try:
+                self.queue.put(item, True, 0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            ok, value = item
+            if not ok:
+                raise value[0], value[1], value[2]
+            yield value
+
+    def close(self):
+        """
+        Stop the generator and wait for the thread to exit.
+        """
+        self.cancelled.set()
+        self.thread.join()
+
+
+def fetch_window(cp, window, aggregator, curr_dbid, max_dbid, materialize,
+        window_end=None):
+    """
+    Query the next window of jobs, starting at curr_dbid and ending at
+    window_end if given, or as sized by window otherwise.
+
+    Returns a dictionary with the window's start_id, end_id and jobs.  The
+    jobs are streamed from the database unless materialize is set (or they
+    come from the aggregator), in which case they are a list and the number
+    of rows scanned is also set.
+    """
+    log.debug("Current transaction: probe=%s, DBID=%i" % \
+        (cp.get("gratia", "probe"), curr_dbid))
+    end_id = curr_dbid + window.size
+    if window_end and window_end > curr_dbid:
+        end_id = window_end
+    end_id = min(end_id, max_dbid + 1)
+    scan = {'start_id': curr_dbid, 'end_id': end_id}
+    if aggregator:
+        scan['jobs'] = metrics.timed("query", gratia.summarize_gratia, cp,
+            curr_dbid, end_id, aggregator)
+        scan['rows'] = aggregator.rows
+    else:
+        jobs = metrics.timed_iter("query", gratia.query_gratia(cp,
+            curr_dbid, end_id))
+        if materialize:
+            jobs = list(jobs)
+            scan['rows'] = len(jobs)
+        scan['jobs'] = jobs
+    return scan
+
+
+def advance_window(cp, window, aggregator, scan, max_dbid):
+    """
+    Once a window's rows are known, resize the window and work out where
+    the next one starts (scan['next_id']) and the txn to commit with it.
+    """
+    window.resize(scan['rows'])
+
+    # Every job in [start_id, end_id) has been summarized.
+    next_id = scan['end_id']
+    if not scan['rows']:
+        # Nothing for our probe here; skip straight to its next record.
+        next_id = metrics.timed("skip", gratia.next_dbid, cp, next_id,
+            max_dbid)
+        if next_id is None:
+            next_id = max_dbid + 1
+        log.debug("No jobs in [%i, %i); skipping to DBID=%i" % \
+            (scan['start_id'], scan['end_id'], next_id))
+    scan['next_id'] = next_id
+
+    if aggregator:
+        # Summaries still held restart from their first record.
+        scan['txn'] = {'last_successful_id': aggregator.checkpoint(next_id),
+            'scanned_id': next_id,
+            'complete_through': aggregator.complete_through}
+    else:
+        scan['txn'] = {'last_successful_id': next_id}
+
+
+def charge_window(cp, txn, journal, index, scan):
+    """
+    Charge the jobs of a window, returning their statuses.
+
+    All the charges in the window are journaled.  With [transaction]
+    retry_attempts set, failed charges are queued in txn for retry and the
+    window goes on to be committed (see queue_failures).  Otherwise a
+    failure rolls back the whole window, so we must not move past it, and
+    None is returned.  The next attempt will start over from the last
+    commit.
+    """
+    checkpointer = transaction.make_checkpointer(cp, txn, journal,
+        scan['end_id'])
+    failed = []
+    statuses = charge_jobs(cp, journal, scan['jobs'], index, checkpointer,
+        failed)
+    count_charges(statuses)
+    if failed and not queue_failures(cp, txn, failed, len(statuses)):
+        rollback(cp, txn, journal, index)
+        log.error("Failed to charge %i of %i jobs; will retry from DBID=%s" \
+            "." % (len(failed), len(statuses), txn['last_successful_id']))
+        return None
+    return statuses
+
+
+def count_charges(statuses):
+    failed = len([i for i in statuses if i != 0])
+    metrics.count("summaries", len(statuses))
+    metrics.count("charges", len(statuses) - failed)
+    metrics.count("failures", failed)
+
+
+def queue_failures(cp, txn, failed, total):
+    """
+    Queue the (job, status) pairs of the failed charges among `total` for
+    retry, if enabled; returns False if they are not queued, in which case
+    the caller rolls back.
+
+    Retries are for the odd charge Gold rejects.  When more than one charge
+    and more than [transaction] retry_failure_ratio (default 0.5) of them
+    failed, Gold itself is taken to be failing, and nothing is queued:
+    moving past the window would only fill the queue with all of it.
+    Nothing is queued either if the queue would grow past [transaction]
+    retry_queue_size (default 1000) charges, as it is rewritten with every
+    commit of the txn.
+
+    The queue is only added to once the window's charges are done, so no
+    checkpoint can commit a job both to the queue and to the replay of its
+    window.
+    """
+    if not transaction.retry_attempts(cp):
+        return False
+    if len(failed) > 1 and \
+            len(failed) > total * transaction.retry_failure_ratio(cp):
+        log.error("%i of %i charges failed; not queueing them for retry." \
+            % (len(failed), total))
+        return False
+    queued = len(txn.get('retry') or [])
+    if queued + len(failed) > transaction.retry_queue_size(cp):
+        log.error("The retry queue already holds %i charges; not queueing " \
+            "%i more." % (queued, len(failed)))
+        return False
+    for job, status in failed:
+        transaction.queue_retry(cp, txn, job,
+            unknown=(status == gold.UNKNOWN))
+    return True
+
+
+def charge_retries(cp, txn, journal, index):
+    """
+    Retry the queued charges which are due, then commit.  Charges failing
+    again are queued with a longer delay, or given up on.
+    """
+    if 'window_end' in txn:
+        # The journal holds a checkpointed window, to be replayed first.
+        return
+    due = transaction.due_retries(txn)
+    if not due:
+        return
+    for entries in retry_rounds(due, index):
+        _charge_retries(cp, txn, journal, index, entries)
+
+
+def retry_rounds(due, index):
+    """
+    Split the due retries into rounds with at most one retry per group.
+    A retry is charged against its group's totals in the index as they are
+    when it is prepared, so a second retry for the group must wait until
+    the first has been recorded.
+    """
+    if not index:
+        return [due]
+    rounds = []
+    counts = {}
+    for entry in due:
+        key = summaries.group_key(entry['job'])
+        count = counts.get(key, 0)
+        counts[key] = count + 1
+        if count == len(rounds):
+            rounds.append([])
+        rounds[count].append(entry)
+    return rounds
+
+
+def _charge_retries(cp, txn, journal, index, due):
+    attempts = {}
+    jobs = []
+    for entry in due:
+        job = entry['job']
+        if entry.get('unknown'):
+            # Gold may have made the charge without answering; undo it, as
+            # a rollback would, before charging it again.  If the refund
+            # fails, the charge may still be in Gold; it is retried later.
+            if metrics.timed("refund", gold.refund, cp, job):
+                transaction.queue_retry(cp, txn, job, entry['attempts'],
+                    True)
                 continue
-            job_count += 1
+            metrics.count("refunds")
+        if index:
+            job = index.prepare_retry(job)
+        attempts[id(job)] = entry['attempts']
+        jobs.append(job)
+    failed = []
+    statuses = charge_jobs(cp, journal, jobs, index, failed=failed,
+        retry=True)
+    metrics.count("retries", len(statuses))
+    metrics.count("charges", len(statuses) - len(failed))
+    metrics.count("failures", len(failed))
+    for job, status in failed:
+        transaction.queue_retry(cp, txn, job, attempts[id(job)],
+            status == gold.UNKNOWN)
+    log.info("Retried %i charges; %i failed again." % (len(jobs),
+        len(failed)))
+    commit(cp, txn, journal, index)
 
-            # Keep track of the max ID
-            if job['dbid'] > max_id:
-                max_id = job['dbid']+1
 
-        if job_count == 0:
-            max_id = txn['last_successful_id'] + gratia.MAX_ID
+def commit_window(cp, txn, journal, index, scan):
+    """
+    Commit a window which has been fully charged.
+    """
+    metrics.count("rows", scan['rows'])
+    txn.update(scan['txn'])
+    for key in ['journal_offset', 'window_end']:
+        txn.pop(key, None)
+    commit(cp, txn, journal, index)
+    charge_retries(cp, txn, journal, index)
+    metrics.maybe_write(cp)
+    profiling.sample(scan['next_id'])
 
-        txn['last_successful_id'] = max_id
-        transaction.commit_txn(cp, txn)
-        curr_dbid = max_id
+
+def commit(cp, txn, journal, index):
+    """
+    Commit a window whose charges all succeeded.
+    """
+    transaction.commit_txn(cp, txn)
+    # The index goes second: if we die in between, a later summary for one
+    # of these groups is charged as a new Gold job rather than incrementally,
+    # but nothing is charged twice.
+    if index:
+        index.commit()
+    # The window is committed; its charges must not be refunded by the
+    # next call to check_rollback.
+    journal.reset()
+
+
+def rollback(cp, txn, journal, index):
+    """
+    Refund the charges of a window which could not be completed, back to
+    its last checkpoint.
+    """
+    if index:
+        index.rollback()
+    transaction.check_rollback(cp, journal, txn.get('journal_offset', 0))
+
+
+def flush_aggregates(cp, txn, journal, index, aggregator):
+    """
+    At the end of a run, charge every summary the aggregator still holds
+    and move the checkpoint up to the end of the scan.
+    """
+    jobs = aggregator.flush()
+    if not jobs:
+        return 0
+    failed = []
+    statuses = charge_jobs(cp, journal, jobs, index, failed=failed)
+    count_charges(statuses)
+    if failed and not queue_failures(cp, txn, failed, len(statuses)):
+        rollback(cp, txn, journal, index)
+        log.error("Failed to charge %i of %i held summaries; will retry from" \
+            " DBID=%s." % (len(failed), len(jobs), txn['last_successful_id']))
+        return 1
+    txn['last_successful_id'] = txn['scanned_id']
+    txn['complete_through'] = aggregator.complete_through
+    commit(cp, txn, journal, index)
+    charge_retries(cp, txn, journal, index)
     return 0
 
+
+def backfill(cp, profile=False, name=None):
+    """
+    Catch the probe configured in cp up to the current end of the Gratia
+    database in parallel.
+
+    The dbids left to synchronize are split into [backfill] shards ranges
+    (default: 4 per worker), which are synchronized by up to [backfill]
+    workers forked processes at a time (default: one per CPU).  Each shard
+    is synchronized like a normal run, over its own range, and keeps its
+    own rollback log, txn file, checkpoints and charged-summary index (see
+    shard_config).  As shards finish, the coordinator merges them, in
+    order, into the global txn file: last_successful_id only moves past a
+    shard once it and every shard below it are complete.
+
+    The plan is kept in the global txn file, so an interrupted backfill
+    picks up where it left off when run again.  Returns 0 once every shard
+    has been merged.
+    """
+    lockfile = cp.get("transaction", "lockfile")
+    # Held until every shard is merged, which may take longer than the lock
+    # timeout of the runs from cron.
+    locking.exclusive_lock(lockfile, persistent=True)
+
+    gold.drop_privs(cp)
+    gold.setup_env(cp)
+
+    min_dbid, max_dbid = gratia.initialize_txn(cp)
+    txn = transaction.start_txn(cp)
+    journal = transaction.check_rollback(cp,
+        committed=txn.get('journal_offset', 0))
+    journal.close()
+    if 'window_end' in txn:
+        raise Exception("The last run was interrupted partway through the " \
+            "window ending at DBID=%s; finish it with a normal run before " \
+            "backfilling." % txn['window_end'])
+    # The shards use their own connections, to Gratia and Gold.
+    gratia.close_connections()
+    gold.close_backend()
+
+    try:
+        workers = cp.getint("backfill", "workers")
+    except ConfigParser.Error:
+        workers = cpu_count()
+    workers = max(workers, 1)
+    plan = txn.get('backfill')
+    if not plan:
+        if txn['last_successful_id'] > max_dbid:
+            log.info("Nothing to backfill; synchronized through DBID=%s." % \
+                max_dbid)
+            return 0
+        try:
+            shards = cp.getint("backfill", "shards")
+        except ConfigParser.Error:
+            shards = 4 * workers
+        plan = plan_backfill(txn, max_dbid, max(shards, 1))
+        txn['backfill'] = plan
+        transaction.commit_txn(cp, txn)
+        log.info("Backfilling DBID=%s through DBID=%s in %i shards." % \
+            (txn['last_successful_id'], max_dbid, len(plan['shards'])))
+    else:
+        log.info("Resuming backfill with %i shards left." % \
+            len(plan['shards']))
+
+    try:
+        index_path = cp.get("transaction", "charged_index")
+    except ConfigParser.Error:
+        index_path = None
+    tasks = []
+    shard_ids = {}
+    for start_id, end_id in plan['shards']:
+        shard_cp = shard_config(cp, start_id)
+        shard_name = "shard%i" % start_id
+        if name:
+            shard_name = "%s-%s" % (name, shard_name)
+        shard_ids[shard_name] = start_id
+        tasks.append((shard_name, shard_task(shard_cp, plan, start_id, end_id,
+            shard_name, profile, index_path)))
+    # A shard is only merged once its worker has exited: it goes on to
+    # retry its failed charges after reaching the end of its range.  A
+    # worker which failed may have left charges to refund in the shard's
+    # rollback log, so its shard waits for the next backfill.
+    exited = {}
+    def finished(shard_name, status):
+        if status == 0:
+            exited[shard_ids[shard_name]] = True
+        merge_shards(cp, txn, exited)
+    status = run_forked(tasks, workers, finished)
+    if 'backfill' in txn:
+        log.error("Backfill stopped with %i shards left; run it again to " \
+            "resume." % len(txn['backfill']['shards']))
+        return 1
+    return status
+
+
+def cpu_count():
+    """
+    Return the number of online CPUs, or 1 if it cannot be determined.
+    """
+    try:
+        return max(int(os.sysconf("SC_NPROCESSORS_ONLN")), 1)
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+
+def plan_backfill(txn, max_dbid, shards):
+    """
+    Split the dbids from txn's last_successful_id through max_dbid into
+    shards ranges [start_id, end_id).
+
+    The plan also records the aggregator state of txn, if any, for every
+    shard to start from, and an id telling its shards' txn files apart
+    from those of earlier backfills.
+    """
+    start_id = txn['last_successful_id']
+    size = max((max_dbid + 1 - start_id + shards - 1) / shards, 1)
+    ranges = []
+    while start_id <= max_dbid:
+        end_id = min(start_id + size, max_dbid + 1)
+        ranges.append([start_id, end_id])
+        start_id = end_id
+    plan = {'id': "%i.%i" % (time.time(), os.getpid()), 'shards': ranges}
+    for key in ['scanned_id', 'complete_through']:
+        if key in txn:
+            plan[key] = txn[key]
+    return plan
+
+
+def shard_config(cp, start_id):
+    """
+    Return the config for the backfill shard starting at start_id: a copy
+    of cp whose state files get a ".shardSTART_ID" suffix.  Charges given
+    up on still go to the probe's dead-letter file.
+    """
+    shard_cp = state_config(cp, "shard%i" % start_id)
+    shard_cp.set("transaction", "dead_letter",
+        transaction.dead_letter_path(cp))
+    return shard_cp
+
+
+def shard_task(cp, plan, start_id, end_id, name, profile, seed=None):
+    """
+    Return a function synchronizing one backfill shard in a forked worker.
+    """
+    if profile:
+        return lambda: profiling.run(cp, lambda: sync_shard(cp, plan,
+            start_id, end_id, seed), name)
+    return lambda: sync_shard(cp, plan, start_id, end_id, seed)
+
+
+def sync_shard(cp, plan, start_id, end_id, seed=None):
+    """
+    Synchronize the dbids in [start_id, end_id) for a backfill shard,
+    resuming from the shard's txn file if it belongs to this plan.
+
+    A new shard starts with an empty charged-summary index, except for the
+    first shard left in the plan, whose index is seeded from the global
+    one at seed: it charges groups already in Gold incrementally, as a
+    normal run would.  The other shards charge their groups as new Gold
+    jobs.  Two shards never charge the same Gold job, as rolling back an
+    incremental charge restores the job to the totals its shard saw, which
+    would drop the charges of the other.
+    """
+    metrics.reset(probe=cp.get("gratia", "probe"), shard=str(start_id))
+    try:
+        return _sync_shard(cp, plan, start_id, end_id, seed)
+    finally:
+        metrics.write(cp)
+
+
+def _sync_shard(cp, plan, start_id, end_id, seed):
+    locking.exclusive_lock(cp.get("transaction", "lockfile"))
+    txn = transaction.start_txn(cp)
+    if txn.get('backfill') != plan['id']:
+        # A new shard, or a leftover from an earlier backfill.
+        if start_id != plan['shards'][0][0]:
+            seed = None
+        seed_index(cp, seed)
+        txn = {'probename': cp.get("gratia", "probe"),
+            'last_successful_id': start_id, 'backfill': plan['id']}
+        for key in ['scanned_id', 'complete_through']:
+            if key in plan:
+                txn[key] = plan[key]
+        transaction.commit_txn(cp, txn)
+    # A complete shard may have been stopped while retrying charges; they
+    # are refunded, and stay queued for the coordinator to take over.
+    journal = transaction.check_rollback(cp,
+        committed=txn.get('journal_offset', 0))
+    if shard_complete(txn, plan, end_id):
+        journal.close()
+        return 0
+
+    index = summaries.open_index(cp)
+    aggregator = None
+    if get_aggregate_mode(cp) == "client":
+        aggregator = gratia.make_aggregator(cp, txn)
+    status, curr_dbid = sync_range(cp, txn, gratia.Window(cp), journal,
+        index, aggregator, txn['last_successful_id'], end_id - 1)
+    if status == 0:
+        charge_retries(cp, txn, journal, index)
+    if status == 0 and aggregator:
+        status = flush_aggregates(cp, txn, journal, index, aggregator)
+    return status
+
+
+def seed_index(cp, seed):
+    """
+    Replace the charged-summary index of cp, if any, with a copy of the
+    index at seed, or with an empty one if seed is None or missing.
+    """
+    index = summaries.open_index(cp)
+    if not index:
+        return
+    try:
+        index.conn.execute("DELETE FROM charged")
+        if seed and os.path.exists(seed):
+            index.merge(seed)
+        index.commit()
+    finally:
+        index.close()
+
+
+def shard_complete(shard_txn, plan, end_id):
+    """
+    Return True if a shard's txn shows it synchronized through end_id.
+    """
+    return shard_txn.get('backfill') == plan['id'] and \
+        shard_txn['last_successful_id'] >= end_id and \
+        'window_end' not in shard_txn
+
+
+def merge_shards(cp, txn, exited):
+    """
+    Merge the complete shards at the front of the backfill plan in txn into
+    the global state, in order, committing txn after each.  Only shards
+    whose start_id is in exited (those whose workers have exited
+    successfully) are considered.
+
+    The shard's charged-summary index entries are merged into the global
+    index first (an entry from the seeded shard replaces the global one
+    for the same Gold job; see sync_shard), so a crash before the txn
+    commit only makes the merge repeat.
+    The shard's queued retries move into txn.  Once committed, the shard's
+    state files are removed.
+    """
+    plan = txn.get('backfill')
+    while plan and plan['shards']:
+        start_id, end_id = plan['shards'][0]
+        if start_id not in exited:
+            break
+        shard_cp = shard_config(cp, start_id)
+        shard_txn = transaction.start_txn(shard_cp)
+        if not shard_complete(shard_txn, plan, end_id):
+            break
+        try:
+            index_path = shard_cp.get("transaction", "charged_index")
+        except ConfigParser.Error:
+            index_path = None
+        if index_path and os.path.exists(index_path):
+            index = summaries.open_index(cp)
+            try:
+                index.merge(index_path)
+                index.commit()
+            finally:
+                index.close()
+        txn['last_successful_id'] = end_id
+        for key in ['scanned_id', 'complete_through']:
+            if key in shard_txn:
+                txn[key] = shard_txn[key]
+        if shard_txn.get('retry'):
+            txn.setdefault('retry', []).extend(shard_txn['retry'])
+        plan['shards'].pop(0)
+        if not plan['shards']:
+            del txn['backfill']
+        transaction.commit_txn(cp, txn)
+        log.info("Backfill is complete through DBID=%i." % (end_id - 1))
+        rollback_path = shard_cp.get("transaction", "rollback")
+        for path in [shard_cp.get("transaction", "last_successful_id"),
+                rollback_path, "%s.refund" % rollback_path, index_path]:
+            if not path:
+                continue
+            try:
+                os.unlink(path)
+            except OSError, oe:
+                if oe.errno != errno.ENOENT:
+                    raise
+
+
+def fan_in(cp, sources, daemon=False):
+    """
+    Synchronize several Gratia sources (see source_configs) into Gold
+    together.
+
+    Each source is queried from a thread of its own, with its own
+    connection, up to [gratia] prefetch windows (default 1) ahead; see
+    Source.  Their windows all go through one charging stage, in this
+    thread, through the one Gold backend.  The stage takes the sources in
+    turn, charging and committing one window from each source which has
+    one ready, so a source with a lot to catch up on does not starve the
+    others, and a slow or failing source holds no one up: it is passed
+    over until its next window is ready.
+
+    If daemon is set, each source polls its own database for new records,
+    backing off as sync() does, and a source whose charges fail (or whose
+    database is down) is started again from its last commit after a while.
+    Returns 0 if every source was synchronized.
+    """
+    metrics.reset(sources=",".join([name for name, source_cp in sources]))
+    try:
+        return _fan_in(cp, sources, daemon)
+    finally:
+        metrics.write(cp)
+
+
+def _fan_in(cp, sources, daemon):
+    lockfile = cp.get("transaction", "lockfile")
+    locking.exclusive_lock(lockfile, persistent=daemon)
+
+    gold.drop_privs(cp)
+    gold.setup_env(cp)
+    if daemon:
+        signal.signal(signal.SIGTERM, _stop)
+        signal.signal(signal.SIGINT, _stop)
+
+    # Set by the sources' threads whenever they have a window ready.
+    ready = threading.Event()
+    sources = [Source(name, source_cp, daemon, ready) for name, source_cp \
+        in sources]
+    retval = 0
+    try:
+        active = list(sources)
+        while active:
+            ready.clear()
+            busy = False
+            for source in active[:]:
+                if source.step():
+                    busy = True
+                if source.finished:
+                    active.remove(source)
+                    if source.status:
+                        retval = 1
+            if active and not busy:
+                ready.wait(1)
+        log_stop()
+    finally:
+        for source in sources:
+            source.close()
+    return retval
+
+
+class SourceFetcher(Prefetcher):
+    """
+    A Prefetcher which can be polled without waiting, and which sets the
+    `ready` Event whenever it has queued an item.
+    """
+
+    def __init__(self, generator, depth, ready, cancelled=None):
+        self.ready = ready
+        self.exhausted = False
+        Prefetcher.__init__(self, generator, depth, cancelled)
+
+    def _put(self, item):
+        if not Prefetcher._put(self, item):
+            return False
+        self.ready.set()
+        return True
+
+    def poll(self):
+        """
+        Return the next item if one is ready, and None otherwise.  Once the
+        generator is exhausted, exhausted is set.  An exception in the
+        generator is re-raised.
+        """
+        try:
+            item = self.queue.get_nowait()
+        except Queue.Empty:
+            return None
+        if item is None:
+            self.exhausted = True
+            return None
+        ok, value = item
+        if not ok:
+            raise value[0], value[1], value[2]
+        return value
+
+
+class Source(object):
+    """
+    One source of a fan-in: its txn, rollback log, charged-summary index
+    and aggregator, and the SourceFetcher querying its windows.
+
+    The thread of the fetcher is the only one using the source's database
+    connection.  It starts by initializing the txn, which it hands over,
+    with the aggregator, as its first item; from then on the txn, the
+    journal and the index are only used by the charging stage, in step().
+    """
+
+    def __init__(self, name, cp, daemon, ready):
+        self.name = name
+        self.cp = cp
+        self.daemon = daemon
+        self.ready = ready
+        try:
+            self.depth = max(cp.getint("gratia", "prefetch"), 1)
+        except ConfigParser.Error:
+            self.depth = 1
+        self.poll_interval, self.max_interval = poll_intervals(cp)
+        self.interval = self.poll_interval
+        self.window = gratia.Window(cp)
+        self.txn = None
+        self.journal = None
+        self.index = None
+        self.aggregator = None
+        self.status = 0
+        self.finished = False
+        self.fetcher = None
+        # A fetcher given up on, whose thread may still be querying.
+        self.stopped = None
+        self.restart_at = 0
+        self.start()
+
+    def start(self):
+        """
+        Start querying the source: from scratch the first time, and from
+        the last commit after a failure.
+        """
+        cancelled = threading.Event()
+        if self.txn is None:
+            windows = self.scan(cancelled)
+        else:
+            aggregator = None
+            if get_aggregate_mode(self.cp) == "client":
+                aggregator = gratia.make_aggregator(self.cp, self.txn)
+            self.aggregator = aggregator
+            windows = self.scan(cancelled, self.txn['last_successful_id'],
+                self.txn.get('window_end'), aggregator)
+        self.fetcher = SourceFetcher(windows, self.depth, self.ready,
+            cancelled)
+
+    def scan(self, cancelled, curr_dbid=None, window_end=None,
+            aggregator=None):
+        """
+        Generate the windows of the source, starting at curr_dbid, or, if
+        it is None, by initializing the txn and handing it over.  If
+        daemon is set, keep polling for new records until stopped.
+        """
+        cp = self.cp
+        if curr_dbid is None:
+            min_dbid, max_dbid = metrics.timed("initialize",
+                gratia.initialize_txn, cp)
+            txn = transaction.start_txn(cp)
+            check_backfill(txn)
+            curr_dbid = max(txn['last_successful_id'], min_dbid)
+            txn['last_successful_id'] = curr_dbid
+            window_end = txn.get('window_end')
+            if get_aggregate_mode(cp) == "client":
+                aggregator = gratia.make_aggregator(cp, txn)
+            yield {'start_txn': txn, 'aggregator': aggregator}
+        else:
+            max_dbid = metrics.timed("poll", gratia.max_dbid, cp)
+        interval = self.poll_interval
+        while not stopping:
+            while curr_dbid <= max_dbid and not stopping:
+                scan = fetch_window(cp, self.window, aggregator, curr_dbid,
+                    max_dbid, True, window_end)
+                window_end = None
+                advance_window(cp, self.window, aggregator, scan, max_dbid)
+                yield scan
+                curr_dbid = scan['next_id']
+            if not self.daemon:
+                return
+            deadline = time.time() + interval
+            while not stopping and not cancelled.isSet() and \
+                    time.time() < deadline:
+                cancelled.wait(min(deadline - time.time(), 1))
+            if stopping or cancelled.isSet():
+                return
+            new_max_dbid = metrics.timed("poll", gratia.max_dbid, cp)
+            if new_max_dbid <= max_dbid:
+                interval = min(interval * 2, self.max_interval)
+                continue
+            max_dbid = new_max_dbid
+            interval = self.poll_interval
+
+    def step(self):
+        """
+        Do the next piece of work for the source in the charging stage:
+        charge and commit a window, if one is ready.  Returns True if
+        there was something to do.
+        """
+        if self.fetcher is None:
+            return self._restart()
+        try:
+            item = self.fetcher.poll()
+        except Exception, e:
+            log.exception("Source %s failed: %s" % (self.name, str(e)))
+            self._fail()
+            return True
+        if self.fetcher.exhausted:
+            self._finish()
+            return True
+        if item is None:
+            if self.txn is not None:
+                # Nothing new from the source; its retries may be due.
+                charge_retries(self.cp, self.txn, self.journal, self.index)
+            return False
+        if 'start_txn' in item:
+            self.txn = item['start_txn']
+            self.aggregator = item['aggregator']
+            self.journal = transaction.check_rollback(self.cp,
+                committed=self.txn.get('journal_offset', 0))
+            self.index = summaries.open_index(self.cp)
+            return True
+        statuses = charge_window(self.cp, self.txn, self.journal, self.index,
+            item)
+        if statuses is None:
+            self._fail()
+            return True
+        commit_window(self.cp, self.txn, self.journal, self.index, item)
+        self.status = 0
+        self.interval = self.poll_interval
+        return True
+
+    def _fail(self):
+        """
+        Give up on the windows queried ahead of a failure.  A daemon starts
+        again from the last commit once it has backed off.
+        """
+        self.status = 1
+        self.fetcher.cancelled.set()
+        self.stopped = self.fetcher
+        self.fetcher = None
+        if not self.daemon or stopping:
+            self.finished = True
+            return
+        log.info("Restarting source %s in %s seconds." % (self.name,
+            self.interval))
+        self.restart_at = time.time() + self.interval
+        self.interval = min(self.interval * 2, self.max_interval)
+
+    def _restart(self):
+        if stopping:
+            self.finished = True
+            return True
+        # The old thread must be done with the connection first.
+        if time.time() < self.restart_at or self.stopped.thread.isAlive():
+            return False
+        self.stopped = None
+        self.start()
+        return True
+
+    def _finish(self):
+        """
+        At the end of the source's windows, charge its due retries and the
+        summaries its aggregator still holds.
+        """
+        self.finished = True
+        if self.txn is None:
+            return
+        if self.daemon:
+            log.info("Stopping source %s at DBID=%s." % (self.name,
+                self.txn['last_successful_id']))
+        charge_retries(self.cp, self.txn, self.journal, self.index)
+        if self.status == 0 and self.aggregator:
+            self.status = flush_aggregates(self.cp, self.txn, self.journal,
+                self.index, self.aggregator)
+
+    def close(self):
+        for fetcher in [self.fetcher, self.stopped]:
+            if fetcher:
+                fetcher.close()
@@ -0,0 +1,212 @@
+
+"""
+Module for recording where a run spends its time.
+
+Keeps counters, and latency histograms for each phase of a sync (querying
+Gratia, journaling, charging, refunding, ...), and writes them out as a
+Prometheus textfile-collector file and/or a JSON stats file.
+"""
+
+import time
+import logging
+import threading
+import ConfigParser
+
+log = logging.getLogger("gratia_gold.metrics")
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+# Counters whose rate per second of run time is reported.
+RATES = ("rows", "summaries", "charges")
+
+class Phase(object):
+    """
+    Count, total time and latency histogram of one phase.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        for idx in range(len(BUCKETS)):
+            if seconds <= BUCKETS[idx]:
+                self.buckets[idx] += 1
+
+started = time.time()
+phases = {}
+counters = {}
+labels = {}
+last_write = started
+# Windows are queried from other threads (see main.Prefetcher) while
+# charges are observed.
+lock = threading.Lock()
+
+def reset(**new_labels):
+    """
+    Start a fresh set of metrics, labeled with new_labels.
+    """
+    global started, last_write
+    started = time.time()
+    last_write = started
+    phases.clear()
+    counters.clear()
+    labels.clear()
+    labels.update(new_labels)
+
+def observe(phase, seconds):
+    """
+    Record one occurrence of phase taking `seconds`.
+    """
+    lock.acquire()
+    try:
+        if phase not in phases:
+            phases[phase] = Phase()
+        phases[phase].observe(seconds)
+    finally:
+        lock.release()
+
+def count(name, n=1):
+    lock.acquire()
+    try:
+        counters[name] = counters.get(name, 0) + n
+    finally:
+        lock.release()
+
+def timed(phase, function, *args, **kw):
+    """
+    Call function, recording its run time under phase.
+    """
+    start = time.time()
+    try:
+        return function(*args, **kw)
+    finally:
+        observe(phase, time.time() - start)
+
+def timed_iter(phase, iterable):
+    """
+    Iterate through iterable, recording the time spent producing its items,
+    from the first fetch until it is exhausted, as one occurrence of phase.
+    Used to time streaming queries, whose work happens as they are
+    consumed; the time the consumer spends between items is left out, so a
+    window's query is timed like a query run with timed().
+    """
+    iterator = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = iterator.next()
+            finally:
+                elapsed += time.time() - start
+            yield item
+    except StopIteration:
+        observe(phase, elapsed)
+
+def stats():
+    """
+    Return the current metrics as a dictionary.
+    """
+    elapsed = time.time() - started
+    result = {'labels': dict(labels), 'elapsed': elapsed,
+        'counters': dict(counters), 'rates': {}, 'phases': {}}
+    for name in RATES:
+        if elapsed > 0:
+            result['rates'][name] = counters.get(name, 0) / elapsed
+    for name, phase in phases.items():
+        result['phases'][name] = {'count': phase.count, 'total': phase.total,
+            'buckets': dict(zip([str(i) for i in BUCKETS], phase.buckets))}
+    return result
+
+def _label_str(extra=None):
+    items = labels.items()
+    if extra:
+        items = items + extra
+    if not items:
+        return ""
+    items.sort()
+    parts = []
+    for name, value in items:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        parts.append('%s="%s"' % (name, value))
+    return "{%s}" % ",".join(parts)
+
+def prometheus():
+    """
+    Return the current metrics in the Prometheus text exposition format.
+    """
+    data = stats()
+    lines = []
+    lines.append("# TYPE gratia_gold_run_seconds gauge")
+    lines.append("gratia_gold_run_seconds%s %f" % (_label_str(),
+        data['elapsed']))
+    lines.append("# TYPE gratia_gold_last_write_timestamp gauge")
+    lines.append("gratia_gold_last_write_timestamp%s %f" % (_label_str(),
+        time.time()))
+    names = counters.keys()
+    names.sort()
+    for name in names:
+        lines.append("# TYPE gratia_gold_%s_total counter" % name)
+        lines.append("gratia_gold_%s_total%s %d" % (name, _label_str(),
+            counters[name]))
+    for name in RATES:
+        if name in data['rates']:
+            lines.append("# TYPE gratia_gold_%s_per_second gauge" % name)
+            lines.append("gratia_gold_%s_per_second%s %f" % (name,
+                _label_str(), data['rates'][name]))
+    names = phases.keys()
+    names.sort()
+    if names:
+        lines.append("# TYPE gratia_gold_phase_seconds histogram")
+    for name in names:
+        phase = phases[name]
+        for bound, value in zip(BUCKETS, phase.buckets):
+            lines.append("gratia_gold_phase_seconds_bucket%s %d" % \
+                (_label_str([("phase", name), ("le", str(bound))]), value))
+        lines.append("gratia_gold_phase_seconds_bucket%s %d" % \
+            (_label_str([("phase", name), ("le", "+Inf")]), phase.count))
+        lines.append("gratia_gold_phase_seconds_sum%s %f" % \
+            (_label_str([("phase", name)]), phase.total))
+        lines.append("gratia_gold_phase_seconds_count%s %d" % \
+            (_label_str([("phase", name)]), phase.count))
+    lines.append("")
+    return "\n".join(lines)
+
+def write(cp):
+    """
+    Write the metrics to the [metrics] prometheus and json files, if set.
+    Files are replaced atomically, as the textfile collector requires.
+    """
+    import simplejson
+    # transaction imports this module.
+    import transaction
+    global last_write
+    last_write = time.time()
+    for option, render in [("prometheus", prometheus),
+            ("json", lambda: simplejson.dumps(stats(), indent=2))]:
+        try:
+            path = cp.get("metrics", option)
+        except ConfigParser.Error:
+            continue
+        try:
+            transaction._write_atomic(path, render())
+        except (IOError, OSError), e:
+            log.warning("Unable to write %s metrics to %s: %s" % (option,
+                path, str(e)))
+
+def maybe_write(cp):
+    """
+    Write the metrics if [metrics] interval seconds (default 60) have passed
+    since they were last written; for long runs.
+    """
+    try:
+        interval = cp.getfloat("metrics", "interval")
+    except ConfigParser.Error:
+        interval = 60
+    if time.time() - last_write >= interval:
+        write(cp)
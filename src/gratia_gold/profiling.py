@@ -0,0 +1,123 @@
+
+"""
+Optional profiling of a gratia-gold run.
+
+When enabled (with --profile, or "enabled=true" in the [profile] section),
+the sync is run under cProfile and the stats are dumped next to the log
+file, as gratia-gold-YYYYmmdd-HHMMSS.prof; load them with pstats.  Each
+forked probe worker profiles itself into its own gratia-gold-NAME-...
+file.  Forked Gold commands drop the profiler before they exec, so the
+stats only cover the sync itself.
+
+With "memory=true", the peak RSS and the number of live objects tracked by
+the garbage collector are also sampled after every window, into a ".memory"
+file alongside the stats.
+"""
+
+import gc
+import os
+import sys
+import time
+import logging
+import resource
+import ConfigParser
+
+log = logging.getLogger("gratia_gold.profiling")
+
+profiler = None
+path = None
+memory_log = None
+
+def enabled(cp, opts):
+    """
+    Return True if this run should be profiled.
+    """
+    if getattr(opts, "profile", False):
+        return True
+    try:
+        return cp.getboolean("profile", "enabled")
+    except ConfigParser.Error:
+        return False
+
+def start(cp, name=None):
+    """
+    Start profiling this process.  If name is given (a probe worker), it is
+    included in the dump's file name.
+    """
+    global profiler
+    global path
+    global memory_log
+    try:
+        directory = cp.get("profile", "directory")
+    except ConfigParser.Error:
+        directory = os.path.dirname(os.path.abspath(cp.get("logging",
+            "file")))
+    prefix = "gratia-gold"
+    if name:
+        prefix = "%s-%s" % (prefix, name)
+    path = os.path.join(directory, "%s-%s.prof" % (prefix,
+        time.strftime("%Y%m%d-%H%M%S")))
+    try:
+        memory = cp.getboolean("profile", "memory")
+    except ConfigParser.Error:
+        memory = False
+    if memory:
+        memory_log = open(path + ".memory", "w")
+        memory_log.write("# time peak_rss_kb gc_objects dbid\n")
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+def sample(dbid):
+    """
+    Record a memory sample after the window ending at dbid, if enabled.
+    """
+    if not memory_log:
+        return
+    memory_log.write("%.3f %i %i %s\n" % (time.time(),
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        len(gc.get_objects()), dbid))
+    memory_log.flush()
+
+def stop():
+    """
+    Stop profiling and write out the stats.
+    """
+    global profiler
+    global memory_log
+    if not profiler:
+        return
+    profiler.disable()
+    try:
+        profiler.dump_stats(path)
+        log.info("Wrote profile to %s" % path)
+    except (IOError, OSError), e:
+        log.error("Unable to write profile to %s: %s" % (path, str(e)))
+    profiler = None
+    if memory_log:
+        memory_log.close()
+        memory_log = None
+
+def detach():
+    """
+    Drop the profile inherited across a fork, without writing it out.
+    """
+    global profiler
+    global memory_log
+    if not profiler:
+        return
+    profiler.disable()
+    sys.setprofile(None)
+    profiler = None
+    if memory_log:
+        memory_log = None
+
+def run(cp, function, name=None):
+    """
+    Call function() under the profiler and return its result.
+    """
+    start(cp, name)
+    try:
+        return function()
+    finally:
+        stop()
@@ -0,0 +1,305 @@
+
+"""
+Reconcile what Gratia says should have been charged with what Gold holds.
+
+The charge totals of the synchronized records are computed per day,
+project and user in one aggregate query against Gratia, and compared with
+the totals charged: queried from the Gold server (over the native
+protocol; see gold.GoldClient), read from the charged-summary index, or
+read from an export file.  Only the (day, project, user) totals which
+differ are reported, with the amount left to charge (positive) or refund
+(negative).
+
+Gold is queried by machine, so the Gratia side then sums the records of
+every probe or source charging to the same machinename, each up to the
+last_successful_id of its own txn file.
+
+Each summary's charge is rounded when it is charged, so a total may be
+off by up to the tolerance once per summary making it up, or once per Gold
+job when a group was charged as several (by backfill shards).
+"""
+
+import sys
+import logging
+import optparse
+import ConfigParser
+from datetime import datetime, timedelta
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+import gold
+import main
+import gratia
+import transaction
+
+log = logging.getLogger("gratia_gold.reconcile")
+
+def parse_opts():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-c", "--config", dest="config",
+                      help="Location of the configuration file.",
+                      default="/etc/gratia-gold.cfg")
+    parser.add_option("-v", "--verbose", dest="verbose",
+                      default=False, action="store_true",
+                      help="Increase verbosity.")
+    parser.add_option("--probe", dest="probe",
+                      help="Reconcile the probe of this [probe:NAME] " \
+                      "section, or the source of this [source:NAME] one.")
+    parser.add_option("--start-id", dest="start_id", type="int", default=0,
+                      help="First Gratia dbid to include (default: all).")
+    parser.add_option("--end-id", dest="end_id", type="int",
+                      help="Include dbids below this one (default: the " \
+                      "last_successful_id of the txn file).")
+    parser.add_option("--from", dest="first_day",
+                      help="First EndTime day to include, as YYYY-MM-DD.")
+    parser.add_option("--to", dest="last_day",
+                      help="Last EndTime day to include, as YYYY-MM-DD.")
+    parser.add_option("--index", dest="index", default=None,
+                      help="Compare against this charged-summary index " \
+                      "instead of the Gold server.")
+    parser.add_option("--export", dest="export", default=None,
+                      help="Compare against this export, one \"day project " \
+                      "user charge\" line (tab-separated) per total.")
+    parser.add_option("--tolerance", dest="tolerance", type="float",
+                      default=1, help="Ignore differences up to this much " \
+                      "per summary in a total (default 1, for the rounding " \
+                      "of each summary).")
+    parser.add_option("-o", "--output", dest="output",
+                      help="Write the discrepancies here instead of stdout.")
+    parser.set_defaults(cron=0)
+
+    opts, args = parser.parse_args()
+    for day in [opts.first_day, opts.last_day]:
+        if day:
+            datetime.strptime(day, "%Y-%m-%d")
+    return opts, args
+
+
+def _key(day, project, user):
+    return (day, project or None, user or None)
+
+
+def _in_days(day, first_day, last_day):
+    return (not first_day or day >= first_day) and \
+        (not last_day or day <= last_day)
+
+
+def gold_totals(cp, first_day=None, last_day=None, counts=None):
+    """
+    Query the Gold server for the totals charged to the [gratia]
+    machinename, by (day, project, user).  The grouping is done by Gold.
+    If a dictionary is given as counts, the number of Gold jobs making up
+    each total is added to it.
+    """
+    client = gold.make_client(cp)
+    where = [("Machine", "EQ", cp.get("gratia", "machinename"))]
+    if first_day:
+        where.append(("EndTime", "GE", first_day))
+    if last_day:
+        where.append(("EndTime", "LT", (datetime.strptime(last_day,
+            "%Y-%m-%d") + timedelta(1)).strftime("%Y-%m-%d")))
+    body = gold.query_request(client.actor, "Job", [("EndTime", "GroupBy"),
+        ("Project", "GroupBy"), ("User", "GroupBy"), ("Charge", "Sum"),
+        ("Id", "Count")],
+        where)
+    try:
+        success, code, message, rows = client.send([body],
+            gold.parse_gold_data)[0]
+    finally:
+        client.close()
+    if not success:
+        raise Exception("Gold query failed: %s (code %s)" % (message, code))
+    totals = {}
+    for row in rows:
+        key = _key(row.get('EndTime', "")[:10], row.get('Project'),
+            row.get('User'))
+        totals[key] = totals.get(key, 0) + float(row.get('Charge') or 0)
+        if counts is not None:
+            counts[key] = counts.get(key, 0) + int(row.get('Id') or 0)
+    return totals
+
+
+def index_totals(path, first_day=None, last_day=None, counts=None):
+    """
+    Read the totals charged by (day, project, user) from a charged-summary
+    index (see summaries.ChargedIndex).  If a dictionary is given as counts,
+    the number of index entries (Gold jobs) making up each total is added
+    to it.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("SELECT group_key, charge FROM charged")
+        totals = {}
+        for group_key, charge in rows:
+            # See summaries.group_key for the layout.
+            parts = group_key.split("\x1f")
+            day, project, user = parts[5], parts[7], parts[2]
+            if day == "None" or not _in_days(day, first_day, last_day):
+                continue
+            key = _key(day, project != "None" and project, user != "None" \
+                and user)
+            totals[key] = totals.get(key, 0) + float(charge)
+            if counts is not None:
+                counts[key] = counts.get(key, 0) + 1
+        return totals
+    finally:
+        conn.close()
+
+
+def export_totals(path, first_day=None, last_day=None):
+    """
+    Read the totals charged by (day, project, user) from an export file:
+    tab-separated "day project user charge" lines, where "-" or an empty
+    field stands for no project or user.  Lines starting with "#" are
+    skipped, so a report of this module can be read back.
+    """
+    fd = open(path, "r")
+    try:
+        totals = {}
+        for line in fd:
+            if not line.strip() or line.startswith("#"):
+                continue
+            day, project, user, charge = line.rstrip("\r\n").split("\t")[:4]
+            if not _in_days(day, first_day, last_day):
+                continue
+            key = _key(day, project != "-" and project, user != "-" and user)
+            totals[key] = totals.get(key, 0) + float(charge)
+        return totals
+    finally:
+        fd.close()
+
+
+def discrepancies(expected, actual, tolerance=0, counts=None):
+    """
+    Compare two {(day, project, user): total} maps by merging their sorted
+    keys, yielding (key, expected total, actual total), in key order, for
+    every key whose totals differ by more than tolerance.  A key missing
+    from one side has a total of 0 there.
+
+    If counts maps a key to the number of summaries making up its totals,
+    the key's tolerance is that many times tolerance.
+    """
+    expected_keys = expected.keys()
+    expected_keys.sort()
+    actual_keys = actual.keys()
+    actual_keys.sort()
+    i = j = 0
+    while i < len(expected_keys) or j < len(actual_keys):
+        if j == len(actual_keys) or (i < len(expected_keys) and \
+                expected_keys[i] < actual_keys[j]):
+            key = expected_keys[i]
+            i += 1
+        elif i == len(expected_keys) or actual_keys[j] < expected_keys[i]:
+            key = actual_keys[j]
+            j += 1
+        else:
+            key = expected_keys[i]
+            i += 1
+            j += 1
+        total, charged = expected.get(key, 0), actual.get(key, 0)
+        allowed = tolerance
+        if counts:
+            allowed = tolerance * max(counts.get(key, 1), 1)
+        if abs(total - charged) > allowed:
+            yield key, total, charged
+
+
+def write_report(fd, rows):
+    """
+    Write the discrepancies as tab-separated "day project user gratia
+    charged difference" lines, returning their count and net difference.
+    """
+    fd.write("# day\tproject\tuser\tgratia\tcharged\tdifference\n")
+    count = 0
+    net = 0
+    for (day, project, user), total, charged in rows:
+        fd.write("%s\t%s\t%s\t%.2f\t%.2f\t%+.2f\n" % (day, project or "-",
+            user or "-", total, charged, total - charged))
+        count += 1
+        net += total - charged
+    return count, net
+
+
+def machine_configs(cp, machinename):
+    """
+    Return the configs synchronized by gratia-gold (see main.main) which
+    charge to machinename: one per [source:NAME] or [probe:NAME] section
+    with that machinename, or cp itself if there are no such sections.
+    """
+    configs = main.source_configs(cp) or main.probe_configs(cp)
+    if not configs:
+        return [cp]
+    return [config for name, config in configs \
+        if config.get("gratia", "machinename") == machinename]
+
+
+def reconcile(cp, opts, configs=None):
+    """
+    Compare the totals of the Gratia records synchronized with cp's
+    settings, or, if given, with each of configs, with those charged.
+    """
+    if configs is None:
+        configs = [cp]
+    counts = {}
+    expected = {}
+    for config in configs:
+        end_id = opts.end_id
+        if end_id is None:
+            end_id = transaction.start_txn(config)['last_successful_id']
+        log.info("Summing the Gratia records of %s from DBID=%i to " \
+            "DBID=%i." % (config.get("gratia", "probe"), opts.start_id,
+            end_id - 1))
+        totals = gratia.charged_totals(config, opts.start_id, end_id,
+            opts.first_day, opts.last_day, counts)
+        for key, total in totals.items():
+            expected[key] = expected.get(key, 0) + total
+    # A group charged as several Gold jobs is rounded once per job.
+    charged_counts = {}
+    if opts.export:
+        actual = export_totals(opts.export, opts.first_day, opts.last_day)
+    elif opts.index:
+        actual = index_totals(opts.index, opts.first_day, opts.last_day,
+            charged_counts)
+    else:
+        actual = gold_totals(cp, opts.first_day, opts.last_day,
+            charged_counts)
+    for key, count in charged_counts.items():
+        counts[key] = max(counts.get(key, 0), count)
+    if opts.output:
+        fd = open(opts.output, "w")
+    else:
+        fd = sys.stdout
+    try:
+        count, net = write_report(fd, discrepancies(expected, actual,
+            opts.tolerance, counts))
+    finally:
+        if opts.output:
+            fd.close()
+    log.info("Compared %i Gratia totals with %i charged totals; %i differ, " \
+        "by %+.2f in all." % (len(expected), len(actual), count, net))
+    if count:
+        return 1
+    return 0
+
+
+def run():
+    opts, args = parse_opts()
+    cp = ConfigParser.ConfigParser()
+    cp.read(opts.config)
+    main.config_logging(cp, opts)
+    if opts.probe:
+        probes = dict(main.probe_configs(cp))
+        probes.update(dict(main.source_configs(cp)))
+        if opts.probe not in probes:
+            raise Exception("No [probe:%s] or [source:%s] section in %s" % \
+                (opts.probe, opts.probe, opts.config))
+        selected = probes[opts.probe]
+    else:
+        selected = cp
+    configs = None
+    if not opts.export and not opts.index:
+        configs = machine_configs(cp, selected.get("gratia", "machinename"))
+    return reconcile(selected, opts, configs)
@@ -0,0 +1,215 @@
+
+"""
+Module for tracking which summaries have already been charged.
+
+Keeps a SQLite index, keyed on the summary's group and Gold job, of the
+Gold jobs each group was charged under and the totals charged to each so
+far.  Summaries that were already charged are skipped, and new data for a
+group already in Gold is charged to its latest Gold job with gcharge
+--incremental.  A group normally has one Gold job; it gets more when it is
+charged by several backfill shards, or from several sources.
+"""
+
+import logging
+import ConfigParser
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+import gold
+
+log = logging.getLogger("gratia_gold.summaries")
+
+SCHEMA = \
+"""
+CREATE TABLE IF NOT EXISTS charged (
+  group_key TEXT NOT NULL,
+  gold_job_id INTEGER NOT NULL,
+  max_dbid INTEGER NOT NULL,
+  charge INTEGER NOT NULL,
+  wall_duration INTEGER,
+  cpu INTEGER,
+  njobs INTEGER,
+  PRIMARY KEY (group_key, gold_job_id)
+)
+"""
+
+COLUMNS = "group_key, gold_job_id, max_dbid, charge, wall_duration, cpu, njobs"
+
+def group_key(job):
+    """
+    Return the index key for a summary: the columns it was grouped on.
+    """
+    endtime = job['endtime']
+    if endtime is not None:
+        endtime = str(endtime)[:10]
+    parts = [job['resource_type'], job['vo_name'], job['user'],
+        gold.get_digits_from_a_string(job['node_count']),
+        gold.get_digits_from_a_string(job['processors']), endtime,
+        job['machine_name'], job['project_name']]
+    return "\x1f".join([str(i) for i in parts])
+
+def _incremental(job, row):
+    """
+    Mark job to be charged incrementally to the Gold job of its group's
+    index row, keeping the group's current totals in 'previous' so a
+    rollback can restore them.
+    """
+    gold_job_id, max_dbid, charge, wall_duration, cpu, njobs = row
+    job['gold_job_id'] = gold_job_id
+    job['incremental'] = True
+    job['previous'] = {'charge': str(charge),
+        'wall_duration': wall_duration, 'cpu': cpu, 'njobs': njobs}
+    return job
+
+def _int_or_none(value):
+    if value is None:
+        return None
+    return int(value)
+
+class ChargedIndex(object):
+    """
+    The charged-summary index.
+
+    Updates are made in the same SQLite transaction until commit(); a
+    window's updates should be committed right after its txn file, and
+    rolled back along with its charges.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.upgrade()
+        self.conn.execute(SCHEMA)
+        self.conn.commit()
+
+    def upgrade(self):
+        """
+        Re-key an index made by an earlier version, which kept one entry
+        per group, on the group and Gold job.
+        """
+        row = self.conn.execute("SELECT sql FROM sqlite_master WHERE "
+            "type='table' AND name='charged'").fetchone()
+        if row is None or "PRIMARY KEY (" in row[0]:
+            return
+        log.info("Upgrading the charged-summary index %s", self.path)
+        # In one SQLite transaction, so a crash leaves the old index.
+        self.conn.executescript("BEGIN; ALTER TABLE charged RENAME TO "
+            "charged_old; %s; INSERT INTO charged (%s) SELECT %s FROM "
+            "charged_old; DROP TABLE charged_old; COMMIT;" % (SCHEMA, COLUMNS,
+            COLUMNS))
+
+    def lookup(self, job):
+        """
+        Return (gold_job_id, max_dbid, charge, wall_duration, cpu, njobs)
+        for the latest Gold job of the job's group (the one with the newest
+        records), or None if the group has never been charged.
+        """
+        return self.conn.execute("SELECT gold_job_id, max_dbid, charge, "
+            "wall_duration, cpu, njobs FROM charged WHERE group_key=? "
+            "ORDER BY max_dbid DESC LIMIT 1", (group_key(job),)).fetchone()
+
+    def filter(self, jobs, skipped):
+        """
+        Prepare a stream of summaries for charging, yielding only those
+        that still need to be charged.
+
+        A summary whose records are already covered by its group's entries
+        (its dbid is no newer than the group's max_dbid) is dropped and
+        appended to skipped.  A summary for a group already in Gold is
+        marked incremental, against the group's latest Gold job id, with
+        that job's current totals kept in 'previous' so a rollback can
+        restore them.
+        """
+        for job in jobs:
+            gold.normalize_job(job)
+            row = self.lookup(job)
+            if row is None:
+                yield job
+                continue
+            if job['dbid'] <= row[1]:
+                log.debug("Summary %s was already charged as job %s",
+                    job['dbid'], row[0])
+                skipped.append(job)
+                continue
+            yield _incremental(job, row)
+
+    def prepare_retry(self, job):
+        """
+        Prepare a charge which failed earlier to be retried.  The group may
+        have been charged since, so the charge is re-targeted at the group's
+        current Gold job and totals, if any.  Unlike filter(), this never
+        drops the job: a later summary for its group does not cover it.
+        """
+        for name in ['gold_job_id', 'incremental', 'previous']:
+            job[name] = None
+        row = self.lookup(job)
+        if row is None:
+            return job
+        return _incremental(job, row)
+
+    def record(self, job):
+        """
+        Record a successful charge of job.
+        """
+        key = group_key(job)
+        charge = int(job['charge'])
+        wall_duration = _int_or_none(job['wall_duration'])
+        cpu = _int_or_none(job['cpu'])
+        njobs = _int_or_none(job['njobs'])
+        if job['incremental']:
+            previous = job['previous']
+            charge += int(previous['charge'])
+            if previous['wall_duration'] is not None:
+                wall_duration = (wall_duration or 0) + previous['wall_duration']
+            if previous['cpu'] is not None:
+                cpu = (cpu or 0) + previous['cpu']
+            if previous['njobs'] is not None:
+                njobs = (njobs or 0) + previous['njobs']
+            self.conn.execute("UPDATE charged SET max_dbid=MAX(max_dbid, ?), "
+                "charge=?, wall_duration=?, cpu=?, njobs=? WHERE group_key=? "
+                "AND gold_job_id=?", (job['dbid'], charge, wall_duration, cpu,
+                njobs, key, job['gold_job_id']))
+        else:
+            self.conn.execute("INSERT OR REPLACE INTO charged (%s) VALUES "
+                "(?, ?, ?, ?, ?, ?, ?)" % COLUMNS, (key,
+                job['gold_job_id'] or job['dbid'], job['dbid'], charge,
+                wall_duration, cpu, njobs))
+
+    def merge(self, path):
+        """
+        Copy every entry of the index at path into this one, replacing the
+        entries for the same Gold jobs.  The totals of a Gold job are only
+        ever updated by one index at a time (see main.sync_shard), so the
+        entry being copied holds all of them.
+        """
+        other = sqlite3.connect(path)
+        try:
+            rows = other.execute("SELECT %s FROM charged" % \
+                COLUMNS).fetchall()
+        finally:
+            other.close()
+        self.conn.executemany("INSERT OR REPLACE INTO charged (%s) VALUES "
+            "(?, ?, ?, ?, ?, ?, ?)" % COLUMNS, rows)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+def open_index(cp):
+    """
+    Open the index named by [transaction] charged_index, or return None if
+    the option is not set.
+    """
+    try:
+        path = cp.get("transaction", "charged_index")
+    except ConfigParser.Error:
+        return None
+    return ChargedIndex(path)
@@ -7,83 +7,422 @@ Allows us to rollback Gratia->Gold uploads on failure.
 
 import os
 import md5
+import time
+import errno
 import logging
-
-import simplejson
+import ConfigParser
 
 import gold
+import metrics
 
 log = logging.getLogger("gratia_gold.transaction")
 
-def check_rollback(cp):
+# Each record in the refund file is the rollback log offset of the next
+# entry to refund, as a fixed-width number, so only the last record needs to
+# be read to resume.
+REFUND_RECORD = "%020d\n"
+REFUND_RECORD_LEN = len(REFUND_RECORD % 0)
+
+class Journal(object):
     """
-    Read the rollback log, and rollback any pending charges.
+    The rollback log: a write-ahead journal of the charges sent to Gold.
+
+    Each job is appended as "md5:json" before it is charged.  Appends are
+    fsync'd in groups: the log is synced once group_size entries are
+    pending, or (if group_interval is nonzero) once the oldest pending entry
+    is group_interval seconds old.  With the default group_size of 1 every
+    entry is on disk before its charge is sent.  With larger groups fewer
+    fsyncs are done, but a crash can lose up to group_size-1 entries (or
+    group_interval seconds worth) whose charges may have already reached
+    Gold.  Those charges would not be refunded, and would be charged again
+    when the window is replayed.
+
+    Refunds issued from the log are tracked in the "<log>.refund" file as
+    offsets into the log, group-committed the same way; a crash during a
+    rollback may re-issue up to group_size-1 refunds.
+
+    A Checkpointer may commit a prefix of the log partway through a window;
+    that prefix is kept when the rest is rolled back, and its jobs are
+    skipped when the window is replayed.
+    """
+
+    def __init__(self, path, group_size=1, group_interval=0):
+        self.path = path
+        self.refund_path = "%s.refund" % path
+        self.group_size = group_size
+        self.group_interval = group_interval
+        self.fd = open(path, "a")
+        self.size = os.path.getsize(path)
+        self.pending = 0
+        self.pending_since = None
+
+    def append(self, job):
+        """
+        Journal a job, returning the log offset just past its entry.
+        """
+        import simplejson
+        if not isinstance(job, dict):
+            job = job.todict()
+        job_str = simplejson.dumps(job)
+        if len(job_str.split("\n")) > 1:
+            raise Exception("Job description contains newline")
+        digest = md5.md5(job_str).hexdigest()
+        entry = "%s:%s\n" % (digest, job_str)
+        self.fd.write(entry)
+        self.size += len(entry)
+        self.pending += 1
+        if self.pending == 1:
+            self.pending_since = time.time()
+        if self.pending >= self.group_size or (self.group_interval and \
+                time.time() - self.pending_since >= self.group_interval):
+            self.sync()
+        return self.size
+
+    def sync(self):
+        if self.pending:
+            started = time.time()
+            self.fd.flush()
+            os.fsync(self.fd.fileno())
+            self.pending = 0
+            metrics.observe("journal", time.time() - started)
+
+    def entries(self, offset):
+        """
+        Iterate through the log starting at byte offset, yielding the
+        offset just past each entry along with the entry's job.
+        """
+        import simplejson
+        self.sync()
+        fd = open(self.path, "r")
+        try:
+            fd.seek(offset)
+            for line in iter(fd.readline, ""):
+                offset += len(line)
+                # Parse the rollback to prepare the refund
+                md5sum, job = line.strip().split(":",1)
+                md5sum2 = md5.md5(job).hexdigest()
+                if md5sum != md5sum2:
+                    raise Exception("Rollback log doesn't match md5sum (%s!=%s): %s" \
+                        % (md5sum, md5sum2, line.strip()))
+                yield offset, simplejson.loads(job)
+        finally:
+            fd.close()
+
+    def refund_offset(self):
+        """
+        Return the offset of the first entry in the log not yet refunded.
+        """
+        try:
+            refund_fd = open(self.refund_path, "r")
+        except IOError, ie:
+            if ie.errno != errno.ENOENT:
+                raise
+            return 0
+        try:
+            refund_fd.seek(0, 2)
+            size = refund_fd.tell()
+            if size < REFUND_RECORD_LEN:
+                return 0
+            refund_fd.seek(size - size % REFUND_RECORD_LEN - REFUND_RECORD_LEN)
+            record = refund_fd.read(REFUND_RECORD_LEN)
+            if len(record) == REFUND_RECORD_LEN and record[:-1].isdigit():
+                return int(record)
+            # Refund file from an older release, holding a copy of each
+            # refunded line; skip that many entries.
+            refund_fd.seek(0)
+            refund_count = len(refund_fd.readlines())
+        finally:
+            refund_fd.close()
+        offset = 0
+        if not refund_count:
+            return offset
+        for offset, job in self.entries(0):
+            refund_count -= 1
+            if refund_count <= 0:
+                break
+        return offset
+
+    def charged(self):
+        """
+        Return the jobs in the log, by dbid.  Called at the start of a
+        window, when the log only holds the checkpointed prefix of a window
+        being replayed.
+        """
+        jobs = {}
+        if not self.size:
+            return jobs
+        for offset, job in self.entries(0):
+            jobs[job['dbid']] = job
+        return jobs
+
+    def reset(self, offset=0):
+        """
+        Empty the log and its refund file in place once every entry has
+        been committed or refunded.  If offset is given, the entries before
+        it (a checkpointed prefix) are kept.
+        """
+        self.sync()
+        self.fd.truncate(offset)
+        os.fsync(self.fd.fileno())
+        self.size = offset
+        if os.path.exists(self.refund_path):
+            refund_fd = open(self.refund_path, "r+")
+            try:
+                refund_fd.truncate(0)
+                os.fsync(refund_fd.fileno())
+            finally:
+                refund_fd.close()
+
+    def close(self):
+        self.sync()
+        self.fd.close()
+
+
+def open_journal(cp):
+    """
+    Open the rollback log named by [transaction] rollback, using the
+    [transaction] group_commit (entries) and group_commit_ms settings.
     """
-    rollback_file = cp.get("transaction", "rollback")
-    if not os.path.exists(rollback_file) or not os.access(rollback_file,
-            os.R_OK):
-        return open(rollback_file, "w")
-        
-    refund_file = "%s.refund" % rollback_file
     try:
-        refund_fd = open(refund_file, "r+")
-    except IOError, ie:
-        if ie.errno != 2:
-            raise
-        refund_fd = None
-    refund_count = 0
-    if refund_fd:
-        for line in refund_fd.readlines():
-            refund_count += 1
-        log.info("There are %i refunds" % refund_count)
-    else:
-        refund_fd = open(refund_file, "w")
-    # Check for a rollback file - if there is none, there's no transaction to
-    # undo; just return a new file handle.
+        group_size = cp.getint("transaction", "group_commit")
+    except ConfigParser.Error:
+        group_size = 1
     try:
-        rollback_fd = open(rollback_file, "r")
-    except IOError, ie:
-        if ie.errno == 2:
-            return open(rollback_file, "w")
-        raise
-    skip_count = 0
-    # We have a rollback file.  If there's refunds already issued, skip those.
-    for line in rollback_fd.readlines():
-        skip_count += 1
-        if skip_count <= refund_count:
-            continue
-        # Parse the rollback to prepare the refund
-        md5sum, job = line.strip().split(":",1)
-        md5sum2 = md5.md5(job).hexdigest()
-        if md5sum != md5sum2:
-            raise Exception("Rollback log doesn't match md5sum (%s!=%s): %s" \
-                % (md5sum, md5sum2, line.strip()))
-        job_dict = simplejson.loads(job)
-        # Perform refund, then write it out.  We err on the side of issuing
-        # too many refunds.
-        gold.refund(cp, job_dict)
-        refund_fd.write(line)
+        group_interval = cp.getfloat("transaction", "group_commit_ms") / 1000
+    except ConfigParser.Error:
+        group_interval = 0
+    return Journal(cp.get("transaction", "rollback"), max(group_size, 1),
+        group_interval)
+
+
+class Checkpointer(object):
+    """
+    Takes checkpoints partway through a window.
+
+    Charges complete out of order, so this tracks the longest prefix of the
+    rollback log whose charges have all succeeded.  Every `interval` charges
+    that prefix grows by, the log is synced and the txn file is committed
+    with its end (journal_offset) and the end of the window being charged
+    (window_end).  After a crash or a failed charge, only the entries past
+    journal_offset are refunded; the window is then replayed over the same
+    dbid range, skipping the jobs still in the log.
+    """
+
+    def __init__(self, cp, txn, journal, interval, window_end):
+        self.cp = cp
+        self.txn = txn
+        self.journal = journal
+        self.interval = interval
+        self.window_end = window_end
+        self.started = {}
+        self.offsets = []
+        self.statuses = []
+        self.done = 0
+        self.checkpointed = 0
+
+    def started_charge(self, job, offset):
+        self.started[id(job)] = len(self.offsets)
+        self.offsets.append(offset)
+        self.statuses.append(None)
+
+    def finished_charge(self, job, status):
+        self.statuses[self.started.pop(id(job))] = status
+        while self.done < len(self.statuses) and \
+                self.statuses[self.done] == 0:
+            self.done += 1
+        if self.done - self.checkpointed >= self.interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        if not self.done:
+            return
+        self.journal.sync()
+        self.txn['journal_offset'] = self.offsets[self.done-1]
+        self.txn['window_end'] = self.window_end
+        commit_txn(self.cp, self.txn)
+        self.checkpointed = self.done
+        metrics.count("checkpoints")
+
+
+def make_checkpointer(cp, txn, journal, window_end):
+    """
+    Return a Checkpointer for the window ending at window_end, if
+    [transaction] checkpoint_interval is set; otherwise None.
+    """
+    try:
+        interval = cp.getint("transaction", "checkpoint_interval")
+    except ConfigParser.Error:
+        interval = 0
+    if interval <= 0:
+        return None
+    return Checkpointer(cp, txn, journal, interval, window_end)
+
+
+def check_rollback(cp, journal=None, committed=0):
+    """
+    Read the rollback log, and rollback any pending charges past the
+    offset `committed` (the journal_offset of a checkpoint, if any).
+
+    Returns the journal, opening it first if none is given; it is left
+    holding only the entries before `committed`.  Raises an exception if a
+    refund fails.
+    """
+    if journal is None:
+        journal = open_journal(cp)
+    journal.sync()
+    if journal.size <= committed:
+        return journal
+
+    offset = max(journal.refund_offset(), committed)
+    log.info("Resuming rollback at offset %i of %s" % (offset, journal.path))
+    refund_fd = open(journal.refund_path, "a")
+    try:
+        pending = 0
+        for offset, job in journal.entries(offset):
+            # Perform refund, then write it out.  We err on the side of
+            # issuing too many refunds.  A failed refund (or a failed
+            # charge back of an incremental job's previous totals) stops
+            # the rollback; the next run resumes it at this entry.
+            status = metrics.timed("refund", gold.refund, cp, job)
+            if status:
+                raise Exception("Refund of job %s failed with status %s; "
+                    "the rollback will resume there on the next run." % \
+                    (str(job.get('gold_job_id') or job['dbid']), status))
+            metrics.count("refunds")
+            refund_fd.write(REFUND_RECORD % offset)
+            pending += 1
+            if pending >= journal.group_size:
+                refund_fd.flush()
+                os.fsync(refund_fd.fileno())
+                pending = 0
+        refund_fd.flush()
         os.fsync(refund_fd.fileno())
-    rollback_fd.close()
-    refund_fd.close()
+    finally:
+        refund_fd.close()
     # We were able to rollback everything that failed - remove the records
-    os.unlink(rollback_file)
-    os.unlink(refund_file)
-    return open(rollback_file, "w")
+    journal.reset(committed)
+    return journal
+
+
+def retry_attempts(cp):
+    """
+    Return [transaction] retry_attempts: how many times a failed charge is
+    retried before it is given up on.  With the default of 0, failed
+    charges are not queued for retry; the window is rolled back instead.
+    """
+    try:
+        return cp.getint("transaction", "retry_attempts")
+    except ConfigParser.Error:
+        return 0
+
+
+def retry_failure_ratio(cp):
+    """
+    Return [transaction] retry_failure_ratio: the fraction of a window's
+    charges which may fail and still be queued for retry (default 0.5).
+    """
+    try:
+        return cp.getfloat("transaction", "retry_failure_ratio")
+    except ConfigParser.Error:
+        return 0.5
 
-def add_rollback(fd, job):
-    job_str = simplejson.dumps(job)
-    if len(job_str.split("\n")) > 1:
-        raise Exception("Job description contains newline")
-    digest = md5.md5(job_str).hexdigest()
-    fd.write("%s:%s\n" % (digest, job_str))
-    os.fsync(fd.fileno())
+
+def retry_queue_size(cp):
+    """
+    Return [transaction] retry_queue_size: the most charges the retry queue
+    may hold (default 1000).
+    """
+    try:
+        return cp.getint("transaction", "retry_queue_size")
+    except ConfigParser.Error:
+        return 1000
+
+
+def queue_retry(cp, txn, job, attempts=0, unknown=False):
+    """
+    Queue a failed charge (which has been tried `attempts` times before)
+    for retry, in txn['retry'].  If unknown is set, Gold may have made the
+    charge (it did not answer), so it is refunded before it is retried.
+
+    The queue is committed with the rest of the txn.  The next attempt is
+    due after [transaction] retry_delay seconds (default 60), doubling
+    after every failure up to retry_max_delay (default 3600).  A job which
+    has failed retry_attempts times is appended to the dead-letter file
+    instead, to be charged by hand.
+    """
+    if not isinstance(job, dict):
+        job = job.todict()
+    attempts += 1
+    if attempts > retry_attempts(cp):
+        dead_letter(cp, job, attempts)
+        return
+    try:
+        delay = cp.getfloat("transaction", "retry_delay")
+    except ConfigParser.Error:
+        delay = 60
+    try:
+        max_delay = cp.getfloat("transaction", "retry_max_delay")
+    except ConfigParser.Error:
+        max_delay = 3600
+    delay = min(delay * 2**(attempts-1), max_delay)
+    log.warning("Will retry the charge of job %s in %i seconds (attempt %i)" \
+        % (str(job['dbid']), delay, attempts+1))
+    entry = {'job': job, 'attempts': attempts, 'due': time.time() + delay}
+    if unknown:
+        entry['unknown'] = True
+    txn.setdefault('retry', []).append(entry)
+    metrics.count("retries_queued")
+
+
+def due_retries(txn):
+    """
+    Remove the retries which are due from txn['retry'], returning them.
+    """
+    queue = txn.get('retry')
+    if not queue:
+        return []
+    now = time.time()
+    due = [i for i in queue if i['due'] <= now]
+    if due:
+        txn['retry'] = [i for i in queue if i['due'] > now]
+    return due
+
+
+def dead_letter_path(cp):
+    """
+    Return the [transaction] dead_letter file: by default, the rollback
+    log's path with ".dead" appended.
+    """
+    try:
+        return cp.get("transaction", "dead_letter")
+    except ConfigParser.Error:
+        return "%s.dead" % cp.get("transaction", "rollback")
+
+
+def dead_letter(cp, job, attempts):
+    """
+    Give up on a charge, appending it to the dead-letter file.
+    """
+    import simplejson
+    path = dead_letter_path(cp)
+    log.error("Giving up on the charge of job %s after %i attempts; see %s" \
+        % (str(job['dbid']), attempts, path))
+    fd = open(path, "a")
+    try:
+        fd.write(simplejson.dumps({'job': job, 'attempts': attempts,
+            'time': time.time()}) + "\n")
+        fd.flush()
+        os.fsync(fd.fileno())
+    finally:
+        fd.close()
+    metrics.count("dead_letters")
 
 
 def start_txn(cp):
     '''
     read the content of the txn file
     '''
+    import simplejson
     txn_file = cp.get("transaction", "last_successful_id")
     try:
         txn_fp = open(txn_file, "r")
@@ -96,15 +435,36 @@ def start_txn(cp):
         probename = cp.get("gratia", "probe")
         return {'probename':probename, 'last_successful_id': 0}
 
+def _write_atomic(path, contents):
+    '''
+    Replace path with contents, so that a crash leaves either the old or
+    the new file: write a temporary file, fsync it, rename it over path and
+    fsync the directory.
+    '''
+    tmp = "%s.tmp" % path
+    fd = open(tmp, "w")
+    try:
+        fd.write(contents)
+        fd.flush()
+        os.fsync(fd.fileno())
+    finally:
+        fd.close()
+    os.rename(tmp, path)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
 def commit_txn(cp, txn):
     '''
     update the txn file
     '''
+    import simplejson
+    started = time.time()
     txn_file = cp.get("transaction", "last_successful_id")
-    txn_fp = open(txn_file, "w")
-    simplejson.dump(txn, txn_fp)
-    log.debug("Updating ... " + str(txn))
-    os.fsync(txn_fp.fileno())
-    txn_fp.close()
+    log.debug("Updating ... %s", txn)
+    _write_atomic(txn_file, simplejson.dumps(txn))
+    metrics.observe("commit", time.time() - started)
 
 
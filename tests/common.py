@@ -0,0 +1,250 @@
+
+"""
+Helpers shared by the gratia-gold unit tests.
+
+The tests run against the sources in src/, without installing them:
+
+    python -m unittest discover -s tests
+
+End-to-end tests (SyncTestCase) run gratia-gold in a child process against
+a SQLite Gratia database, through the benchmark's MySQLdb stand-in
+(bench/sqlite_mysqldb.py), and charge the fake Gold backend.
+"""
+
+import os
+import sys
+import pwd
+import shutil
+import sqlite3
+import logging
+import tempfile
+import unittest
+import subprocess
+import ConfigParser
+from datetime import datetime, timedelta
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(TESTS_DIR), "src")
+BENCH_DIR = os.path.join(os.path.dirname(TESTS_DIR), "bench")
+for path in [BENCH_DIR, SRC_DIR]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import sqlite_mysqldb
+sqlite_mysqldb.install()
+
+from gratia_gold import gold
+from gratia_gold import main
+from gratia_gold import gratia
+from gratia_gold import locking
+from gratia_gold import transaction
+
+from gratia_bench import SCHEMA
+
+PROBE = "condor:test"
+
+# Set up by main.config_logging in a real run.
+main.log = logging.getLogger("gratia_gold")
+
+# Runs gratia-gold with the arguments given, like the gratia-gold script.
+RUNNER = """
+import sys
+sys.path[:0] = [%r, %r]
+import sqlite_mysqldb
+sqlite_mysqldb.install()
+from gratia_gold import main
+sys.argv[0] = "gratia-gold"
+sys.exit(main.main())
+""" % (BENCH_DIR, SRC_DIR)
+
+def make_job(dbid, charge=100, user="user1", project="proj1", day="2012-01-01",
+        **fields):
+    """
+    Return a summarized job (a gratia.Job) for the given group.
+    """
+    endtime = None
+    if day:
+        endtime = "%s 00:00:00" % day
+    job = gratia.Job(dbid, "Batch", "vo1", user, str(charge), charge, 2, 1, 1,
+        1, endtime, "mach", project, "condor")
+    for name, value in fields.items():
+        job[name] = value
+    return job
+
+
+class StateTestCase(unittest.TestCase):
+    """
+    A test with a scratch directory for the state files, and a config
+    pointing at them.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="gratia-gold-test")
+        self.cp = ConfigParser.ConfigParser()
+        for section in ["gratia", "gold", "transaction"]:
+            self.cp.add_section(section)
+        self.cp.set("gratia", "probe", "condor:test")
+        self.cp.set("gratia", "machinename", "mach")
+        self.cp.set("gold", "backend", "fake")
+        for option, name in [("rollback", "rollback"),
+                ("last_successful_id", "txn"), ("lockfile", "lock")]:
+            self.cp.set("transaction", option, self.path(name))
+        self.saved_backend = gold.backend
+        gold.backend = None
+
+    def tearDown(self):
+        if gold.backend:
+            gold.backend.close()
+        gold.backend = self.saved_backend
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+
+def make_records(first, count, probe=PROBE, users=3):
+    """
+    Return count (JobUsageRecord, JobUsageRecord_Meta) rows starting at
+    dbid first.  Records end ten per hour, from 2012-01-01 on.  Their
+    Charge is NULL, so each is charged its (whole) WallDuration.
+    """
+    records = []
+    for dbid in range(first, first + count):
+        endtime = datetime(2012, 1, 1) + timedelta(0, 360 * dbid)
+        wall = 100 + dbid % 50
+        records.append(((dbid, "Batch", "vo1", "user%d" % (dbid % users),
+            None, wall, wall / 2.0, 1.0, 1, 1, 1,
+            endtime.strftime("%Y-%m-%d %H:%M:%S"), "mach",
+            "proj%d" % (dbid % 2)), (dbid, probe)))
+    return records
+
+
+class FailingBackend(gold.FakeBackend):
+    """
+    The fake backend, failing the charges of the jobs for which
+    failing(job) is true.  The dbid of every charge made is appended to
+    charged.
+    """
+
+    def __init__(self, database, failing=None):
+        gold.FakeBackend.__init__(self, database)
+        self.failing = failing
+        self.charged = []
+
+    def charge(self, jobs, before_charge=None, after_charge=None):
+        statuses = []
+        for job in jobs:
+            if self.failing and self.failing(job):
+                if before_charge:
+                    before_charge(job)
+                statuses.append(1)
+                if after_charge:
+                    after_charge(job, 1)
+                continue
+            statuses += gold.FakeBackend.charge(self, [job], before_charge,
+                after_charge)
+            self.charged.append(job['dbid'])
+        return statuses
+
+
+class SyncTestCase(StateTestCase):
+    """
+    An end-to-end test: gratia-gold synchronizes a SQLite Gratia database
+    into the fake Gold backend, recording its charges in SQLite.
+    """
+
+    def setUp(self):
+        StateTestCase.setUp(self)
+        self.cp.set("gratia", "db", self.path("gratia.sqlite"))
+        self.cp.set("gratia", "probe", PROBE)
+        self.cp.set("gold", "username", pwd.getpwuid(os.getuid()).pw_name)
+        self.cp.set("gold", "fake_database", self.path("gold.sqlite"))
+        self.cp.add_section("logging")
+        self.cp.set("logging", "file", self.path("log"))
+        self.records = []
+        conn = sqlite3.connect(self.path("gratia.sqlite"))
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        gratia.close_connections()
+        gratia._probe_names.clear()
+        StateTestCase.tearDown(self)
+
+    def add_records(self, first, count, probe=PROBE, users=3,
+            db="gratia.sqlite"):
+        records = make_records(first, count, probe, users)
+        conn = sqlite3.connect(self.path(db))
+        conn.executemany("INSERT INTO JobUsageRecord VALUES (%s)" % \
+            ", ".join(["?"]*14), [jur for jur, jurm in records])
+        conn.executemany("INSERT INTO JobUsageRecord_Meta VALUES (?, ?)",
+            [jurm for jur, jurm in records])
+        conn.commit()
+        conn.close()
+        self.records += records
+        return records
+
+    def expected(self, probe=PROBE):
+        """
+        Return the total every record of probe should be charged.
+        """
+        return sum([jur[5] for jur, jurm in self.records if \
+            jurm[1] == probe])
+
+    def start_sync(self, *args):
+        """
+        Start gratia-gold with the test's configuration and the given
+        arguments; returns the subprocess.Popen.
+        """
+        config = self.path("gratia-gold.cfg")
+        fd = open(config, "w")
+        try:
+            self.cp.write(fd)
+        finally:
+            fd.close()
+        output = open(self.path("output"), "a")
+        try:
+            return subprocess.Popen([sys.executable, "-c", RUNNER, "-c",
+                config] + list(args), stdout=output, stderr=output)
+        finally:
+            output.close()
+
+    def run_sync(self, *args):
+        """
+        Run gratia-gold with the test's configuration and the given
+        arguments; returns its exit status.
+        """
+        return self.start_sync(*args).wait()
+
+    def sync(self, failing=None):
+        """
+        Run main.sync in this process, through a FailingBackend; returns
+        the status and the backend.
+        """
+        gold.backend = FailingBackend(self.path("gold.sqlite"), failing)
+        try:
+            return main.sync(self.cp), gold.backend
+        finally:
+            gratia.close_connections()
+            gold.backend.close()
+            gold.backend = None
+            locking.close_and_unlink_lock()
+            locking.fd = None
+
+    def charged(self, db="gold.sqlite"):
+        """
+        Return the total charged to the fake Gold backend, less refunds.
+        """
+        if not os.path.exists(self.path(db)):
+            return 0
+        conn = sqlite3.connect(self.path(db))
+        try:
+            return conn.execute("SELECT sum(charge) FROM charges WHERE "
+                "refunded=0").fetchone()[0] or 0
+        finally:
+            conn.close()
+
+    def txn(self):
+        return transaction.start_txn(self.cp)
@@ -0,0 +1,85 @@
+
+"""
+Tests for the client-side summarizing of raw records (gratia.Aggregator).
+"""
+
+import unittest
+from datetime import datetime, timedelta
+
+import common # puts src/ on sys.path
+
+from gratia_gold import gratia
+
+GRACE = timedelta(0, 3600)
+
+def row(dbid, day, hour=12, user="user1", charge=10):
+    """
+    Return a row of gratia.RAW_QUERY for a record ending at hour on day
+    (of January 2012), or with no EndTime if day is None.
+    """
+    endtime = None
+    if day is not None:
+        endtime = datetime(2012, 1, day, hour)
+    return (dbid, "Batch", "vo1", user, charge, charge, 1, 1, 1, 1, 1,
+        endtime, "mach", "proj1")
+
+def summaries(jobs):
+    return [(job['dbid'], job['user'], job['endtime'], job['charge'],
+        job['njobs']) for job in jobs]
+
+class AggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.aggregator = gratia.Aggregator("mach", GRACE)
+
+    def add(self, *rows):
+        for i in rows:
+            self.aggregator.add(i)
+
+    def test_grouping(self):
+        self.add(row(1, 1), row(2, 1, user="user2"), row(3, 1, charge=5))
+        self.assertEqual(summaries(self.aggregator.flush()), [
+            (2, "user2", "2012-01-01 00:00:00", 10, 1),
+            (3, "user1", "2012-01-01 00:00:00", 15, 2)])
+        self.assertEqual(self.aggregator.complete_through, "2012-01-01")
+
+    def test_grace(self):
+        self.add(row(1, 1), row(2, 2, hour=0))
+        # Day 1 ends at midnight; its records are held for the grace hour.
+        self.assertEqual(self.aggregator.complete(), [])
+        self.assertEqual(self.aggregator.checkpoint(10), 1)
+        self.add(row(3, 2, hour=2))
+        self.assertEqual(summaries(self.aggregator.complete()),
+            [(1, "user1", "2012-01-01 00:00:00", 10, 1)])
+        self.assertEqual(self.aggregator.complete_through, "2012-01-01")
+        self.assertEqual(self.aggregator.checkpoint(10), 2)
+
+    def test_late(self):
+        self.add(row(1, 1), row(2, 3))
+        self.assertEqual(len(self.aggregator.complete()), 1)
+        # A late record for a day already emitted is emitted on its own.
+        self.add(row(3, 1))
+        self.assertEqual(summaries(self.aggregator.complete()),
+            [(3, "user1", "2012-01-01 00:00:00", 10, 1)])
+        self.assertEqual(self.aggregator.checkpoint(10), 2)
+
+    def test_no_endtime(self):
+        self.add(row(1, None), row(2, 2))
+        self.assertEqual(summaries(self.aggregator.complete()),
+            [(1, "user1", None, 10, 1)])
+        self.add(row(3, None))
+        self.assertEqual(summaries(self.aggregator.complete()),
+            [(3, "user1", None, 10, 1)])
+        self.assertEqual(self.aggregator.checkpoint(10), 2)
+
+    def test_resume(self):
+        aggregator = gratia.Aggregator("mach", GRACE, "2012-01-01", 5)
+        for i in [row(1, 1), row(2, None), row(3, 2), row(6, 1),
+                row(7, None)]:
+            aggregator.add(i)
+        self.assertEqual([job['dbid'] for job in aggregator.flush()],
+            [3, 6, 7])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+
+"""
+Tests for catching up in parallel shards (main.backfill).
+"""
+
+import os
+import unittest
+
+from common import make_job, FailingBackend, SyncTestCase
+
+from gratia_gold import gold
+from gratia_gold import main
+from gratia_gold import gratia
+from gratia_gold import locking
+from gratia_gold import transaction
+
+class BackfillTest(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.cp.add_section("backfill")
+        self.cp.set("backfill", "workers", "2")
+        self.cp.set("backfill", "shards", "4")
+        self.add_records(1, 200)
+
+    def backfill(self, failing=None):
+        """
+        Run main.backfill in this process; the shards charge through a
+        FailingBackend of their own.  Each backend made in this process is
+        recorded in made; those of the shards go to their copies of it.
+        """
+        def make(cp):
+            self.made.append(os.getpid())
+            return FailingBackend(self.path("gold.sqlite"), failing)
+        self.made = []
+        make_backend = gold.make_backend
+        gold.make_backend = make
+        try:
+            return main.backfill(self.cp)
+        finally:
+            gold.make_backend = make_backend
+            gratia.close_connections()
+            if gold.backend:
+                gold.backend.close()
+            gold.backend = None
+            locking.close_and_unlink_lock()
+            locking.fd = None
+
+    def test_backfill(self):
+        self.assertEqual(self.backfill(), 0)
+        self.assertEqual(self.charged(), self.expected())
+        # The forked shards do not inherit a backend from the coordinator.
+        self.assertEqual(self.made, [])
+        txn = self.txn()
+        self.assertEqual(txn['last_successful_id'], 201)
+        self.assertFalse('backfill' in txn)
+        self.assertEqual([name for name in os.listdir(self.dir) \
+            if ".shard" in name], [])
+
+    def test_resume(self):
+        # The third shard, [101, 151), fails; the fourth is charged, but
+        # cannot be merged before it.
+        self.assertEqual(self.backfill(lambda job: 101 <= job['dbid'] < 151),
+            1)
+        txn = self.txn()
+        self.assertEqual(txn['last_successful_id'], 101)
+        self.assertEqual(txn['backfill']['shards'], [[101, 151], [151, 201]])
+        charged = self.charged()
+        self.assertEqual(charged, self.expected() - sum([jur[5] for jur, jurm \
+            in self.records if 101 <= jur[0] < 151]))
+        # A normal run would charge the fourth shard again.
+        self.assertFalse(main.idle(self.cp))
+        self.assertRaises(Exception, self.sync)
+        self.assertEqual(self.txn(), txn)
+        self.assertEqual(self.charged(), charged)
+        self.assertEqual(self.backfill(), 0)
+        self.assertEqual(self.charged(), self.expected())
+        self.assertFalse('backfill' in self.txn())
+        status, backend = self.sync()
+        self.assertEqual((status, backend.charged), (0, []))
+
+    def test_stopped_retrying(self):
+        # A shard was stopped while retrying a charge, after reaching the
+        # end of its range.
+        self.cp.set("transaction", "retry_attempts", "3")
+        plan = main.plan_backfill(self.txn(), 200, 1)
+        start_id, end_id = plan['shards'][0]
+        shard_cp = main.shard_config(self.cp, start_id)
+        job = make_job(150)
+        shard_txn = {'probename': self.cp.get("gratia", "probe"),
+            'last_successful_id': end_id, 'backfill': plan['id']}
+        transaction.queue_retry(shard_cp, shard_txn, job)
+        transaction.commit_txn(shard_cp, shard_txn)
+        gold.backend = FailingBackend(self.path("gold.sqlite"))
+        journal = transaction.open_journal(shard_cp)
+        gold.backend.charge([job], journal.append)
+        journal.close()
+        self.assertEqual(self.charged(), 100)
+        try:
+            self.assertEqual(main.sync_shard(shard_cp, plan, start_id,
+                end_id), 0)
+        finally:
+            locking.close_and_unlink_lock()
+            locking.fd = None
+        # The charge is refunded, and left queued for the coordinator.
+        self.assertEqual(self.charged(), 0)
+        self.assertEqual([entry['job']['dbid'] for entry in \
+            transaction.start_txn(shard_cp)['retry']], [150])
+
+
+if __name__ == '__main__':
+    unittest.main()
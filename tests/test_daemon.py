@@ -0,0 +1,66 @@
+
+"""
+Tests for running as a daemon (gratia-gold --daemon).
+"""
+
+import os
+import time
+import signal
+import unittest
+
+from common import SyncTestCase
+
+class DaemonTest(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.cp.add_section("daemon")
+        self.cp.set("daemon", "poll_interval", "0.2")
+        self.daemon = None
+
+    def tearDown(self):
+        if self.daemon and self.daemon.poll() is None:
+            os.kill(self.daemon.pid, signal.SIGKILL)
+            self.daemon.wait()
+        SyncTestCase.tearDown(self)
+
+    def wait_for(self, condition, timeout=30):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline or self.daemon.poll() is not None:
+                self.fail("Timed out; see %s" % self.path("output"))
+            time.sleep(0.1)
+
+    def stop(self):
+        os.kill(self.daemon.pid, signal.SIGTERM)
+        return self.daemon.wait()
+
+    def test_cron(self):
+        self.add_records(1, 50)
+        self.daemon = self.start_sync("-d")
+        self.wait_for(lambda: self.charged() == self.expected())
+        self.add_records(51, 50)
+        self.wait_for(lambda: self.charged() == self.expected())
+        # A run from cron leaves the daemon be, however old it is.
+        self.assertEqual(self.run_sync("-s", "1", "-v"), 0)
+        self.assertTrue("holds the lockfile" in open(self.path("log")).read())
+        self.assertEqual(self.daemon.poll(), None)
+        self.assertEqual(self.stop(), 0)
+        self.assertEqual(self.txn()['last_successful_id'], 101)
+
+    def test_stop_catching_up(self):
+        self.cp.set("gratia", "window", "10")
+        self.cp.set("gold", "fake_latency", "0.01")
+        self.add_records(1, 1000)
+        self.daemon = self.start_sync("-d")
+        self.wait_for(lambda: self.charged())
+        # Stopped partway through the first catch-up, after a whole window.
+        self.assertEqual(self.stop(), 0)
+        last_successful_id = self.txn()['last_successful_id']
+        self.assertTrue(last_successful_id < 1001)
+        self.assertEqual(self.charged(), sum([jur[5] for jur, jurm in \
+            self.records if jur[0] < last_successful_id]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+
+"""
+Tests for charging from several Gratia sources together (main.fan_in).
+"""
+
+import sqlite3
+import unittest
+
+from common import SyncTestCase
+
+from gratia_gold import main
+from gratia_gold import transaction
+
+from gratia_bench import SCHEMA
+
+OFFSET = 1000000
+
+class FanInTest(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        # Two collectors, whose dbids overlap.
+        self.totals = {}
+        for name, offset in [("east", 0), ("west", OFFSET)]:
+            db = "%s.sqlite" % name
+            conn = sqlite3.connect(self.path(db))
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            conn.close()
+            section = "source:%s" % name
+            self.cp.add_section(section)
+            self.cp.set(section, "db", self.path(db))
+            self.cp.set(section, "job_id_offset", str(offset))
+            records = self.add_records(1, 100, db=db)
+            self.totals[name] = sum([jur[5] for jur, jurm in records])
+
+    def source_charged(self, name):
+        """
+        Return the total charged to the Gold jobs of a source.
+        """
+        if name == "east":
+            condition = "CAST(job_id AS INTEGER) < %i" % OFFSET
+        else:
+            condition = "CAST(job_id AS INTEGER) >= %i" % OFFSET
+        conn = sqlite3.connect(self.path("gold.sqlite"))
+        try:
+            return conn.execute("SELECT sum(charge) FROM charges WHERE "
+                "refunded=0 AND %s" % \
+                condition).fetchone()[0] or 0
+        finally:
+            conn.close()
+
+    def source_txn(self, name):
+        return transaction.start_txn(dict(main.source_configs(self.cp))[name])
+
+    def test_fan_in(self):
+        self.assertEqual(self.run_sync(), 0)
+        for name in ["east", "west"]:
+            self.assertEqual(self.source_charged(name), self.totals[name])
+            self.assertEqual(self.source_txn(name)['last_successful_id'], 101)
+        self.assertEqual(self.charged(), self.totals["east"] + \
+            self.totals["west"])
+        # Nothing new: both sources are idle.
+        self.assertEqual(self.run_sync(), 0)
+        self.assertEqual(self.charged(), self.totals["east"] + \
+            self.totals["west"])
+
+    def test_unfinished_backfill(self):
+        west_cp = dict(main.source_configs(self.cp))["west"]
+        txn = transaction.start_txn(west_cp)
+        txn['last_successful_id'] = 1
+        txn['backfill'] = main.plan_backfill(txn, 100, 1)
+        transaction.commit_txn(west_cp, txn)
+        # The other source is charged all the same.
+        self.assertEqual(self.run_sync(), 1)
+        self.assertEqual(self.source_charged("east"), self.totals["east"])
+        self.assertEqual(self.source_charged("west"), 0)
+        self.assertEqual(self.source_txn("west"), txn)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+
+"""
+Tests for the native Gold backend (gold.GoldClient and gold.NativeBackend),
+against the mock Gold server.
+"""
+
+import socket
+import unittest
+
+from common import make_job
+
+from gratia_gold import gold
+from gratia_gold import gold_mock
+
+KEY = "test-key"
+
+class NativeBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = gold_mock.MockGoldServer(KEY)
+        self.server.start()
+        self.client = self.make_client(KEY)
+        self.backend = gold.NativeBackend(self.client, batch_size=2)
+
+    def tearDown(self):
+        self.backend.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_client(self, key):
+        return gold.GoldClient("localhost", self.server.server_address[1],
+            "gold", key, timeout=10)
+
+    def test_charge(self):
+        self.assertEqual(self.backend.charge([make_job(1, charge=100)]), [0])
+        self.assertEqual(self.server.jobs["1"]['Charge'], 100)
+        self.assertEqual(self.server.jobs["1"]['User'], "user1")
+
+    def test_bad_signature(self):
+        client = self.make_client("wrong-key")
+        try:
+            success, code, message = client.send([gold.charge_request("gold",
+                make_job(1))])[0]
+            self.assertEqual((success, code), (False, "444"))
+            backend = gold.NativeBackend(client)
+            self.assertEqual(backend.charge([make_job(2)]), [1])
+        finally:
+            client.close()
+        self.assertEqual(self.server.jobs, {})
+
+    def test_charge_failure(self):
+        self.server.failure_rate = 1
+        self.assertEqual(self.backend.charge([make_job(1)]), [1])
+        self.assertEqual(self.server.jobs, {})
+
+    def test_no_response(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        client = gold.GoldClient("localhost", port, "gold", KEY, timeout=10)
+        backend = gold.NativeBackend(client)
+        try:
+            self.assertEqual(backend.charge([make_job(1), make_job(2)]),
+                [gold.UNKNOWN, gold.UNKNOWN])
+        finally:
+            backend.close()
+
+    def test_batches(self):
+        jobs = [make_job(i, charge=i*10) for i in range(1, 6)]
+        finished = []
+        def after_charge(job, status):
+            finished.append((job['dbid'], status))
+        statuses = self.backend.charge(jobs, after_charge=after_charge)
+        self.assertEqual(statuses, [0]*5)
+        self.assertEqual(finished, [(i, 0) for i in range(1, 6)])
+        for i in range(1, 6):
+            self.assertEqual(self.server.jobs[str(i)]['Charge'], i*10)
+
+    def test_incremental_charge_and_refund(self):
+        self.backend.charge([make_job(1, charge=100)])
+        job = make_job(5, charge=30, gold_job_id=1, incremental=True,
+            previous={'charge': "100", 'wall_duration': 100, 'cpu': 2,
+            'njobs': 1})
+        self.assertEqual(self.backend.charge([job]), [0])
+        self.assertEqual(self.server.jobs["1"]['Charge'], 130)
+        self.assertEqual(self.backend.refund(job.todict()), 0)
+        self.assertEqual(self.server.jobs["1"]['Charge'], 100)
+
+    def test_refund(self):
+        job = make_job(1, charge=100)
+        self.backend.charge([job])
+        self.assertEqual(self.backend.refund(job.todict()), 0)
+        self.assertEqual(self.server.jobs["1"]['Charge'], 0)
+
+    def test_query(self):
+        self.backend.charge([make_job(1, charge=100),
+            make_job(2, charge=50, user="user2"),
+            make_job(3, charge=25, user="user2")])
+        body = gold.query_request("gold", "Job", [("User", "GroupBy"),
+            ("Charge", "Sum"), ("Id", "Count")], [("Charge", "NE", "0")])
+        success, code, message, rows = self.client.send([body],
+            parse=gold.parse_gold_data)[0]
+        self.assertTrue(success)
+        totals = {}
+        for row in rows:
+            totals[row['User']] = (float(row['Charge']), int(row['Id']))
+        self.assertEqual(totals, {"user1": (100, 1), "user2": (75, 2)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+
+"""
+Tests for charging through goldsh (gold.batch_gcharge), against a stand-in
+goldsh printing canned output.
+"""
+
+import os
+import unittest
+
+from common import make_job, StateTestCase
+
+from gratia_gold import gold
+
+# Prints the output, and exits with the status, the test asked for.
+GOLDSH = """#!/bin/sh
+cat > %(dir)s/goldsh.script
+cat %(dir)s/goldsh.out
+exit `cat %(dir)s/goldsh.status`
+"""
+
+class GoldshTest(StateTestCase):
+
+    def setUp(self):
+        StateTestCase.setUp(self)
+        os.mkdir(self.path("bin"))
+        fd = open(self.path("bin/goldsh"), "w")
+        fd.write(GOLDSH % {'dir': self.dir})
+        fd.close()
+        os.chmod(self.path("bin/goldsh"), 0755)
+        self.saved_path = os.environ['PATH']
+        os.environ['PATH'] = "%s:%s" % (self.path("bin"), self.saved_path)
+
+    def tearDown(self):
+        os.environ['PATH'] = self.saved_path
+        StateTestCase.tearDown(self)
+
+    def charge(self, output, status=0):
+        for name, contents in [("goldsh.out", output),
+                ("goldsh.status", str(status))]:
+            fd = open(self.path(name), "w")
+            fd.write(contents)
+            fd.close()
+        return gold.batch_gcharge([make_job(1), make_job(2)])
+
+    def test_charge(self):
+        self.assertEqual(self.charge("Successfully charged job 1 for 100 "
+            "credits\nSuccessfully charged job 2 for 100 credits\n"), [0, 0])
+        script = open(self.path("goldsh.script")).read().splitlines()
+        self.assertEqual(len(script), 2)
+        self.assertTrue(script[0].startswith("Job Charge Job.JobId=\"1\""))
+
+    def test_failure(self):
+        self.assertEqual(self.charge("Successfully charged job 1\nFailed to "
+            "charge job 2: insufficient balance\n", 74), [0, 1])
+
+    def test_died(self):
+        # goldsh stopped before answering for the second job.
+        self.assertEqual(self.charge("Successfully charged job 1\n", 1),
+            [0, gold.UNKNOWN])
+
+    def test_unparsable(self):
+        self.assertRaises(Exception, self.charge, "Charged 2 jobs\n")
+        self.assertRaises(Exception, self.charge, "Successfully charged "
+            "job 1\nSuccessfully charged job 2\n", 1)
+        self.assertRaises(Exception, self.charge, "Successfully charged "
+            "job 1\nSuccessfully charged job 2\nSuccessfully charged job 3\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
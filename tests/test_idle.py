@@ -0,0 +1,86 @@
+
+"""
+Tests for exiting early when there is nothing to charge (main.idle).
+"""
+
+import os
+import time
+import unittest
+
+from common import make_job, SyncTestCase
+
+from gratia_gold import main
+from gratia_gold import transaction
+
+class IdleTest(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.add_records(1, 20)
+
+    def synced(self):
+        """
+        Synchronize the records, returning the txn.
+        """
+        status, backend = self.sync()
+        self.assertEqual(status, 0)
+        return self.txn()
+
+    def test_no_txn(self):
+        self.assertFalse(main.idle(self.cp))
+        self.synced()
+        self.assertTrue(main.idle(self.cp))
+
+    def test_new_records(self):
+        self.synced()
+        self.add_records(21, 1)
+        self.assertFalse(main.idle(self.cp))
+        # Another probe's records do not count.
+        self.synced()
+        self.add_records(22, 1, "condor:other")
+        self.assertTrue(main.idle(self.cp))
+
+    def test_rollback(self):
+        self.synced()
+        fd = open(self.path("rollback"), "w")
+        fd.write("\n")
+        fd.close()
+        self.assertFalse(main.idle(self.cp))
+
+    def test_unfinished(self):
+        txn = self.synced()
+        for name, value in [('window_end', 21), ('backfill', {}),
+                ('scanned_id', 30)]:
+            unfinished = dict(txn)
+            unfinished[name] = value
+            transaction.commit_txn(self.cp, unfinished)
+            self.assertFalse(main.idle(self.cp), name)
+        transaction.commit_txn(self.cp, txn)
+        self.assertTrue(main.idle(self.cp))
+
+    def test_retry(self):
+        self.cp.set("transaction", "retry_attempts", "3")
+        txn = self.synced()
+        transaction.queue_retry(self.cp, txn, make_job(5))
+        transaction.commit_txn(self.cp, txn)
+        self.assertTrue(main.idle(self.cp))
+        txn['retry'][0]['due'] = time.time() - 1
+        transaction.commit_txn(self.cp, txn)
+        self.assertFalse(main.idle(self.cp))
+
+    def test_cron(self):
+        self.synced()
+        mtime = os.stat(self.path("txn")).st_mtime
+        time.sleep(1)
+        # Exits without sleeping, and without writing the txn file.
+        started = time.time()
+        self.assertEqual(self.run_sync("-s", "600", "-v"), 0)
+        self.assertTrue(time.time() - started < 60)
+        self.assertEqual(os.stat(self.path("txn")).st_mtime, mtime)
+        log = open(self.path("log")).read()
+        self.assertTrue("Nothing new to charge" in log)
+        self.assertFalse("sleeping" in log)
+
+
+if __name__ == '__main__':
+    unittest.main()
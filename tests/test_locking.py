@@ -0,0 +1,83 @@
+
+"""
+Tests for the lockfile (locking), and for runs finding it held.
+"""
+
+import os
+import time
+import signal
+import unittest
+
+from common import SyncTestCase
+
+from gratia_gold import locking
+
+class PersistentLockTest(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.holder = None
+
+    def tearDown(self):
+        if self.holder:
+            os.kill(self.holder, signal.SIGKILL)
+            os.waitpid(self.holder, 0)
+        SyncTestCase.tearDown(self)
+
+    def hold(self, persistent):
+        """
+        Fork a child which takes the lock, and holds it until killed.
+        """
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(rfd)
+                locking.exclusive_lock(self.path("lock"),
+                    persistent=persistent)
+                os.write(wfd, "x")
+                time.sleep(60)
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        os.read(rfd, 1)
+        os.close(rfd)
+        self.holder = pid
+
+    def alive(self):
+        return os.waitpid(self.holder, os.WNOHANG) == (0, 0)
+
+    def test_persistent(self):
+        self.hold(True)
+        self.assertEqual(locking.persistent_holder(self.path("lock")),
+            self.holder)
+        fd = open(self.path("lock"), "a+")
+        try:
+            # Never timed out, however old.
+            self.assertFalse(locking.check_lock(fd, 0))
+        finally:
+            fd.close()
+        self.assertTrue(self.alive())
+
+    def test_not_persistent(self):
+        self.hold(False)
+        self.assertEqual(locking.persistent_holder(self.path("lock")), None)
+        fd = open(self.path("lock"), "a+")
+        try:
+            self.assertTrue(locking.check_lock(fd, 0))
+        finally:
+            fd.close()
+        os.waitpid(self.holder, 0)
+        self.holder = None
+
+    def test_cron(self):
+        self.add_records(1, 10)
+        self.hold(True)
+        self.assertEqual(self.run_sync("-s", "1", "-v"), 0)
+        self.assertTrue(self.alive())
+        self.assertEqual(self.charged(), 0)
+        self.assertTrue("holds the lockfile" in open(self.path("log")).read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+
+"""
+Tests for queued logging (logs).
+"""
+
+import os
+import logging
+import unittest
+
+from common import StateTestCase
+
+from gratia_gold import logs
+
+class RecordingHandler(logging.Handler):
+    """
+    Keeps the records it is handed, and whether it was closed.
+    """
+
+    def __init__(self, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.records = []
+        self.closed = False
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def close(self):
+        self.closed = True
+        logging.Handler.close(self)
+
+
+class LogsTest(StateTestCase):
+
+    def setUp(self):
+        StateTestCase.setUp(self)
+        # after_fork looks after the handlers of the gratia_gold logger.
+        self.log = logging.getLogger("gratia_gold")
+        self.saved = (self.log.handlers[:], self.log.level, logs.writer)
+        logs.writer = None
+        self.handler = RecordingHandler()
+
+    def tearDown(self):
+        if logs.writer:
+            logs.writer.close()
+        handlers, level, logs.writer = self.saved
+        self.log.handlers[:] = handlers
+        self.log.setLevel(level)
+        StateTestCase.tearDown(self)
+
+    def messages(self, handler=None):
+        logs.stop()
+        return [record.getMessage() for record in \
+            (handler or self.handler).records]
+
+    def test_queued(self):
+        warnings = RecordingHandler(logging.WARNING)
+        logs.configure(self.log, [self.handler, warnings], logging.INFO)
+        job = {'dbid': 1}
+        self.log.info("Charging %s", job)
+        # Logged as it was when logged.
+        job['dbid'] = 2
+        self.log.debug("Not logged")
+        self.log.warning("Warned")
+        self.assertEqual(self.messages(), ["Charging {'dbid': 1}", "Warned"])
+        self.assertEqual(self.messages(warnings), ["Warned"])
+
+    def test_exception(self):
+        logs.configure(self.log, [self.handler], logging.INFO)
+        try:
+            raise ValueError("bad value")
+        except ValueError:
+            self.log.exception("Failed")
+        self.messages()
+        record = self.handler.records[0]
+        self.assertEqual(record.exc_info, None)
+        self.assertTrue("ValueError: bad value" in record.exc_text)
+        self.assertTrue("ValueError: bad value" in \
+            logging.Formatter().format(record))
+
+    def test_reconfigure(self):
+        logs.configure(self.log, [self.handler], logging.INFO)
+        other = RecordingHandler()
+        logs.configure(self.log, [other], logging.DEBUG)
+        self.assertTrue(self.handler.closed)
+        self.assertEqual(len(self.log.handlers), 1)
+        self.log.debug("Once")
+        self.assertEqual(self.messages(other), ["Once"])
+        self.assertEqual(self.handler.records, [])
+
+    def test_after_fork(self):
+        handler = logging.FileHandler(self.path("log"))
+        logs.configure(self.log, [handler], logging.INFO)
+        self.log.info("Parent")
+        logs.stop()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                logs.after_fork()
+                self.log.info("Child %i", os.getpid())
+                logs.stop()
+            finally:
+                os._exit(0)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(open(self.path("log")).read().splitlines(),
+            ["Parent", "Child %i" % pid])
+
+
+if __name__ == '__main__':
+    unittest.main()
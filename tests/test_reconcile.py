@@ -0,0 +1,104 @@
+
+"""
+Tests for comparing Gratia totals with those charged (gratia-gold-reconcile),
+against the mock Gold server.
+"""
+
+import sys
+import sqlite3
+import unittest
+import subprocess
+
+from common import BENCH_DIR, SRC_DIR, SyncTestCase
+
+from gratia_gold import gold_mock
+
+KEY = "test-key"
+
+# Runs gratia-gold-reconcile with the arguments given.
+RUNNER = """
+import sys
+sys.path[:0] = [%r, %r]
+import sqlite_mysqldb
+sqlite_mysqldb.install()
+from gratia_gold import reconcile
+sys.argv[0] = "gratia-gold-reconcile"
+sys.exit(reconcile.run())
+""" % (BENCH_DIR, SRC_DIR)
+
+class ReconcileTest(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.server = gold_mock.MockGoldServer(KEY)
+        self.server.start()
+        fd = open(self.path("auth_key"), "w")
+        fd.write(KEY)
+        fd.close()
+        self.cp.set("gold", "backend", "native")
+        self.cp.set("gold", "home", self.dir)
+        self.cp.set("gold", "port", str(self.server.server_address[1]))
+        self.cp.set("gold", "auth_key", self.path("auth_key"))
+        # Probes a and b charge to the same machine.
+        for name, machinename in [("a", "mach"), ("b", "mach"),
+                ("c", "other")]:
+            self.cp.add_section("probe:%s" % name)
+            self.cp.set("probe:%s" % name, "probe", "condor:%s" % name)
+            self.cp.set("probe:%s" % name, "machinename", machinename)
+        self.add_records(1, 100, "condor:a")
+        self.add_records(101, 100, "condor:b")
+        self.add_records(201, 50, "condor:c")
+        # Charged an hour, and 100 seconds.
+        conn = sqlite3.connect(self.path("gratia.sqlite"))
+        for dbid, wall in [(251, None), (252, 100.5)]:
+            conn.execute("INSERT INTO JobUsageRecord VALUES (%s)" % \
+                ", ".join(["?"]*14), (dbid, "Batch", "vo1", "user9", None,
+                wall, 1.0, 1.0, 1, 1, 1, "2012-01-02 12:00:00", "mach",
+                "proj9"))
+            conn.execute("INSERT INTO JobUsageRecord_Meta VALUES (?, ?)",
+                (dbid, "condor:a"))
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.run_sync(), 0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        SyncTestCase.tearDown(self)
+
+    def reconcile(self, *args):
+        """
+        Run gratia-gold-reconcile with the test's configuration; returns
+        its exit status and the discrepancies it reported.
+        """
+        output = open(self.path("output"), "a")
+        try:
+            status = subprocess.call([sys.executable, "-c", RUNNER, "-c",
+                self.path("gratia-gold.cfg"), "-o", self.path("report"),
+                "--tolerance", "0"] + list(args), stdout=output,
+                stderr=output)
+        finally:
+            output.close()
+        lines = open(self.path("report")).read().splitlines()
+        return status, [line.split("\t") for line in lines[1:]]
+
+    def test_shared_machine(self):
+        self.assertEqual(self.reconcile("--probe", "a"), (0, []))
+        self.assertEqual(self.reconcile("--probe", "c"), (0, []))
+        self.assertEqual(self.reconcile(), (0, []))
+        # A charge of probe b is missing from the totals of its machine.
+        job_id = [job_id for job_id in self.server.jobs \
+            if 101 <= int(job_id) < 201][0]
+        job = self.server.jobs[job_id]
+        charge = job['Charge']
+        job['Charge'] = 0
+        status, rows = self.reconcile("--probe", "a")
+        self.assertEqual(status, 1)
+        self.assertEqual([row[:3] + row[5:] for row in rows],
+            [[job['EndTime'][:10], job['Project'], job['User'],
+            "%+.2f" % charge]])
+        self.assertEqual(self.reconcile("--probe", "c"), (0, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
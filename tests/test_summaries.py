@@ -0,0 +1,134 @@
+
+"""
+Tests for the charged-summary index (summaries.ChargedIndex).
+"""
+
+import unittest
+
+from common import make_job, StateTestCase
+
+from gratia_gold import gold
+from gratia_gold import summaries
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+OLD_SCHEMA = \
+"""
+CREATE TABLE charged (
+  group_key TEXT PRIMARY KEY,
+  gold_job_id INTEGER NOT NULL,
+  max_dbid INTEGER NOT NULL,
+  charge INTEGER NOT NULL,
+  wall_duration INTEGER,
+  cpu INTEGER,
+  njobs INTEGER
+)
+"""
+
+class ChargedIndexTest(StateTestCase):
+
+    def setUp(self):
+        StateTestCase.setUp(self)
+        self.index = summaries.ChargedIndex(self.path("charged"))
+
+    def tearDown(self):
+        self.index.close()
+        StateTestCase.tearDown(self)
+
+    def filter(self, jobs, index=None):
+        skipped = []
+        charged = list((index or self.index).filter(jobs, skipped))
+        return charged, skipped
+
+    def test_filter(self):
+        charged, skipped = self.filter([make_job(10, charge=100)])
+        self.assertEqual(charged[0]['incremental'], None)
+        self.index.record(charged[0])
+        old, new, other = make_job(10), make_job(20, charge=30), \
+            make_job(15, user="user2")
+        charged, skipped = self.filter([old, new, other])
+        self.assertEqual(charged, [new, other])
+        self.assertEqual(skipped, [old])
+        self.assertEqual((new['gold_job_id'], new['incremental']), (10, True))
+        self.assertEqual(new['previous'], {'charge': "100",
+            'wall_duration': 100, 'cpu': 2, 'njobs': 1})
+        self.index.record(new)
+        self.assertEqual(self.index.lookup(make_job(30)),
+            (10, 20, 130, 130, 4, 2))
+
+    def test_prepare_retry(self):
+        self.index.record(self.filter([make_job(20, charge=100)])[0][0])
+        # A failed charge of an older summary is still made, to the
+        # group's current Gold job.
+        job = make_job(10, charge=5, gold_job_id=3, incremental=True,
+            previous={'charge': "1"})
+        job = self.index.prepare_retry(job)
+        self.assertEqual((job['gold_job_id'], job['incremental'],
+            job['previous']['charge']), (20, True, "100"))
+        job = self.index.prepare_retry(make_job(5, user="user2",
+            gold_job_id=3))
+        self.assertEqual((job['gold_job_id'], job['incremental']),
+            (None, None))
+
+    def test_rollback(self):
+        self.index.record(self.filter([make_job(10)])[0][0])
+        self.index.commit()
+        self.index.record(self.filter([make_job(20)])[0][0])
+        self.index.rollback()
+        self.assertEqual(self.index.lookup(make_job(30))[:3], (10, 10, 100))
+
+    def test_refund_incremental(self):
+        backend = gold.FakeBackend()
+        first = self.filter([make_job(10, charge=100)])[0]
+        backend.charge(first)
+        self.index.record(first[0])
+        second = self.filter([make_job(20, charge=30)])[0]
+        backend.charge(second)
+        self.assertEqual(backend.charges["10"][4], 130)
+        # Gold can only refund whole jobs; the previous totals are charged
+        # back.
+        self.assertEqual(backend.refund(second[0].todict()), 0)
+        self.assertEqual(backend.charges["10"][4], 100)
+
+    def test_merge(self):
+        self.index.record(self.filter([make_job(10, charge=100)])[0][0])
+        self.index.commit()
+        # A backfill shard charges the same group as a new Gold job.
+        shard = summaries.ChargedIndex(self.path("charged.shard"))
+        try:
+            charged = self.filter([make_job(50, charge=40)], shard)[0]
+            shard.record(charged[0])
+            charged = self.filter([make_job(60, charge=2)], shard)[0]
+            shard.record(charged[0])
+            shard.commit()
+        finally:
+            shard.close()
+        self.index.merge(self.path("charged.shard"))
+        self.index.commit()
+        rows = self.index.conn.execute("SELECT gold_job_id, max_dbid, "
+            "charge FROM charged ORDER BY gold_job_id").fetchall()
+        self.assertEqual(rows, [(10, 10, 100), (50, 60, 42)])
+        self.assertEqual(self.index.lookup(make_job(70))[0], 50)
+
+    def test_upgrade(self):
+        self.index.close()
+        conn = sqlite3.connect(self.path("charged.old"))
+        conn.execute(OLD_SCHEMA)
+        conn.execute("INSERT INTO charged VALUES ('key', 10, 12, 100, 100, "
+            "2, 1)")
+        conn.commit()
+        conn.close()
+        self.index = summaries.ChargedIndex(self.path("charged.old"))
+        self.assertEqual(self.index.conn.execute("SELECT %s FROM charged" % \
+            summaries.COLUMNS).fetchall(), [("key", 10, 12, 100, 100, 2, 1)])
+        self.index.conn.execute("INSERT INTO charged VALUES ('key', 20, 30, "
+            "5, 5, 1, 1)")
+        self.assertEqual(self.index.conn.execute("SELECT count(*) FROM "
+            "charged").fetchone()[0], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+
+"""
+End-to-end tests of the sync loop, against a SQLite Gratia database.
+"""
+
+import unittest
+
+from common import SyncTestCase
+
+from gratia_gold import main
+from gratia_gold import gratia
+
+class WindowTest(SyncTestCase):
+
+    def test_resize(self):
+        self.cp.set("gratia", "window", "1000")
+        self.cp.set("gratia", "window_rows", "100")
+        window = gratia.Window(self.cp)
+        for rows, size in [(200, 500), (50, 1000), (0, 4000), (10000, 1000),
+                (1, 4000)]:
+            window.resize(rows)
+            self.assertEqual(window.size, size)
+
+    def test_invalid(self):
+        self.cp.set("gratia", "window_rows", "0")
+        self.assertRaises(Exception, gratia.Window, self.cp)
+
+    def test_next_dbid(self):
+        self.add_records(1, 10)
+        self.add_records(5001, 10)
+        self.add_records(9001, 10, probe="other:probe")
+        self.assertEqual(gratia.next_dbid(self.cp, 11, 9010), 5001)
+        self.assertEqual(gratia.next_dbid(self.cp, 5011, 9010), None)
+
+    def test_sync(self):
+        self.cp.set("gratia", "window", "20")
+        self.cp.set("gratia", "window_rows", "5")
+        self.add_records(1, 300, users=10)
+        self.add_records(100001, 300, users=10)
+        self.add_records(200001, 50, probe="other:probe")
+        self.assertEqual(self.run_sync(), 0)
+        self.assertEqual(self.charged(), self.expected())
+        self.assertEqual(self.txn()['last_successful_id'], 200051)
+
+
+class PrefetchTest(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.cp.set("gratia", "window", "20")
+        self.cp.set("gratia", "window_rows", "5")
+        self.cp.set("gratia", "prefetch", "2")
+        self.add_records(1, 400, users=10)
+
+    def test_prefetcher(self):
+        def items():
+            for i in range(5):
+                yield i
+            raise ValueError("done")
+        prefetcher = main.Prefetcher(items(), 2)
+        seen = []
+        try:
+            for item in prefetcher:
+                seen.append(item)
+        except ValueError:
+            pass
+        prefetcher.close()
+        self.assertEqual(seen, range(5))
+
+    def test_close(self):
+        def items():
+            i = 0
+            while True:
+                yield i
+                i += 1
+        prefetcher = main.Prefetcher(items(), 2)
+        self.assertEqual(iter(prefetcher).next(), 0)
+        prefetcher.close()
+        self.assertFalse(prefetcher.thread.isAlive())
+
+    def test_sync(self):
+        self.assertEqual(self.run_sync(), 0)
+        self.assertEqual(self.charged(), self.expected())
+
+    def test_client_aggregate(self):
+        self.cp.set("gratia", "aggregate", "client")
+        self.assertEqual(self.run_sync(), 0)
+        self.assertEqual(self.charged(), self.expected())
+
+    def test_failure(self):
+        # The windows fetched ahead of a failed one are not committed.
+        status, backend = self.sync(lambda job: job['dbid'] >= 200)
+        self.assertEqual(status, 1)
+        committed = self.txn()['last_successful_id']
+        self.assertTrue(1 < committed <= 200)
+        self.assertEqual(self.charged(), sum([jur[5] for jur, jurm in \
+            self.records if jur[0] < committed]))
+        status, backend = self.sync()
+        self.assertEqual(status, 0)
+        self.assertEqual(self.charged(), self.expected())
+
+
+class CheckpointTest(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.cp.set("gratia", "window", "1000")
+        self.cp.set("transaction", "checkpoint_interval", "5")
+        # One window of 50 summaries, each of the records dbid and
+        # dbid - 50, with dbids 51 to 100.
+        self.add_records(1, 100, users=50)
+
+    def summary_total(self, first, last):
+        total = 0
+        for jur, jurm in self.records:
+            dbid = jur[0] % 50 + 50
+            if dbid == 50:
+                dbid = 100
+            if first <= dbid <= last:
+                total += jur[5]
+        return total
+
+    def test_replay(self):
+        status, backend = self.sync(lambda job: job['dbid'] == 75)
+        self.assertEqual(status, 1)
+        self.assertEqual(backend.charged, range(51, 75) + range(76, 101))
+        # Charges up to the last checkpoint are kept; the rest are refunded.
+        txn = self.txn()
+        self.assertEqual(txn['window_end'], 101)
+        self.assertTrue(txn['journal_offset'] > 0)
+        self.assertEqual(self.charged(), self.summary_total(51, 70))
+        # The window is replayed without them.
+        status, backend = self.sync()
+        self.assertEqual(status, 0)
+        self.assertEqual(backend.charged, range(71, 101))
+        self.assertEqual(self.charged(), self.expected())
+        self.assertFalse('window_end' in self.txn())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,291 @@
+
+"""
+Tests for the rollback log, checkpoints and the retry queue.
+"""
+
+import os
+import time
+import unittest
+
+from common import make_job, StateTestCase
+
+from gratia_gold import gold
+from gratia_gold import main
+from gratia_gold import summaries
+from gratia_gold import transaction
+
+class RecordingBackend(gold.Backend):
+    """
+    Records the charges and refunds it is asked for; the charges of the
+    dbids in `failing`, and the refunds of those in `failing_refunds`,
+    fail.
+    """
+
+    name = "recording"
+
+    def __init__(self, failing=(), failing_refunds=()):
+        self.failing = failing
+        self.failing_refunds = failing_refunds
+        self.requests = []
+
+    def charge(self, jobs, before_charge=None, after_charge=None):
+        statuses = []
+        for job in jobs:
+            if before_charge:
+                before_charge(job)
+            status = 0
+            if job['dbid'] in self.failing:
+                status = 1
+            self.requests.append(("charge", job['dbid']))
+            statuses.append(status)
+            if after_charge:
+                after_charge(job, status)
+        return statuses
+
+    def refund(self, job):
+        self.requests.append(("refund", job['dbid']))
+        if job['dbid'] in self.failing_refunds:
+            return 1
+        return 0
+
+
+class JournalTest(StateTestCase):
+
+    def setUp(self):
+        StateTestCase.setUp(self)
+        self.journal = transaction.open_journal(self.cp)
+
+    def tearDown(self):
+        self.journal.close()
+        StateTestCase.tearDown(self)
+
+    def test_entries(self):
+        offsets = [self.journal.append(make_job(i)) for i in range(1, 4)]
+        self.assertEqual(offsets[-1], os.path.getsize(self.path("rollback")))
+        entries = list(self.journal.entries(0))
+        self.assertEqual([offset for offset, job in entries], offsets)
+        self.assertEqual([job['dbid'] for offset, job in entries], [1, 2, 3])
+        self.assertEqual([job['dbid'] for offset, job in \
+            self.journal.entries(offsets[0])], [2, 3])
+        self.assertEqual(sorted(self.journal.charged().keys()), [1, 2, 3])
+
+    def test_group_commit(self):
+        self.journal.close()
+        self.journal = transaction.Journal(self.path("rollback"), 3)
+        self.journal.append(make_job(1))
+        self.journal.append(make_job(2))
+        self.assertEqual(self.journal.pending, 2)
+        self.journal.append(make_job(3))
+        self.assertEqual(self.journal.pending, 0)
+        self.assertEqual(os.path.getsize(self.path("rollback")),
+            self.journal.size)
+
+    def test_corrupt_entry(self):
+        self.journal.append(make_job(1))
+        self.journal.close()
+        fd = open(self.path("rollback"), "r+")
+        fd.seek(40)
+        fd.write("X")
+        fd.close()
+        self.journal = transaction.open_journal(self.cp)
+        self.assertRaises(Exception, list, self.journal.entries(0))
+
+    def test_rollback(self):
+        gold.backend = RecordingBackend()
+        self.journal.append(make_job(1))
+        self.journal.append(make_job(2))
+        transaction.check_rollback(self.cp, self.journal)
+        self.assertEqual(gold.backend.requests, [("refund", 1),
+            ("refund", 2)])
+        self.assertEqual(os.path.getsize(self.path("rollback")), 0)
+        self.assertEqual(self.journal.refund_offset(), 0)
+
+    def test_failed_refund(self):
+        gold.backend = RecordingBackend(failing_refunds=[2])
+        for dbid in range(1, 4):
+            self.journal.append(make_job(dbid))
+        self.assertRaises(Exception, transaction.check_rollback, self.cp,
+            self.journal)
+        self.assertEqual(gold.backend.requests, [("refund", 1),
+            ("refund", 2)])
+        # The next run resumes the rollback at the failed refund.
+        gold.backend = RecordingBackend()
+        transaction.check_rollback(self.cp, self.journal)
+        self.assertEqual(gold.backend.requests, [("refund", 2),
+            ("refund", 3)])
+        self.assertEqual(self.journal.charged(), {})
+
+    def test_reset(self):
+        first = self.journal.append(make_job(1))
+        self.journal.append(make_job(2))
+        self.journal.reset(first)
+        self.assertEqual(self.journal.charged().keys(), [1])
+        self.journal.reset()
+        self.assertEqual(self.journal.charged(), {})
+        self.assertEqual(os.path.getsize(self.path("rollback")), 0)
+
+    def test_rollback_to_checkpoint(self):
+        gold.backend = RecordingBackend()
+        committed = self.journal.append(make_job(1))
+        self.journal.append(make_job(2))
+        self.journal.append(make_job(3))
+        transaction.check_rollback(self.cp, self.journal, committed)
+        self.assertEqual(gold.backend.requests, [("refund", 2),
+            ("refund", 3)])
+        self.assertEqual(self.journal.charged().keys(), [1])
+
+    def test_resume_rollback(self):
+        gold.backend = RecordingBackend()
+        first = self.journal.append(make_job(1))
+        self.journal.append(make_job(2))
+        # A rollback interrupted after refunding the first entry.
+        fd = open(self.journal.refund_path, "w")
+        fd.write(transaction.REFUND_RECORD % first)
+        fd.close()
+        self.assertEqual(self.journal.refund_offset(), first)
+        transaction.check_rollback(self.cp, self.journal)
+        self.assertEqual(gold.backend.requests, [("refund", 2)])
+        self.assertEqual(os.path.getsize(self.path("rollback")), 0)
+
+
+class CheckpointerTest(StateTestCase):
+
+    def test_out_of_order(self):
+        journal = transaction.open_journal(self.cp)
+        txn = transaction.start_txn(self.cp)
+        checkpointer = transaction.Checkpointer(self.cp, txn, journal, 2, 100)
+        jobs = [make_job(i) for i in range(1, 5)]
+        offsets = []
+        for job in jobs:
+            offsets.append(journal.append(job))
+            checkpointer.started_charge(job, offsets[-1])
+        checkpointer.finished_charge(jobs[1], 0)
+        checkpointer.finished_charge(jobs[3], 0)
+        self.assertFalse('journal_offset' in txn)
+        checkpointer.finished_charge(jobs[0], 0)
+        self.assertEqual(txn['journal_offset'], offsets[1])
+        self.assertEqual(txn['window_end'], 100)
+        self.assertEqual(transaction.start_txn(self.cp)['journal_offset'],
+            offsets[1])
+        checkpointer.finished_charge(jobs[2], 1)
+        self.assertEqual(txn['journal_offset'], offsets[1])
+        journal.close()
+
+    def test_commit_txn(self):
+        txn = transaction.start_txn(self.cp)
+        self.assertEqual(txn['last_successful_id'], 0)
+        txn['last_successful_id'] = 10
+        transaction.commit_txn(self.cp, txn)
+        self.assertEqual(transaction.start_txn(self.cp), txn)
+        self.assertFalse(os.path.exists(self.path("txn.tmp")))
+
+
+class RetryQueueTest(StateTestCase):
+
+    def setUp(self):
+        StateTestCase.setUp(self)
+        self.cp.set("transaction", "retry_attempts", "3")
+        self.cp.set("transaction", "retry_delay", "10")
+        self.cp.set("transaction", "retry_max_delay", "25")
+        self.txn = transaction.start_txn(self.cp)
+
+    def test_delays(self):
+        now = time.time()
+        for attempts in range(3):
+            transaction.queue_retry(self.cp, self.txn, make_job(attempts),
+                attempts)
+        delays = [entry['due'] - now for entry in self.txn['retry']]
+        for delay, expected in zip(delays, [10, 20, 25]):
+            self.assertTrue(expected <= delay < expected + 5)
+        self.assertEqual([entry['attempts'] for entry in self.txn['retry']],
+            [1, 2, 3])
+
+    def test_dead_letter(self):
+        import simplejson
+        transaction.queue_retry(self.cp, self.txn, make_job(1), 3)
+        self.assertEqual(self.txn.get('retry'), None)
+        lines = open(self.path("rollback.dead")).readlines()
+        self.assertEqual(len(lines), 1)
+        entry = simplejson.loads(lines[0])
+        self.assertEqual((entry['job']['dbid'], entry['attempts']), (1, 4))
+
+    def test_due(self):
+        transaction.queue_retry(self.cp, self.txn, make_job(1),
+            unknown=True)
+        transaction.queue_retry(self.cp, self.txn, make_job(2))
+        self.assertEqual(transaction.due_retries(self.txn), [])
+        self.txn['retry'][0]['due'] = time.time() - 1
+        due = transaction.due_retries(self.txn)
+        self.assertEqual([(entry['job']['dbid'], entry.get('unknown')) \
+            for entry in due], [(1, True)])
+        self.assertEqual([entry['job']['dbid'] for entry in \
+            self.txn['retry']], [2])
+
+    def test_queue_failures(self):
+        failed = [(make_job(1), 1), (make_job(2), gold.UNKNOWN)]
+        self.assertFalse(main.queue_failures(self.cp, self.txn, failed, 3))
+        self.assertTrue(main.queue_failures(self.cp, self.txn, failed, 4))
+        self.assertEqual([entry.get('unknown') for entry in \
+            self.txn['retry']], [None, True])
+        self.cp.set("transaction", "retry_queue_size", "3")
+        self.assertFalse(main.queue_failures(self.cp, self.txn, failed, 100))
+        self.cp.set("transaction", "retry_attempts", "0")
+        self.assertFalse(main.queue_failures(self.cp, self.txn,
+            failed[:1], 100))
+
+    def test_charge_retries(self):
+        gold.backend = RecordingBackend(failing=[2])
+        transaction.queue_retry(self.cp, self.txn, make_job(1),
+            unknown=True)
+        transaction.queue_retry(self.cp, self.txn, make_job(2))
+        for entry in self.txn['retry']:
+            entry['due'] = time.time() - 1
+        journal = transaction.open_journal(self.cp)
+        main.charge_retries(self.cp, self.txn, journal, None)
+        self.assertEqual(gold.backend.requests, [("refund", 1),
+            ("charge", 1), ("charge", 2)])
+        self.assertEqual([(entry['job']['dbid'], entry['attempts']) \
+            for entry in self.txn['retry']], [(2, 2)])
+        self.assertEqual(journal.charged(), {})
+        self.assertEqual(transaction.start_txn(self.cp)['retry'],
+            self.txn['retry'])
+        journal.close()
+
+    def test_failed_refund(self):
+        gold.backend = RecordingBackend(failing_refunds=[1])
+        transaction.queue_retry(self.cp, self.txn, make_job(1),
+            unknown=True)
+        self.txn['retry'][0]['due'] = time.time() - 1
+        journal = transaction.open_journal(self.cp)
+        main.charge_retries(self.cp, self.txn, journal, None)
+        # The charge may still be in Gold; it is not made again.
+        self.assertEqual(gold.backend.requests, [("refund", 1)])
+        self.assertEqual([(entry['job']['dbid'], entry['attempts'],
+            entry['unknown']) for entry in self.txn['retry']],
+            [(1, 2, True)])
+        journal.close()
+
+    def test_same_group(self):
+        # Two retries for a group already in Gold, charged to its Gold job.
+        gold.backend = gold.FakeBackend(self.path("gold.sqlite"))
+        index = summaries.ChargedIndex(self.path("index"))
+        job = make_job(1)
+        gold.normalize_job(job)
+        gold.backend.charge([job])
+        index.record(job)
+        index.commit()
+        for dbid in [2, 3]:
+            transaction.queue_retry(self.cp, self.txn, make_job(dbid))
+        for entry in self.txn['retry']:
+            entry['due'] = time.time() - 1
+        journal = transaction.open_journal(self.cp)
+        main.charge_retries(self.cp, self.txn, journal, index)
+        journal.close()
+        self.assertEqual(gold.backend.conn.execute("SELECT job_id, charge "
+            "FROM charges").fetchall(), [("1", 300)])
+        self.assertEqual(index.lookup(make_job(4))[:3], (1, 3, 300))
+        index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()